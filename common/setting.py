@@ -1,7 +1,9 @@
+import os
+import threading
 from pathlib import Path
+from typing import Optional
 
 from dataclasses import dataclass
-from omegaconf import OmegaConf
 
 
 @dataclass
@@ -46,6 +48,49 @@ class ModelsConfig:
     vae_path: str
     dwpose_config_path: str
     dwpose_model_path: str
+    export_dir: str
+
+
+@dataclass
+class CacheConfig:
+    audio_feature_dir: str
+    audio_feature_memory_items: int
+    audio_feature_disk_bytes: int
+    tts_dir: str
+    tts_disk_bytes: int
+    tts_provider: str
+
+
+@dataclass
+class ServingConfig:
+    avatar_id: str
+    video_path: str
+    bbox_shift: int
+    batch_size: int
+    frame_buffer_size: int
+    jitter_buffer_depth: int
+    underrun_policy: str
+    overrun_policy: str
+    client_buffer_size: int
+    encoder_workers: int
+    max_width: int
+    max_height: int
+    jpeg_quality: int
+    h264_gop: int
+    h264_bitrate: str
+    h264_preset: str
+    queue_policy: str
+    admission_policy: str
+    max_backlog_seconds: float
+    tts_seconds_per_char: float
+    mode: str
+    ring_slots: int
+    worker_heartbeat_timeout: float
+    profile_dir: str
+    profile_token: str
+    backend: str
+    backend_threads: int
+    variable_length_audio: bool
 
 
 @dataclass
@@ -55,9 +100,13 @@ class Settings:
     train: TrainConfig
     avatar: AvatarConfig
     models: ModelsConfig
+    cache: CacheConfig
+    serving: ServingConfig
 
     @classmethod
     def from_yaml(cls, file_path: str) -> "Settings":
+        from omegaconf import OmegaConf
+
         # 加载 YAML 文件并转换为字典
         config_dict = OmegaConf.load(file_path)
         # 将字典转换为 OmegaConf 对象的结构化形式
@@ -68,9 +117,41 @@ class Settings:
         return OmegaConf.to_object(config)
 
     def save_to_yaml(self, file_path: str):
+        from omegaconf import OmegaConf
+
         # 将当前配置保存为 YAML 文件
         config_dict = OmegaConf.structured(self)
         OmegaConf.save(config_dict, file_path)
 
 
-settings = Settings.from_yaml(str(Path(__file__).parent / "settings.yaml"))
+_settings: Optional[Settings] = None
+_settings_lock = threading.Lock()
+
+
+def get_settings() -> Settings:
+    """
+    第一次调用时读取配置文件，MUSETALK_SETTINGS可指定其它配置文件，例如压测时使用的小模型配置
+    """
+    global _settings
+    if _settings is None:
+        with _settings_lock:
+            if _settings is None:
+                _settings = Settings.from_yaml(
+                    os.environ.get("MUSETALK_SETTINGS", str(Path(__file__).parent / "settings.yaml"))
+                )
+    return _settings
+
+
+class _LazySettings:
+    """
+    import时不读取配置文件(也不导入omegaconf)，第一次访问属性时才加载
+    """
+
+    def __getattr__(self, name):
+        return getattr(get_settings(), name)
+
+    def __repr__(self):
+        return repr(get_settings())
+
+
+settings = _LazySettings()
@@ -0,0 +1,26 @@
+import re
+
+pattern = re.compile('([﹒﹔﹖﹗．；。！？]["’”」』]{0,2}|：(?=["‘“「『]{1,2}|$))')
+# 可朗读的内容: 文字和数字，只有空白和标点的片段tts无法合成
+speakable = re.compile(r'[^\W_]')
+
+
+def split_sentence(text, min_length=5):
+    if not text.strip():
+        return []
+    slist = []
+    for sentence in pattern.split(text):
+        if pattern.match(sentence) and slist:
+            slist[-1] += sentence
+        elif sentence:
+            if len(sentence) >= min_length:
+                slist.append(sentence)
+    return slist
+
+
+def speakable_sentences(text, min_length=1):
+    """
+    按句切分后去掉首尾空白，丢弃没有可朗读内容的句子(例如句号之后的换行或单独的标点)
+    """
+    sentences = (sentence.strip() for sentence in split_sentence(text, min_length))
+    return [sentence for sentence in sentences if speakable.search(sentence)]
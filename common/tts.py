@@ -0,0 +1,185 @@
+import io
+import os
+import asyncio
+import hashlib
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Dict, Union, Optional
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+import soundfile
+
+from common.setting import settings
+
+DEFAULT_VOICE = "zh-CN-XiaoxiaoNeural"
+DEFAULT_RATE = '-4%'
+DEFAULT_VOLUME = '+0%'
+
+
+class TTSProvider(ABC):
+    """
+    tts服务的接口，synthesize返回编码后的音频bytes，suffix为对应的文件后缀
+    """
+    name = "base"
+    suffix = ".mp3"
+
+    @abstractmethod
+    async def synthesize(self, text: str, voice: str, rate: str, volume: str) -> bytes:
+        ...
+
+
+class EdgeTTSProvider(TTSProvider):
+    name = "edge"
+    suffix = ".mp3"
+
+    async def synthesize(self, text, voice, rate, volume):
+        import edge_tts
+
+        communicate = edge_tts.Communicate(text=text, voice=voice, rate=rate, volume=volume)
+        audio = bytearray()
+        async for chunk in communicate.stream():
+            if chunk["type"] == "audio":
+                audio.extend(chunk["data"])
+        return bytes(audio)
+
+
+class ToneTTSProvider(TTSProvider):
+    """
+    不访问网络的替身，每个字符生成一段固定时长的音调，输出16kHz单声道wav，用于离线测试和压测
+    """
+    name = "tone"
+    suffix = ".wav"
+
+    def __init__(self, seconds_per_char=0.2, sample_rate=16000):
+        self.seconds_per_char = seconds_per_char
+        self.sample_rate = sample_rate
+
+    async def synthesize(self, text, voice, rate, volume):
+        chars = text.strip() or " "
+        samples_per_char = int(self.seconds_per_char * self.sample_rate)
+        t = np.arange(samples_per_char) / self.sample_rate
+        # 每个字符的音高由字符本身和voice决定，并加上起伏的包络模拟音节
+        envelope = np.sin(np.pi * t / self.seconds_per_char)
+        offset = int(hashlib.sha256(voice.encode()).hexdigest()[:4], 16) % 100
+        waveform = np.concatenate([
+            0.3 * envelope * np.sin(2 * np.pi * (150 + offset + ord(char) % 300) * t) for char in chars
+        ]).astype(np.float32)
+        buffer = io.BytesIO()
+        soundfile.write(buffer, waveform, self.sample_rate, format='WAV', subtype='PCM_16')
+        return buffer.getvalue()
+
+
+TTS_PROVIDERS = {
+    EdgeTTSProvider.name: EdgeTTSProvider,
+    ToneTTSProvider.name: ToneTTSProvider,
+}
+
+
+class TTSCache:
+    """
+    以(text, voice, rate, volume)为键的tts音频缓存，相同的内容只合成一次(并发的相同请求等待同一次合成)，
+    总大小超过max_bytes时按最近使用时间淘汰
+
+    调用方可能各自使用asyncio.run(每个请求一个事件循环)，等待中的合成因此使用线程安全的concurrent.futures.Future
+    """
+
+    def __init__(self, cache_dir: Union[str, Path], max_bytes=1 << 30, provider: Optional[TTSProvider] = None):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.provider = provider or EdgeTTSProvider()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # 正在合成的文件名及其结果
+        self.pending: Dict[str, Future] = {}
+        files = sorted(self.cache_dir.glob(f'*{self.provider.suffix}'), key=lambda file: file.stat().st_mtime)
+        self.index = OrderedDict((file.name, file.stat().st_size) for file in files)
+        self.total_bytes = sum(self.index.values())
+
+    def make_key(self, text, voice, rate, volume) -> str:
+        content = "\x00".join([self.provider.name, text, voice, rate, volume])
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    async def synthesize(self, text, voice=DEFAULT_VOICE, rate=DEFAULT_RATE, volume=DEFAULT_VOLUME) -> Path:
+        """
+        返回合成音频的文件路径，命中缓存时不再调用tts服务
+        """
+        filename = self.make_key(text, voice, rate, volume) + self.provider.suffix
+        path = self.cache_dir / filename
+        with self.lock:
+            if filename in self.index and path.exists():
+                self.index.move_to_end(filename)
+                self.hits += 1
+                os.utime(path)
+                return path
+            future = self.pending.get(filename)
+            if future is None:
+                future = self.pending[filename] = Future()
+                self.misses += 1
+                owner = True
+            else:
+                self.hits += 1
+                owner = False
+        if not owner:
+            return await asyncio.wrap_future(future)
+        try:
+            audio = await self.provider.synthesize(text, voice, rate, volume)
+            # 先写临时文件再替换，其它进程不会读到不完整的文件
+            tmp_path = self.cache_dir / f'{filename}.{os.getpid()}.{threading.get_ident()}.tmp'
+            tmp_path.write_bytes(audio)
+            os.replace(tmp_path, path)
+            with self.lock:
+                self.total_bytes -= self.index.pop(filename, 0)
+                self.index[filename] = len(audio)
+                self.total_bytes += len(audio)
+                while self.total_bytes > self.max_bytes and len(self.index) > 1:
+                    oldest, size = self.index.popitem(last=False)
+                    self.total_bytes -= size
+                    (self.cache_dir / oldest).unlink(missing_ok=True)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(path)
+            return path
+        finally:
+            with self.lock:
+                self.pending.pop(filename, None)
+
+    async def synthesize_bytes(self, text, voice=DEFAULT_VOICE, rate=DEFAULT_RATE, volume=DEFAULT_VOLUME) -> bytes:
+        path = await self.synthesize(text, voice, rate, volume)
+        try:
+            return path.read_bytes()
+        except FileNotFoundError:
+            # 返回路径之后、读取之前被淘汰，重新合成
+            return (await self.synthesize(text, voice, rate, volume)).read_bytes()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "items": len(self.index),
+                "bytes": self.total_bytes,
+            }
+
+
+_tts_cache: Optional[TTSCache] = None
+
+
+def get_tts_cache() -> TTSCache:
+    """
+    按settings.cache创建进程内共享的tts缓存
+    """
+    global _tts_cache
+    if _tts_cache is None:
+        _tts_cache = TTSCache(
+            settings.cache.tts_dir,
+            max_bytes=settings.cache.tts_disk_bytes,
+            provider=TTS_PROVIDERS[settings.cache.tts_provider](),
+        )
+    return _tts_cache
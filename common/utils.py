@@ -2,14 +2,14 @@ import os
 import time
 import shutil
 import subprocess
-from uuid import uuid4
 from functools import partial
 from concurrent.futures import ThreadPoolExecutor
 
 import cv2
-import edge_tts
 from tqdm import tqdm
 
+from common.tts import DEFAULT_VOICE, get_tts_cache
+
 
 def timeit(func):
     def inner(*args, **kwargs):
@@ -89,8 +89,15 @@ def read_images(img_list, grayscale=False, to_rgb=True):
     return frames
 
 
-async def tts(message, voice="zh-CN-XiaoxiaoNeural"):
-    voice = edge_tts.Communicate(text=message, voice=voice, rate='-4%', volume='+0%')
-    dst_file = f"tmp/{uuid4().hex}.wav"
-    await voice.save(dst_file)
-    return dst_file
+async def tts(message, voice=DEFAULT_VOICE):
+    """
+    合成语音并返回音频文件路径，相同的内容直接返回缓存的文件
+    """
+    return str(await get_tts_cache().synthesize(message, voice))
+
+
+async def tts_bytes(message, voice=DEFAULT_VOICE):
+    """
+    与tts相同，但直接返回音频的bytes
+    """
+    return await get_tts_cache().synthesize_bytes(message, voice)
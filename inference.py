@@ -49,7 +49,7 @@ if __name__ == "__main__":
         data_preparation = inference_config[avatar_id]["preparation"]
         video_path = inference_config[avatar_id]["video_path"]
         bbox_shift = inference_config[avatar_id]["bbox_shift"]
-        avatar = Avatar(str(avatar_id), video_path, bbox_shift, device)
+        avatar = Avatar(str(avatar_id), video_path, bbox_shift, device, streaming=False)
         audio_clips = inference_config[avatar_id]["audio_clips"]
         for audio_num, audio_path in audio_clips.items():
             print("Inferring using:", audio_path)
@@ -1,12 +1,51 @@
-from typing import Union, Iterable
+import io
+from pathlib import Path
+from typing import Callable, Union, Iterable, List, Optional
 
 import torch
+import soundfile
+import torchaudio
 import numpy as np
 from torch import nn, Tensor
 import torch.nn.functional as F
-from whisper.audio import N_FRAMES, log_mel_spectrogram, pad_or_trim, HOP_LENGTH
+from whisper.audio import (
+    N_FRAMES, N_FFT, SAMPLE_RATE, HOP_LENGTH, log_mel_spectrogram, mel_filters, pad_or_trim,
+    load_audio as ffmpeg_load_audio
+)
 from whisper.model import Conv1d, ResidualAttentionBlock, LayerNorm, sinusoids
 
+from musetalk.audio.feature_cache import audio_digest
+from musetalk.models.backends import LOSSY_BACKENDS
+
+# 变长模式下mel帧数向上取整的倍数(100帧即1秒)，保证conv2的stride为2时token数为整数，同时减少不同的输入形状
+VARIABLE_LENGTH_MULTIPLE = 100
+
+
+def load_audio(audio: Union[str, Path, bytes, np.ndarray, torch.Tensor], sample_rate=SAMPLE_RATE) -> torch.Tensor:
+    """
+    在进程内解码并重采样音频，不写临时文件，也不为每个请求启动ffmpeg子进程
+    audio: 文件路径、编码后的音频bytes(wav/mp3/flac/ogg等)，或已经是16kHz单声道的PCM(float32或int16)
+    return: 单声道float32波形
+    """
+    if isinstance(audio, torch.Tensor):
+        audio = audio.cpu().numpy()
+    if isinstance(audio, np.ndarray):
+        if audio.dtype == np.int16:
+            audio = audio.astype(np.float32) / 32768.0
+        return torch.from_numpy(audio.astype(np.float32, copy=False).reshape(-1))
+    if isinstance(audio, (str, Path)):
+        try:
+            data, sr = soundfile.read(str(audio), dtype='float32', always_2d=True)
+        except soundfile.LibsndfileError:
+            # libsndfile不支持的容器(如mp4)仍交给ffmpeg解码
+            return torch.from_numpy(ffmpeg_load_audio(str(audio), sample_rate))
+    else:
+        data, sr = soundfile.read(io.BytesIO(audio), dtype='float32', always_2d=True)
+    waveform = torch.from_numpy(data.mean(axis=1))
+    if sr != sample_rate:
+        waveform = torchaudio.functional.resample(waveform, sr, sample_rate)
+    return waveform
+
 
 class AudioEncoder(nn.Module):
     def __init__(
@@ -22,25 +61,32 @@ class AudioEncoder(nn.Module):
         )
         self.ln_post = LayerNorm(n_state)
 
-    def forward(self, x: Tensor, include_embeddings: bool = True):
+    def forward(self, x: Tensor, include_embeddings: bool = True, embeddings_dtype: Optional[torch.dtype] = None):
         """
         x : torch.Tensor, shape = (batch_size, n_mels, n_ctx)
             the mel spectrogram of the audio
+        embeddings_dtype: 各层embedding的输出精度，默认与x一致，可传入torch.float16减少显存和传输
         """
         x = F.gelu(self.conv1(x))
         x = F.gelu(self.conv2(x))
         x = x.permute(0, 2, 1)
 
-        assert x.shape[1:] == self.positional_embedding.shape, "incorrect audio shape"
-        x = (x + self.positional_embedding).to(x.dtype)
+        # 允许短于30秒的输入(变长模式)，此时只取对应长度的位置编码
+        n_ctx, n_state = self.positional_embedding.shape
+        assert x.shape[1] <= n_ctx and x.shape[2] == n_state, "incorrect audio shape"
+        x = (x + self.positional_embedding[:x.shape[1]]).to(x.dtype)
 
         if include_embeddings:
-            embeddings = [x.cpu().detach().numpy()]
+            # embeddings保留在x所在的设备上，由调用方决定是否以及何时拷贝到cpu
+            embeddings = [x]
             for block in self.blocks:
                 x = block(x)
-                embeddings.append(x.cpu().detach().numpy())
+                embeddings.append(x)
             x = self.ln_post(x)
-            return x, torch.Tensor(np.stack(embeddings, axis=1))
+            embeddings = torch.stack(embeddings, dim=1)
+            if embeddings_dtype is not None:
+                embeddings = embeddings.to(embeddings_dtype)
+            return x, embeddings
         else:
             for block in self.blocks:
                 x = block(x)
@@ -50,9 +96,22 @@ class AudioEncoder(nn.Module):
 
 class AudioFeatureExtractor:
 
-    def __init__(self, model_path, device, dtype):
+    def __init__(self, model_path, device, dtype, max_batch_size=4, variable_length=False):
+        """
+        max_batch_size: 单次送入encoder的30秒片段数上限，用于限制长音频编码时的显存占用
+        variable_length: 最后一个不足30秒的片段不再补零到30秒，而是裁剪到实际长度(向上取整到VARIABLE_LENGTH_MULTIPLE)，
+                         短句的编码耗时大幅减少，但由于encoder的注意力是全局的，结果与补零编码存在细微差异
+        """
         self.device = device
         self.dtype = dtype
+        self.max_batch_size = max_batch_size
+        self.variable_length = variable_length
+        self.sample_rate = SAMPLE_RATE
+        self.model_path = model_path
+        self._model_checksum = None
+        # 为None时直接调用self.encoder，否则为set_encoder设置的编译或导出的encoder
+        self.backend = 'eager'
+        self.run_encoder: Optional[Callable[[torch.Tensor], torch.Tensor]] = None
         # 加载whisper的audio encoder
         state_dict = torch.load(model_path)
         dims = state_dict['dims']
@@ -71,58 +130,322 @@ class AudioFeatureExtractor:
         )
         self.encoder.load_state_dict(encoder_state_dict)
         self.encoder = self.encoder.to(device)
+        self.n_mels = dims['n_mels']
+
+    @property
+    def model_checksum(self) -> str:
+        """
+        模型文件的sha256，用作特征缓存键的一部分，模型更新后旧的缓存自动失效
+        """
+        if self._model_checksum is None:
+            checksum = audio_digest(self.model_path)
+            # 导出或量化的后端结果与eager存在细微差异，缓存分开保存；compiled与eager结果相同，共用缓存
+            lossy = self.backend in LOSSY_BACKENDS
+            self._model_checksum = f'{checksum}:{self.backend}' if lossy else checksum
+        return self._model_checksum
+
+    def set_encoder(self, run_encoder: Optional[Callable[[torch.Tensor], torch.Tensor]], backend: str):
+        """
+        run_encoder: 输入mel(n * n_mels * n_frames)，输出各层embedding(n * n_layers * n_tokens * n_state)，
+                     为None时恢复为self.encoder(使用导出模型的Avatar会释放self.encoder，之后不能再恢复)
+        backend: 后端名称，计入model_checksum
+        """
+        self.run_encoder = run_encoder
+        self.backend = backend
+        self._model_checksum = None
+
+    @torch.no_grad()
+    def encode(self, mel: torch.Tensor, variable_length: Optional[bool] = None) -> torch.Tensor:
+        """
+        编码任意长度的mel，按30秒切分，最后一段不足部分补零，各片段按max_batch_size分批送入encoder
+        mel: n_mels * n_frames
+        variable_length: 为None时使用self.variable_length
+        return: n_tokens * 5 * 384, 每个token对应5层的embedding
+        """
+        if variable_length is None:
+            variable_length = self.variable_length
+        n_frames = max(mel.shape[-1], 1)
+        # 变长模式下只有完整的30秒片段参与批量编码
+        full_frames = n_frames // N_FRAMES * N_FRAMES if variable_length else n_frames
+        segments = [
+            pad_or_trim(mel[:, start_idx: start_idx + N_FRAMES], N_FRAMES)
+            for start_idx in range(0, full_frames, N_FRAMES)
+        ]
+        features = []
+        if segments:
+            segments = torch.stack(segments)
+            for batch_idx in range(0, segments.shape[0], self.max_batch_size):
+                batch = segments[batch_idx: batch_idx + self.max_batch_size]
+                features.append(self._encode_batch(batch))
+        if n_frames > full_frames:
+            # 最后一段只补零到VARIABLE_LENGTH_MULTIPLE的整数倍
+            length = -(-(n_frames - full_frames) // VARIABLE_LENGTH_MULTIPLE) * VARIABLE_LENGTH_MULTIPLE
+            segment = pad_or_trim(mel[:, full_frames:], min(length, N_FRAMES))
+            features.append(self._encode_batch(segment.unsqueeze(0)))
+        return torch.cat(features, dim=0)
+
+    def _encode_batch(self, batch: torch.Tensor) -> torch.Tensor:
+        # embeddings的形状为n*5*1500*384,(n batch_size, 5 layers, 1500~30second, 384 embedding dim)
+        # 单帧图像对应的音频特征为1 * 5 * 2 * 384
+        batch = batch.to(self.device, dtype=self.dtype)
+        if self.run_encoder is not None:
+            embeddings = self.run_encoder(batch)
+        else:
+            _, embeddings = self.encoder(batch)
+        embeddings = embeddings.permute(0, 2, 1, 3)
+        return embeddings.reshape(-1, *embeddings.shape[2:])
+
+    def create_stream(self, audio_window=2, lookahead: Optional[int] = 5) -> "AudioFeatureStream":
+        return AudioFeatureStream(self, audio_window=audio_window, lookahead=lookahead)
+
+    def extract_features_stream(self, pcm_chunks: Iterable[np.ndarray], audio_window=2, lookahead: Optional[int] = 5):
+        """
+        以生成器的方式处理不断到达的PCM片段，每凑够上下文就产出一帧特征
+        """
+        stream = self.create_stream(audio_window, lookahead)
+        for chunk in pcm_chunks:
+            yield from stream.push(chunk)
+        yield from stream.flush()
 
     @torch.no_grad()
     def extract_features(
             self,
-            audio: Union[str, np.ndarray, torch.Tensor],
-            audio_window=2
+            audio: Union[str, Path, bytes, np.ndarray, torch.Tensor],
+            audio_window=2,
+            on_device=False,
+            variable_length: Optional[bool] = None,
+            return_tensor=True,
     ):
-        mel = log_mel_spectrogram(audio)
+        """
+        audio: 文件路径、编码后的音频bytes或16kHz单声道PCM，均在进程内解码
+        variable_length: 是否使用变长编码，为None时使用self.variable_length
+        return_tensor: 为False时返回numpy数组，与AudioFrameExtractor.extract_features的参数一致
+        on_device: 为True时特征保留在self.device上(精度为self.dtype)，可直接送入unet；
+                   否则在最后一次性拷贝回cpu并转换为float32
+        """
+        mel = log_mel_spectrogram(load_audio(audio))
         # 计算当sample_rate为16000时，对应的25fps的视频的总帧数
         frame_count = mel.shape[1] // 4
-        features = []
-        for start_idx in range(0, mel.shape[-1], N_FRAMES):
-            mel_chunk = mel[:, start_idx: start_idx + 3000]
-            segment = pad_or_trim(mel_chunk, N_FRAMES).to(self.device, dtype=self.dtype)
-            single = segment.ndim == 2
-            if single:
-                segment = segment.unsqueeze(0)
-            # embeddings的形状为n*5*1500*384,(n batch_size, 5 layers, 1500~30second, 384 embedding dim)
-            # 单帧图像对应的音频特征为1 * 5 * 2 * 384
-            _, embeddings = self.encoder(segment)
-            features.append(embeddings.permute(0, 2, 1, 3))
-        features = torch.cat(features, dim=1)
-
-        hidden_dim = ((audio_window * 2) + 1) * 2 * 5
-        audio_frame_features = torch.zeros((
-            frame_count,
-            hidden_dim,
-            384
-        ))
-        for audio_idx in range(frame_count):
-            start_idx = max(0, (audio_idx - audio_window) * 2)
-            end_idx = min(frame_count * 2, (audio_idx + audio_window + 1) * 2)
-            audio_frame_feature = features[0, start_idx:end_idx, :, :].reshape(1, -1, 384)
+        # 所有30秒片段批量编码，features形状为n_tokens * 5 * 384
+        features = self.encode(mel, variable_length)
+        audio_frame_features = self.assemble_windows(features, frame_count, audio_window)
+        if on_device:
+            return audio_frame_features
+        audio_frame_features = audio_frame_features.float().cpu()
+        return audio_frame_features if return_tensor else audio_frame_features.numpy()
+
+    @torch.no_grad()
+    def variable_length_parity(self, audio, audio_window=2) -> dict:
+        """
+        比较变长编码与补零编码得到的每帧窗口特征
+        return: 最大绝对误差、相对于特征幅度的最大误差，以及逐帧余弦相似度的最小值
+        """
+        padded = self.extract_features(audio, audio_window, variable_length=False)
+        trimmed = self.extract_features(audio, audio_window, variable_length=True)
+        diff = (trimmed - padded).abs()
+        return {
+            "frames": padded.shape[0],
+            "max_abs_error": diff.max().item(),
+            "max_rel_error": (diff.max() / padded.abs().max().clamp(min=1e-12)).item(),
+            "min_cosine": F.cosine_similarity(padded.flatten(1), trimmed.flatten(1)).min().item(),
+        }
+
+    @staticmethod
+    def assemble_windows(features: torch.Tensor, frame_count: int, audio_window=2) -> torch.Tensor:
+        """
+        将token特征组装为每一帧的音频窗口特征，首尾不足的部分补零
+        features: n_tokens * n_layers * 384
+        return: frame_count * (((audio_window * 2) + 1) * 2 * n_layers) * 384
+        """
+        _, n_layers, embedding_dim = features.shape
+        hidden_dim = ((audio_window * 2) + 1) * 2 * n_layers
+        if frame_count == 0:
+            return features.new_zeros((0, hidden_dim, embedding_dim))
+        # 两侧各补audio_window帧(每帧2个token)的零，之后第i帧的窗口即padded[2i: 2i + window_size]
+        padding = audio_window * 2
+        padded = F.pad(features[:frame_count * 2], (0, 0, 0, 0, padding, padding))
+        windows = padded.unfold(0, (audio_window * 2 + 1) * 2, 2)
+        # unfold的窗口维在最后，调整为frame_count * window_size * n_layers * 384后展平
+        return windows.permute(0, 3, 1, 2).reshape(frame_count, hidden_dim, embedding_dim)
+
 
+class AudioFeatureStream:
+    """
+    流式音频特征提取, 不断push 16kHz单声道PCM片段，当某一帧左右audio_window的上下文都具备时立即产出该帧的特征。
+
+    - mel在片段边界处保留n_fft的重叠，与离线log_mel_spectrogram逐帧一致
+    - 离线的动态范围下限(最大值 - 8)取自整段音频，流式提交时只能使用截至当前的最大值，
+      之后出现更响的峰值时，已提交的特征与离线结果不同
+    - 编码按照离线相同的30秒切分，未满30秒的片段补零编码，token在右侧具备lookahead帧上下文后提交
+    - lookahead为None时所有token推迟到flush时以整段音频的最大值编码，结果与离线extract_features一致，
+      但要等音频结束才产出特征
+    """
+
+    def __init__(self, extractor, audio_window=2, lookahead: Optional[int] = 5):
+        """
+        extractor: AudioFeatureExtractor或AudioFrameExtractor，需提供n_mels和encode(mel)
+        """
+        self.extractor = extractor
+        self.audio_window = audio_window
+        self.lookahead = lookahead
+        self.window = torch.hann_window(N_FFT)
+        self.filters = mel_filters(torch.device('cpu'), extractor.n_mels)
+        # 左侧已做reflect填充的采样点，以及padded[0]在填充坐标系中的位置
+        self.padded: Optional[torch.Tensor] = None
+        self.padded_offset = 0
+        self.pending = np.zeros(0, dtype=np.float32)
+        self.num_samples = 0
+        # 当前30秒片段内未归一化的log10 mel，以及全局已计算的mel帧数
+        self.chunk_mel: List[torch.Tensor] = []
+        self.chunk_mel_frames = 0
+        self.mel_frames = 0
+        self.mel_max = None
+        # 已提交的token，形状为n_tokens * n_layers * 384，tokens[0]对应全局的第tokens_offset个token
+        self.tokens: Optional[torch.Tensor] = None
+        self.tokens_offset = 0
+        self.chunk_tokens_offset = 0
+        self.committed = 0
+        self.next_frame = 0
+        self.finished = False
+
+    @staticmethod
+    def to_float_pcm(pcm: Union[np.ndarray, torch.Tensor]) -> np.ndarray:
+        if isinstance(pcm, torch.Tensor):
+            pcm = pcm.cpu().numpy()
+        if pcm.dtype == np.int16:
+            return pcm.astype(np.float32) / 32768.0
+        return pcm.astype(np.float32, copy=False)
+
+    def push(self, pcm: Union[np.ndarray, torch.Tensor]) -> List[torch.Tensor]:
+        """
+        pcm: 16kHz单声道，float32(-1~1)或int16
+        return: 新产出的帧特征列表，每帧形状为((audio_window * 2) + 1) * 2 * n_layers * 384
+        """
+        assert not self.finished, "stream is already flushed"
+        self.pending = np.concatenate([self.pending, self.to_float_pcm(pcm).reshape(-1)])
+        self._compute_mel(final=False)
+        self._encode(final=False)
+        return self._emit(final=False)
+
+    def flush(self) -> List[torch.Tensor]:
+        """
+        音频结束，尾部按离线方式补零并产出剩余的全部帧
+        """
+        if self.finished:
+            return []
+        self._compute_mel(final=True)
+        self._encode(final=True)
+        self.finished = True
+        return self._emit(final=True)
+
+    def _compute_mel(self, final):
+        pad = N_FFT // 2
+        if self.padded is None:
+            # 与torch.stft(center=True)一致，开头使用reflect填充
+            if self.pending.shape[0] <= pad:
+                return
+            samples = torch.from_numpy(self.pending)
+            self.padded = torch.cat([samples[1:pad + 1].flip(0), samples])
+            self.num_samples = samples.shape[0]
+        elif self.pending.shape[0]:
+            self.padded = torch.cat([self.padded, torch.from_numpy(self.pending)])
+            self.num_samples += self.pending.shape[0]
+        self.pending = np.zeros(0, dtype=np.float32)
+
+        if final:
+            # whisper丢弃了stft的最后一帧，因此总帧数为num_samples // HOP_LENGTH
+            tail = self.padded[-pad - 1:-1].flip(0)
+            self.padded = torch.cat([self.padded, tail])
+            stop = self.num_samples // HOP_LENGTH
+        else:
+            total = self.padded_offset + self.padded.shape[0]
+            stop = (total - N_FFT) // HOP_LENGTH + 1 if total >= N_FFT else 0
+        start = self.mel_frames
+        if stop <= start:
+            return
+        segment = self.padded[start * HOP_LENGTH - self.padded_offset: (stop - 1) * HOP_LENGTH + N_FFT - self.padded_offset]
+        stft = torch.stft(segment, N_FFT, HOP_LENGTH, window=self.window, center=False, return_complex=True)
+        mel_spec = self.filters @ stft.abs() ** 2
+        log_spec = torch.clamp(mel_spec, min=1e-10).log10()
+        self.mel_max = log_spec.max() if self.mel_max is None else torch.maximum(self.mel_max, log_spec.max())
+        self.chunk_mel.append(log_spec)
+        self.chunk_mel_frames += log_spec.shape[1]
+        self.mel_frames = stop
+        # 丢弃之后不再需要的采样点
+        drop = stop * HOP_LENGTH - self.padded_offset
+        self.padded = self.padded[drop:]
+        self.padded_offset += drop
+
+    def _normalized_chunk_mel(self, frames):
+        self.chunk_mel = [torch.cat(self.chunk_mel, dim=1)]
+        log_spec = self.chunk_mel[0][:, :frames]
+        log_spec = torch.maximum(log_spec, self.mel_max - 8.0)
+        return (log_spec + 4.0) / 4.0
+
+    def _commit(self, embeddings, count):
+        # embeddings为当前30秒片段的token，提交其中尚未提交的前count个
+        start = self.committed - self.chunk_tokens_offset
+        if count <= start:
+            return
+        new_tokens = embeddings[start:count].float().cpu()
+        self.tokens = new_tokens if self.tokens is None else torch.cat([self.tokens, new_tokens], dim=0)
+        self.committed = self.chunk_tokens_offset + count
+
+    def _encode(self, final):
+        if self.lookahead is None and not final:
+            # 归一化依赖整段音频的最大值，全部推迟到flush
+            return
+        # 已满30秒的片段直接完整编码并全部提交
+        while self.chunk_mel_frames >= N_FRAMES:
+            mel = self._normalized_chunk_mel(N_FRAMES)
+            self._commit(self.extractor.encode(mel), N_FRAMES // 2)
+            rest = torch.cat(self.chunk_mel, dim=1)[:, N_FRAMES:]
+            self.chunk_mel = [rest] if rest.shape[1] else []
+            self.chunk_mel_frames = rest.shape[1]
+            self.chunk_tokens_offset += N_FRAMES // 2
+        if self.chunk_mel_frames == 0:
+            return
+        if final:
+            count = self.chunk_mel_frames // 2
+        else:
+            # 只提交完整视频帧对应的token
+            count = (self.chunk_mel_frames // 4 - self.lookahead) * 2
+            if count <= self.committed - self.chunk_tokens_offset:
+                return
+        mel = self._normalized_chunk_mel(self.chunk_mel_frames)
+        self._commit(self.extractor.encode(mel), count)
+
+    def _emit(self, final) -> List[torch.Tensor]:
+        frames = []
+        if self.tokens is None:
+            return frames
+        frame_count = self.mel_frames // 4
+        _, n_layers, embedding_dim = self.tokens.shape
+        while True:
+            idx = self.next_frame
+            start = (idx - self.audio_window) * 2
+            end = (idx + self.audio_window + 1) * 2
+            if final:
+                if idx >= frame_count:
+                    break
+                limit = frame_count * 2
+            else:
+                if end > self.committed:
+                    break
+                limit = end
+            tokens = self.tokens[max(0, start) - self.tokens_offset: min(end, limit) - self.tokens_offset]
+            feature = tokens.reshape(-1, embedding_dim)
             # 对开始帧和结束帧进行填充
-            if audio_frame_feature.shape[1] != hidden_dim:
-                padding_feature = torch.zeros((1, hidden_dim - audio_frame_feature.shape[1], 384))
-                if start_idx == 0:
-                    audio_frame_feature = torch.cat([padding_feature, audio_frame_feature], dim=1)
-                if end_idx == frame_count * 2:
-                    audio_frame_feature = torch.cat([audio_frame_feature, padding_feature], dim=1)
-            audio_frame_features[audio_idx] = audio_frame_feature
-        return audio_frame_features
-
-
-if __name__ == '__main__':
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    afe = AudioFeatureExtractor('../../models/whisper/tiny.pt', device=device, dtype=torch.float32)
-    fs = afe.extract_features('../../data/audio/zack.wav', audio_window=0)
-    print(fs.shape)
-    # audio = whisper.audio.load_audio('../../data/audio/222.wav')
-    # print(audio.shape)
-    # chunks = afe.extract_frames(audio)
-    # for chunk in chunks:
-    #     print(chunk.shape)
+            left = max(0, -start) * n_layers
+            right = max(0, end - limit) * n_layers
+            if left or right:
+                feature = F.pad(feature, (0, 0, left, right))
+            frames.append(feature)
+            self.next_frame += 1
+        # 丢弃之后的帧不再需要的token
+        drop = max(0, (self.next_frame - self.audio_window) * 2 - self.tokens_offset)
+        if drop:
+            self.tokens = self.tokens[drop:]
+            self.tokens_offset += drop
+        return frames
+
@@ -0,0 +1,159 @@
+import os
+import hashlib
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from typing import Union, Optional
+
+import torch
+import numpy as np
+
+
+def audio_digest(audio: Union[str, Path, bytes, np.ndarray, torch.Tensor]) -> str:
+    """
+    计算音频内容的sha256，文件按内容计算，与文件名和路径无关
+    """
+    sha = hashlib.sha256()
+    if isinstance(audio, (str, Path)):
+        with open(audio, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+    elif isinstance(audio, bytes):
+        sha.update(audio)
+    else:
+        if isinstance(audio, torch.Tensor):
+            audio = audio.cpu().numpy()
+        audio = np.ascontiguousarray(audio)
+        sha.update(f"{audio.dtype}{audio.shape}".encode())
+        sha.update(audio.tobytes())
+    return sha.hexdigest()
+
+
+class AudioFeatureCache:
+    """
+    以音频内容、模型校验和以及audio_window为键的音频特征缓存
+
+    - 内存层: LRU，最多保存memory_items条
+    - 磁盘层: 以dtype(默认fp16)的.npy保存，读取时直接使用内存映射(写时复制)，不读入整个文件，
+              总大小超过max_disk_bytes时按最近使用时间淘汰
+
+    dtype: 存储精度，训练数据的预处理等不接受精度损失的场景使用torch.float32
+    """
+
+    def __init__(
+            self, cache_dir: Union[str, Path], memory_items=64, max_disk_bytes=2 << 30, dtype=torch.float16,
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.memory_items = memory_items
+        self.max_disk_bytes = max_disk_bytes
+        self.dtype = dtype
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        # 磁盘上的缓存文件及其大小，按最近使用时间从旧到新排列
+        files = sorted(self.cache_dir.glob('*.npy'), key=lambda file: file.stat().st_mtime)
+        self.disk_index = OrderedDict((file.stem, file.stat().st_size) for file in files)
+        self.disk_bytes = sum(self.disk_index.values())
+
+    @staticmethod
+    def make_key(
+            digest: str, model_checksum: str, audio_window: int, variable_length=False, dtype=torch.float16,
+    ) -> str:
+        key = f"{digest}:{model_checksum}:{audio_window}:{int(variable_length)}"
+        if dtype != torch.float16:
+            # fp16的键保持不变，已有的缓存仍然有效
+            key += f":{str(dtype).replace('torch.', '')}"
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[torch.Tensor]:
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return self.memory[key]
+            path = self.cache_dir / f'{key}.npy'
+            try:
+                # 写时复制的映射可以直接转为tensor，按需从page cache读取；文件被替换或淘汰后映射仍然有效
+                features = torch.from_numpy(np.load(path, mmap_mode='c'))
+                os.utime(path)
+            except (OSError, ValueError):
+                # 不存在、已被其它进程淘汰或文件不完整
+                self._remove_disk(key)
+                self.misses += 1
+                return None
+            if key not in self.disk_index:
+                # 由其它进程写入的缓存
+                self.disk_index[key] = path.stat().st_size
+                self.disk_bytes += self.disk_index[key]
+            self.disk_index.move_to_end(key)
+            self.disk_hits += 1
+            self._put_memory(key, features)
+            return features
+
+    def put(self, key: str, features: torch.Tensor) -> torch.Tensor:
+        """
+        保存特征，返回实际缓存的cpu特征(存储精度)
+        """
+        features = features.detach().to('cpu', dtype=self.dtype).contiguous()
+        with self.lock:
+            self._put_memory(key, features)
+        path = self.cache_dir / f'{key}.npy'
+        # 写文件不持有锁，不阻塞其它请求的读取；先写临时文件再替换，避免并发读取到不完整的文件
+        tmp_path = self.cache_dir / f'{key}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, features.numpy())
+        os.replace(tmp_path, path)
+        with self.lock:
+            self._remove_disk(key, unlink=False)
+            self.disk_index[key] = path.stat().st_size
+            self.disk_bytes += self.disk_index[key]
+            while self.disk_bytes > self.max_disk_bytes and len(self.disk_index) > 1:
+                self._remove_disk(next(iter(self.disk_index)))
+        return features
+
+    def get_or_compute(self, extractor, audio, audio_window=2, on_device=False, variable_length=None):
+        """
+        缓存版的extractor.extract_features，命中时返回的特征经过存储精度(默认fp16)，未命中时为extractor的原始精度
+        """
+        if variable_length is None:
+            variable_length = extractor.variable_length
+        key = self.make_key(audio_digest(audio), extractor.model_checksum, audio_window, variable_length, self.dtype)
+        features = self.get(key)
+        if features is None:
+            # AudioFrameExtractor的第二个位置参数是return_tensor，以关键字传入
+            features = extractor.extract_features(
+                audio, audio_window=audio_window, on_device=on_device, variable_length=variable_length,
+                return_tensor=True,
+            )
+            self.put(key, features)
+            return features
+        if on_device:
+            return features.to(extractor.device, dtype=extractor.dtype)
+        return features.float()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_items": len(self.memory),
+                "disk_items": len(self.disk_index),
+                "disk_bytes": self.disk_bytes,
+            }
+
+    def _put_memory(self, key, features):
+        self.memory[key] = features
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    def _remove_disk(self, key, unlink=True):
+        size = self.disk_index.pop(key, None)
+        if size is not None:
+            self.disk_bytes -= size
+        if unlink:
+            (self.cache_dir / f'{key}.npy').unlink(missing_ok=True)
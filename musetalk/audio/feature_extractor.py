@@ -1,45 +1,110 @@
-import math
+import hashlib
+from pathlib import Path
+from typing import Iterable, Optional
 
 import torch
-import librosa
 import numpy as np
+from whisper.audio import N_FRAMES, N_SAMPLES, SAMPLE_RATE
 from transformers import WhisperProcessor, WhisperModel
 
+from musetalk.audio.feature_cache import audio_digest
+from musetalk.audio.audio_feature_extract import AudioFeatureExtractor, AudioFeatureStream, load_audio
+
 
 class AudioFrameExtractor:
-    def __init__(self, model_name_or_path, device='cuda', dtype=torch.float16):
+    """
+    使用transformers格式(如微调后的whisper-tiny-zh)的whisper encoder提取音频特征，
+    与AudioFeatureExtractor提供相同的批量与流式接口，每个token只保留最后一层的输出
+    """
+
+    def __init__(self, model_name_or_path, device='cuda', dtype=torch.float16, max_batch_size=4):
         super().__init__()
         self.device = device
         self.dtype = dtype
-        self.sample_rate = 16000
+        self.max_batch_size = max_batch_size
+        # transformers的encoder要求输入固定为3000帧，不支持变长编码
+        self.variable_length = False
+        self.sample_rate = SAMPLE_RATE
         self.video_fps = 25
+        self.model_name_or_path = model_name_or_path
+        self._model_checksum = None
         self.processor = WhisperProcessor.from_pretrained(model_name_or_path)
         self.model = WhisperModel.from_pretrained(model_name_or_path).to(device, dtype=dtype)
+        self.n_mels = self.model.config.num_mel_bins
         self.audio_fps = self.sample_rate // self.video_fps
 
+    @property
+    def model_checksum(self) -> str:
+        if self._model_checksum is None:
+            path = Path(self.model_name_or_path)
+            if path.is_dir():
+                sha = hashlib.sha256()
+                for file in sorted(path.rglob('*')):
+                    if file.is_file():
+                        sha.update(f"{file.relative_to(path)}:{audio_digest(file)}".encode())
+                self._model_checksum = sha.hexdigest()
+            else:
+                self._model_checksum = hashlib.sha256(str(self.model_name_or_path).encode()).hexdigest()
+        return self._model_checksum
+
+    @torch.no_grad()
+    def encode(self, mel: torch.Tensor, variable_length: Optional[bool] = None) -> torch.Tensor:
+        """
+        编码任意长度的已归一化mel(与whisper.audio.log_mel_spectrogram一致)，按30秒切分后分批送入encoder
+        mel: n_mels * n_frames
+        return: n_tokens * 1 * 384
+        """
+        segments = []
+        for start_idx in range(0, max(mel.shape[-1], 1), N_FRAMES):
+            segment = mel[:, start_idx: start_idx + N_FRAMES]
+            # WhisperFeatureExtractor先对波形补零再计算mel，补零部分的mel被截断到该片段的最大值-8(归一化后为max-2)
+            padding_value = segment.max() - 2.0 if segment.numel() else 0.0
+            padded = torch.full((mel.shape[0], N_FRAMES), float(padding_value), dtype=mel.dtype)
+            padded[:, :segment.shape[-1]] = segment
+            segments.append(padded)
+        return self._encode_batches(torch.stack(segments))
+
+    def _encode_batches(self, input_features: torch.Tensor) -> torch.Tensor:
+        features = []
+        for batch_idx in range(0, input_features.shape[0], self.max_batch_size):
+            batch = input_features[batch_idx: batch_idx + self.max_batch_size].to(self.device, dtype=self.dtype)
+            # last_hidden_state形状为n × 1500 × 384，展平为(n * 1500) × 1 × 384
+            hidden_states = self.model.encoder(batch).last_hidden_state
+            features.append(hidden_states.reshape(-1, 1, hidden_states.shape[-1]))
+        return torch.cat(features, dim=0)
+
+    def create_stream(self, audio_window=0, lookahead: Optional[int] = 5) -> AudioFeatureStream:
+        return AudioFeatureStream(self, audio_window=audio_window, lookahead=lookahead)
+
+    def extract_features_stream(self, pcm_chunks: Iterable[np.ndarray], audio_window=0, lookahead: Optional[int] = 5):
+        stream = self.create_stream(audio_window, lookahead)
+        for chunk in pcm_chunks:
+            yield from stream.push(chunk)
+        yield from stream.flush()
+
     @torch.no_grad()
-    def extract_features(self, audio_path, return_tensor=False):
-        audio, sr = librosa.load(audio_path, sr=self.sample_rate)
+    def extract_features(
+            self, audio, return_tensor=False, audio_window=0, on_device=False, variable_length: Optional[bool] = None,
+    ):
+        """
+        audio: 文件路径、编码后的音频bytes或16kHz单声道PCM，时长不限
+        return_tensor: 为False时返回numpy数组，为True时返回cpu上的torch.Tensor；on_device为True时总是返回Tensor
+        return: audio_window为0时形状为frames * 2 * 384
+        """
+        audio = load_audio(audio, self.sample_rate).numpy()
         # 计算视频总帧数
-        frames = min(math.floor(audio.shape[-1] / self.audio_fps), self.video_fps * 30)
+        frames = audio.shape[-1] // self.audio_fps
+        # 按30秒切分后一次性交给processor，得到n × 80 × 3000的输入
+        chunks = [audio[start_idx: start_idx + N_SAMPLES] for start_idx in range(0, max(audio.shape[-1], 1), N_SAMPLES)]
         input_features = self.processor(
-            audio, sampling_rate=sr, return_tensors='pt'
-        ).input_features.to(self.device, dtype=self.dtype)
-        if return_tensor:
-            segments = torch.zeros((frames, 2, 384))
-        else:
-            segments = np.zeros((frames, 2, 384))
-        encoder_outputs = self.model.encoder(input_features)
-        # audio_features形状为n × 1500 × 384
-        audio_features = encoder_outputs.last_hidden_state
-        for i in range(frames):
-            start = i * 2
-            end = start + 2
-            if return_tensor:
-                segments[i, :, :] = audio_features[0, start:end, :].cpu()
-            else:
-                segments[i, :, :] = audio_features[0, start:end, :].cpu().numpy()
-        return segments
+            chunks, sampling_rate=self.sample_rate, return_tensors='pt'
+        ).input_features
+        features = self._encode_batches(input_features)
+        segments = AudioFeatureExtractor.assemble_windows(features, frames, audio_window)
+        if on_device:
+            return segments
+        segments = segments.float().cpu()
+        return segments if return_tensor else segments.numpy()
 
 
 if __name__ == '__main__':
@@ -1,36 +1,46 @@
 import sys
+import time
 import shutil
 import asyncio
-from queue import Queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Optional
+from typing import Any, Callable, Optional, Union
 
 import cv2
 import torch
 import numpy as np
 from tqdm import tqdm
-from PIL import Image
 from diffusers import AutoencoderKL
 
 sys.path.append('.')
 from common.setting import settings
 from musetalk.processors import ImageProcessor
-from common.utils import video2images, read_images, tts
-from musetalk.faces.face_analysis import FaceAnalyst
+from common.text import speakable_sentences
+from common.tts import DEFAULT_VOICE
+from common.utils import video2images, read_images, tts_bytes
+from musetalk.serving.metrics import stage, TIME_TO_FIRST_FRAME
+from musetalk.serving.profiling import PROFILER
+from musetalk.serving.playout import PlayoutFrame, FrameRingBuffer, PlayoutEngine
 from musetalk.utils import datagen, images2video, merge_audio_video
 from musetalk.models.musetalk import MuseTalkModel, PositionalEncoding
-from musetalk.audio.audio_feature_extract import AudioFeatureExtractor
+from musetalk.models.backends import (
+    ARTIFACT_BACKENDS, UNetModule, VaeDecoderModule, AudioEncoderModule, load_backend
+)
+from musetalk.audio.feature_cache import AudioFeatureCache
+from musetalk.audio.audio_feature_extract import AudioFeatureExtractor, load_audio
 
 
 @torch.no_grad()
 class Avatar:
     def __init__(
             self, avatar_id: str, video_path: str, bbox_shift_size: int = 5, device: Any = 'cuda',
-            dtype=torch.float16
+            dtype=torch.float16, streaming: bool = True
     ):
         """
         avatar_id: avatar的唯一标识
         video_path: 视频路径
+        streaming: 是否将推理结果送入播放缓冲，离线生成时设为False，否则缓冲满后推理会被阻塞
         """
         self.idx = 0
         self.avatar_id = avatar_id
@@ -41,11 +51,19 @@ class Avatar:
         self.vae = AutoencoderKL.from_pretrained(
             settings.models.vae_path, use_safetensors=False
         ).to(device, dtype=dtype)
-        self.afe = AudioFeatureExtractor(settings.models.whisper_path, device, dtype)
+        self.afe = AudioFeatureExtractor(
+            settings.models.whisper_path, device, dtype, variable_length=settings.serving.variable_length_audio
+        )
+        self.feature_cache = AudioFeatureCache(
+            settings.cache.audio_feature_dir,
+            memory_items=settings.cache.audio_feature_memory_items,
+            max_disk_bytes=settings.cache.audio_feature_disk_bytes,
+        )
         self.image_processor = ImageProcessor()
         self.unet = MuseTalkModel(settings.models.unet_path).to(device, dtype=dtype)
         self.pe = PositionalEncoding().to(device, dtype=dtype)
         self.face_analyst = None
+        self.load_backends(settings.serving.backend)
 
         # 保存avatar相关文件的目录
         self.avatar_path = Path(settings.avatar.avatar_dir) / avatar_id
@@ -67,11 +85,60 @@ class Avatar:
         self.audio_window = 2
         self.face_location = None
         self.default_location = [0, 0, 0, 0]
-        self.inference_results = Queue()
+        self.streaming = streaming
+        # 推理线程写入、播放时钟读取的有界缓冲
+        self.frame_buffer = FrameRingBuffer(settings.serving.frame_buffer_size, settings.serving.overrun_policy)
+        self.playout = PlayoutEngine(
+            self.frame_buffer,
+            self.idle_frame,
+            self.on_played,
+            fps=settings.common.fps,
+            jitter_depth=settings.serving.jitter_buffer_depth,
+            underrun=settings.serving.underrun_policy,
+        )
+        # 下一帧推理结果在frame_cycle中的序号，每段语音开始时为None
+        self.render_idx = None
+        # 当前语音开始时播放缓冲的generation，缓冲被flush(打断)后该语音的帧不再进入缓冲
+        self.utterance_generation = None
+        # 当前语音是否已有帧进入播放缓冲，之前缓冲中只有上一段语音的帧，取消当前语音时不flush。
+        # 与取消标记一起由utterance_lock保护，取消与渲染线程放入第一帧之间不会交错
+        self.utterance_rendering = False
+        self.utterance_lock = threading.Lock()
+        # 渲染进度的回调，以是否正在渲染调用: 每个batch开始前为True，语音结束时为False。
+        # 多进程模式下写入共享内存的心跳，用于发现卡住的渲染(例如CUDA调用不返回)
+        self.on_render_progress: Optional[Callable[[bool], None]] = None
+        # 当前语音的请求到达时间和首帧回调，附加在该语音渲染出的第一帧上，随帧一起排队播放
+        self.requested_at = None
+        self.on_first_frame: Optional[Callable[[float], None]] = None
+        # GPU上的阶段需要同步后计时
+        self.synchronize = torch.cuda.synchronize if torch.device(device).type == 'cuda' else None
 
         # 初始化数字人需要的相关信息
         self.init_avatar()
 
+    def load_backends(self, backend: str):
+        """
+        按settings.serving.backend选择unet、vae decoder和audio encoder的执行方式，
+        vae的encoder只在预处理avatar时使用，始终为eager
+        """
+        options = dict(
+            backend=backend, export_dir=settings.models.export_dir, device=self.device,
+            threads=settings.serving.backend_threads,
+        )
+        self.run_unet = load_backend('unet', UNetModule(self.unet), **options)
+        self.run_vae_decoder = load_backend('vae_decoder', VaeDecoderModule(self.vae), **options)
+        if backend != 'eager':
+            run_encoder = load_backend('audio_encoder', AudioEncoderModule(self.afe.encoder), **options)
+            self.afe.set_encoder(run_encoder, backend)
+        if backend in ARTIFACT_BACKENDS:
+            # 导出的模型不再需要eager模块，释放以免模型内存翻倍；vae的encoder仍用于准备avatar
+            self.unet = None
+            self.vae.decoder = None
+            self.vae.post_quant_conv = None
+            self.afe.encoder = None
+            if torch.device(self.device).type == 'cuda':
+                torch.cuda.empty_cache()
+
     def init_avatar(self):
         if self.avatar_path.exists():
             if not self.validate_avatar():
@@ -85,7 +152,8 @@ class Avatar:
             mask_list = sorted(
                 list(self.full_masks_path.glob('*.[jpJP][pnPN]*[gG]'))
             )
-            frame_list = read_images([str(file) for file in frame_list])
+            # 帧以BGR保存，与jpeg和h264编码器的输入一致，播放和编码时不需要翻转通道
+            frame_list = read_images([str(file) for file in frame_list], to_rgb=False)
             mask_list = read_images([str(file) for file in mask_list], grayscale=True)
 
             self.frame_cycle = frame_list + frame_list[::-1]
@@ -127,6 +195,9 @@ class Avatar:
         return True
 
     def prepare_avatar(self):
+        # mmpose只在预处理新avatar时需要，延迟导入
+        from musetalk.faces.face_analysis import FaceAnalyst
+
         print("preparing avatar ...")
         self.face_analyst = FaceAnalyst(
             settings.models.dwpose_config_path, settings.models.dwpose_model_path
@@ -136,7 +207,7 @@ class Avatar:
         input_image_list = sorted(
             list(self.full_images_path.glob('*.[jpJP][pnPN]*[gG]'))
         )
-        frame_list = read_images([str(file) for file in input_image_list])
+        frame_list = read_images([str(file) for file in input_image_list], to_rgb=False)
         mask_list = []
         coord_list = []
         face_latent_list = []
@@ -156,7 +227,8 @@ class Avatar:
                 total=len(frame_list)
         ):
             x1, y1, x2, y2 = coord
-            face = frame[y1:y2, x1:x2, :]
+            # vae的输入为RGB
+            face = cv2.cvtColor(frame[y1:y2, x1:x2, :], cv2.COLOR_BGR2RGB)
             # 编码人物形象图片
             avatar_face = self.image_processor(face)[None].to(self.device, dtype=self.dtype)
             avatar_face_latent = self.vae.encode(avatar_face).latent_dist.sample()
@@ -180,39 +252,168 @@ class Avatar:
         del self.face_analyst
 
     @torch.no_grad()
-    def inference(self, audio_path: Optional[str], text: Optional[str], batch_size=4):
+    def inference(
+            self, audio: Union[str, bytes, np.ndarray, None], text: Optional[str] = None, batch_size=4,
+            cancel: Optional[threading.Event] = None, requested_at: Optional[float] = None,
+            on_first_frame: Optional[Callable[[float], None]] = None,
+    ) -> int:
+        """
+        audio: 音频文件路径、编码后的音频bytes或16kHz单声道PCM
+        text: 不为空时按句合成语音并流式渲染
+        cancel: 被set后在下一个batch前停止渲染
+        requested_at: 请求到达的时间(time.time())，用于统计首帧延迟，默认为调用时
+        on_first_frame: 第一帧语音播放时以播放时间(time.time())调用
+        return: 渲染的帧数
+        """
         if text:
-            audio_path = asyncio.run(tts(text))
+            return self.inference_text(
+                text, batch_size, cancel=cancel, requested_at=requested_at, on_first_frame=on_first_frame
+            )
+        self.begin_utterance(requested_at, on_first_frame)
+        try:
+            return self.render(audio, batch_size, cancel)
+        finally:
+            self.end_utterance()
+
+    @torch.no_grad()
+    def inference_text(
+            self, text: str, batch_size=4, voice=DEFAULT_VOICE, cancel: Optional[threading.Event] = None,
+            requested_at: Optional[float] = None, on_first_frame: Optional[Callable[[float], None]] = None,
+    ) -> int:
+        """
+        按句切分文本，渲染第k句的同时合成第k+1句的语音，各句的帧连续输出，
+        首帧的等待时间只取决于第一句的tts耗时
+        """
+        sentences = speakable_sentences(text)
+        if not sentences:
+            return 0
+        frames = 0
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pending = executor.submit(self.synthesize, sentences[0], voice)
+            self.begin_utterance(requested_at or time.time(), on_first_frame)
+            try:
+                for idx in range(len(sentences)):
+                    audio = pending.result()
+                    if cancel is not None and cancel.is_set():
+                        break
+                    if idx + 1 < len(sentences):
+                        pending = executor.submit(self.synthesize, sentences[idx + 1], voice)
+                    frames += self.render(audio, batch_size, cancel)
+            finally:
+                self.end_utterance()
+        return frames
+
+    def begin_utterance(
+            self, requested_at: Optional[float] = None, on_first_frame: Optional[Callable[[float], None]] = None
+    ):
+        self.requested_at = requested_at or time.time()
+        self.on_first_frame = on_first_frame
+        with self.utterance_lock:
+            self.utterance_rendering = False
+        if self.streaming:
+            # 上一段语音仍在播放时，新语音的帧接在其后继续渲染
+            if not self.frame_buffer.start():
+                self.render_idx = None
+            self.utterance_generation = self.frame_buffer.generation
+        else:
+            self.render_idx = None
+
+    def report_progress(self, rendering: bool):
+        if self.on_render_progress is not None:
+            self.on_render_progress(rendering)
+
+    def end_utterance(self):
+        self.report_progress(False)
+        with self.utterance_lock:
+            self.utterance_rendering = False
+        self.frame_buffer.end()
+
+    def cancel_utterance(self, cancel: threading.Event, flush=False):
+        """
+        设置当前语音的取消标记；语音已有帧进入播放缓冲或flush为True(打断)时丢弃缓冲中未播放的帧，
+        阻塞在缓冲上的渲染线程会被唤醒并退出
+        """
+        with self.utterance_lock:
+            cancel.set()
+            if flush or self.utterance_rendering:
+                self.frame_buffer.flush()
+
+    @staticmethod
+    def synthesize(text: str, voice=DEFAULT_VOICE) -> bytes:
+        with stage('tts'):
+            return asyncio.run(tts_bytes(text, voice))
+
+    @torch.no_grad()
+    def render(self, audio: Union[str, bytes, np.ndarray], batch_size=4, cancel: Optional[threading.Event] = None):
+        """
+        渲染一段音频对应的帧并放入播放缓冲，同一段语音内各次调用的帧序号连续递增，
+        每帧附带其时长内的音频
+        return: 渲染的帧数，被取消或打断时为已渲染的部分
+        """
+        self.report_progress(True)
         self.vid_output_path.mkdir(exist_ok=True)
         self.tmp_path.mkdir(exist_ok=True)
-        frame_idx = self.idx
-        whisper_chunks = self.afe.extract_features(audio_path, self.audio_window)
+        # 只解码一次，特征提取和随帧发送的音频使用同一份PCM
+        pcm = load_audio(audio, self.afe.sample_rate).numpy()
+        pcm16 = (np.clip(pcm, -1.0, 1.0) * 32767).astype(np.int16)
+        samples_per_frame = self.afe.sample_rate // settings.common.fps
+        with stage('features', self.synchronize):
+            whisper_chunks = self.feature_cache.get_or_compute(self.afe, pcm, self.audio_window, on_device=True)
+        if self.render_idx is None:
+            # 语音的第一帧在缓冲jitter_depth帧后才会播放，从那时待机画面所在的位置开始渲染
+            self.render_idx = (self.idx + self.playout.jitter_depth) % len(self.frame_cycle)
+        frame_idx = self.render_idx
+        frames = 0
         gen = datagen(
-            whisper_chunks, self.input_latent_cycle, batch_size=batch_size, delay_frames=self.idx,
+            whisper_chunks, self.input_latent_cycle, batch_size=batch_size, delay_frames=frame_idx,
         )
-        self.inference_results.put('<start>')
         for i, (whisper_batch, latent_batch) in enumerate(
                 tqdm(gen, total=whisper_chunks.shape[0] // batch_size, desc='Inference...')
         ):
-            whisper_batch = whisper_batch.to(self.device, dtype=self.dtype)
-            whisper_batch = self.pe(whisper_batch)
-            latent_batch = latent_batch.to(self.device, dtype=self.dtype)
-            pred_latents = self.unet((latent_batch, whisper_batch))
-            pred_latents = (1 / self.vae.config.scaling_factor) * pred_latents
-            pred_images = self.vae.decode(pred_latents).sample
-            for idx, pred_image in enumerate(pred_images.cpu()):
-                x1, y1, x2, y2 = self.coord_cycle[frame_idx]
-                frame = self.frame_cycle[frame_idx].copy()
-                resized_image = cv2.resize(self.image_processor.de_process(pred_image), (x2 - x1, y2 - y1))
-                # 融合预测图像与原图像
-                pil_frame = Image.fromarray(frame)
-                pil_face = Image.fromarray(resized_image)
-                pil_mask = Image.fromarray(self.mask_cycle[frame_idx]).convert('L').crop((x1, y1, x2, y2))
-                pil_frame.paste(pil_face, box=[x1, y1, x2, y2], mask=pil_mask)
-                pil_frame.save(str(self.tmp_path / f'{frame_idx:08d}.jpg'))
-                frame_idx = self.increase_idx()
-                self.inference_results.put(np.array(pil_frame))
-        self.inference_results.put('<end>')
+            if cancel is not None and cancel.is_set():
+                return frames
+            self.report_progress(True)
+            with PROFILER.batch():
+                with stage('unet', self.synchronize):
+                    whisper_batch = whisper_batch.to(self.device, dtype=self.dtype)
+                    whisper_batch = self.pe(whisper_batch)
+                    latent_batch = latent_batch.to(self.device, dtype=self.dtype)
+                    pred_latents = self.run_unet(latent_batch, whisper_batch)
+                with stage('vae'):
+                    pred_latents = (1 / self.vae.config.scaling_factor) * pred_latents
+                    pred_images = self.image_processor.de_process_bgr(self.run_vae_decoder(pred_latents))
+                for idx, pred_image in enumerate(pred_images):
+                    with stage('composite'):
+                        x1, y1, x2, y2 = self.coord_cycle[frame_idx]
+                        frame = self.frame_cycle[frame_idx].copy()
+                        face = cv2.resize(pred_image, (x2 - x1, y2 - y1))
+                        # 按mask融合预测图像与原图像，直接写入帧的人脸区域
+                        alpha = self.mask_cycle[frame_idx][y1:y2, x1:x2].astype(np.float32) / 255.0
+                        region = frame[y1:y2, x1:x2]
+                        region[:] = cv2.blendLinear(face, region, alpha, 1.0 - alpha)
+                    if self.streaming:
+                        audio_chunk = pcm16[frames * samples_per_frame: (frames + 1) * samples_per_frame]
+                        playout_frame = PlayoutFrame(
+                            frame, frame_idx, idle=False, audio=audio_chunk,
+                            requested_at=self.requested_at, on_first_frame=self.on_first_frame,
+                        )
+                        self.requested_at = self.on_first_frame = None
+                        with self.utterance_lock:
+                            if cancel is not None and cancel.is_set():
+                                return frames
+                            # 在put之前标记，put阻塞时取消方也能flush缓冲将其唤醒
+                            self.utterance_rendering = True
+                        if not self.frame_buffer.put(playout_frame, self.utterance_generation):
+                            # 播放缓冲已被flush，当前语音被打断
+                            return frames
+                        self.utterance_rendering = True
+                    else:
+                        # 离线生成时保存帧，用于合成视频
+                        cv2.imwrite(str(self.tmp_path / f'{frame_idx:08d}.jpg'), frame)
+                    frames += 1
+                    frame_idx = (frame_idx + 1) % len(self.frame_cycle)
+                    self.render_idx = frame_idx
+        return frames
         # tmp_video_path = self.vid_output_path / (Path(audio_path).stem + '_tmp.mp4')
         # video_path = self.vid_output_path / (Path(audio_path).stem + '.mp4')
         # images2video(self.tmp_path, tmp_video_path)
@@ -226,34 +427,33 @@ class Avatar:
         self.idx = (self.idx + 1) % len(self.frame_cycle)
         return self.idx
 
+    def idle_frame(self) -> PlayoutFrame:
+        frame = PlayoutFrame(self.frame_cycle[self.idx], self.idx, idle=True)
+        self.increase_idx()
+        return frame
+
+    def on_played(self, frame: PlayoutFrame):
+        # 语音帧播放后，待机画面从其下一帧继续
+        if not frame.idle:
+            self.idx = (frame.index + 1) % len(self.frame_cycle)
+            if frame.requested_at is not None:
+                # 该语音的第一帧，之前播放的可能是上一段语音的帧
+                played_at = time.time()
+                TIME_TO_FIRST_FRAME.observe(played_at - frame.requested_at, avatar=self.avatar_id)
+                if frame.on_first_frame is not None:
+                    frame.on_first_frame(played_at)
+
     async def next_frame(self):
-        inferencing = False
-        while True:
-            # 如果正在推理
-            try:
-                if not inferencing:
-                    flag = self.inference_results.get_nowait()
-                else:
-                    flag = self.inference_results.get()
-                if isinstance(flag, str) and flag == '<start>':
-                    inferencing = True
-                elif isinstance(flag, str) and flag == '<end>':
-                    inferencing = False
-                if isinstance(flag, np.ndarray):
-                    yield flag[:, :, ::-1]
-                    await asyncio.sleep(1 / settings.common.fps)
-            except Exception as e:
-                pass
-            # 如果不在推理
-            if not inferencing:
-                yield self.frame_cycle[self.idx][:, :, ::-1]
-                self.increase_idx()
-                await asyncio.sleep(1 / settings.common.fps)
+        """
+        按设定的帧率输出PlayoutFrame，image为BGR格式
+        """
+        async for frame in self.playout.frames():
+            yield frame
 
 
 def main():
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    avatar = Avatar('111', r'F:\Workplace\MuseTalkPlus\data\video\zack.mp4', device=device)
+    avatar = Avatar('111', r'F:\Workplace\MuseTalkPlus\data\video\zack.mp4', device=device, streaming=False)
     avatar.inference(r'F:\Workplace\MuseTalkPlus\data\audio\00000002.mp3')
 
 
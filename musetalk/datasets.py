@@ -14,11 +14,6 @@ sys.path.append('.')
 from common.setting import settings
 from musetalk.processors import ImageProcessor
 
-RESIZED_IMG = settings.common.image_size
-HIDDEN_SIZE = settings.common.hidden_size
-EMBEDDING_DIM = settings.common.embedding_dim
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-
 
 class MuseTalkDataset(Dataset):
     def __init__(
@@ -37,7 +32,8 @@ class MuseTalkDataset(Dataset):
         self.split = split
 
         self.hidden_dim = (self.audio_window * 2 + 1) * 10
-        self.embedding_dim = EMBEDDING_DIM
+        self.embedding_dim = settings.common.embedding_dim
+        self.image_size = settings.common.image_size
         self.image_processor = ImageProcessor()
         self.load_filenames()
 
@@ -140,9 +136,9 @@ class MuseTalkDataset(Dataset):
             min(len(video_data['image_files']), len(video_data['audio_files'])) - 1 - self.sync_t
         )
         frame_idxes = [frame_idx + i for i in range(self.sync_t)]
-        target_images = torch.zeros(self.sync_t, 3, RESIZED_IMG, RESIZED_IMG)
-        reference_images = torch.zeros(self.sync_t, 3, RESIZED_IMG, RESIZED_IMG)
-        masked_images = torch.zeros(self.sync_t, 3, RESIZED_IMG, RESIZED_IMG)
+        target_images = torch.zeros(self.sync_t, 3, self.image_size, self.image_size)
+        reference_images = torch.zeros(self.sync_t, 3, self.image_size, self.image_size)
+        masked_images = torch.zeros(self.sync_t, 3, self.image_size, self.image_size)
         audio_features = torch.zeros(self.sync_t, self.hidden_dim, self.embedding_dim)
         for idx, frame_idx in enumerate(frame_idxes):
             target_image, reference_image, masked_image = self.load_frames(video_name, frame_idx)
@@ -181,7 +177,7 @@ class SyncNetDataset(MuseTalkDataset):
                 frame_idxes = [frame_idx + i for i in range(self.sync_t)]
             else:
                 frame_idxes = random.sample(range(len(video_data['image_files'])), self.sync_t)
-        images = torch.zeros(self.sync_t, 3, RESIZED_IMG, RESIZED_IMG)
+        images = torch.zeros(self.sync_t, 3, self.image_size, self.image_size)
         for idx, frame_idx in enumerate(frame_idxes):
             images[idx] = self.load_frame(video_name, frame_idx)
 
@@ -0,0 +1,300 @@
+import json
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Literal, Optional, Sequence, Tuple, Union
+
+import torch
+from torch import nn
+
+Backend = Literal['eager', 'compiled', 'torchscript', 'onnxruntime', 'int8']
+ArtifactFormat = Literal['onnx', 'torchscript']
+
+COMPONENTS = ('unet', 'vae_decoder', 'audio_encoder')
+MANIFEST = 'manifest.json'
+# 后端对应的导出格式
+BACKEND_FORMATS = {'torchscript': 'torchscript', 'onnxruntime': 'onnx', 'int8': 'int8'}
+# int8为scripts/calibrate_int8.py保存的量化参数
+FORMAT_SUFFIXES = {'torchscript': '.pt', 'onnx': '.onnx', 'int8': '.int8.pt'}
+# 运行时只依赖导出文件、不再需要eager模块的后端
+ARTIFACT_BACKENDS = ('torchscript', 'onnxruntime')
+# 输出与eager存在差异的后端，compiled与eager的计算相同
+LOSSY_BACKENDS = ('torchscript', 'onnxruntime', 'int8')
+
+
+class UNetModule(nn.Module):
+    """
+    以位置参数调用MuseTalkModel，输入为latents(n * 8 * 32 * 32)和加上位置编码后的音频特征(n * 50 * 384)
+    """
+
+    def __init__(self, model: nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, latents, audio):
+        return self.model((latents, audio))
+
+
+class VaeDecoderModule(nn.Module):
+    """
+    AutoencoderKL的解码部分，输入已除以scaling_factor的latents，输出-1~1的图像
+    """
+
+    def __init__(self, vae: nn.Module):
+        super().__init__()
+        self.vae = vae
+
+    def forward(self, latents):
+        return self.vae.decode(latents).sample
+
+
+class AudioEncoderModule(nn.Module):
+    """
+    whisper的AudioEncoder，只输出各层embedding(n * n_layers * n_tokens * n_state)
+    """
+
+    def __init__(self, encoder: nn.Module):
+        super().__init__()
+        self.encoder = encoder
+
+    def forward(self, mel):
+        return self.encoder(mel)[1]
+
+
+def load_modules(components: Sequence[str], unet_path: str, vae_path: str, whisper_path: str) -> Dict[str, nn.Module]:
+    """
+    以float32在cpu上加载各组件的eager模块，用于导出、校准和一致性检查
+    """
+    from diffusers import AutoencoderKL
+    from musetalk.models.musetalk import MuseTalkModel
+    from musetalk.audio.audio_feature_extract import AudioFeatureExtractor
+
+    modules = {}
+    if 'unet' in components:
+        modules['unet'] = UNetModule(MuseTalkModel(unet_path)).eval()
+    if 'vae_decoder' in components:
+        modules['vae_decoder'] = VaeDecoderModule(AutoencoderKL.from_pretrained(vae_path, use_safetensors=False)).eval()
+    if 'audio_encoder' in components:
+        afe = AudioFeatureExtractor(whisper_path, 'cpu', torch.float32)
+        modules['audio_encoder'] = AudioEncoderModule(afe.encoder).eval()
+    return modules
+
+
+# 各组件的输入输出名称及可变的维度
+SIGNATURES = {
+    'unet': (['latents', 'audio'], ['sample'], {'latents': [0], 'audio': [0], 'sample': [0]}),
+    'vae_decoder': (['latents'], ['image'], {'latents': [0], 'image': [0]}),
+    'audio_encoder': (['mel'], ['embeddings'], {'mel': [0, 2], 'embeddings': [0, 2]}),
+}
+
+
+def sample_inputs(component: str, module: nn.Module, batch_size=4, audio_frames=3000) -> Tuple[torch.Tensor, ...]:
+    """
+    按模型配置生成导出和一致性检查使用的随机输入
+    audio_frames: audio_encoder输入的mel帧数，3000即30秒
+    """
+    parameter = next(module.parameters())
+    options = {"device": parameter.device, "dtype": parameter.dtype}
+    if component == 'unet':
+        config = module.model.unet.config
+        latents = torch.randn(batch_size, config.in_channels, config.sample_size, config.sample_size, **options)
+        # 音频窗口: (audio_window * 2 + 1) * 2帧 * 5层
+        audio = torch.randn(batch_size, 50, config.cross_attention_dim, **options)
+        return latents, audio
+    if component == 'vae_decoder':
+        config = module.vae.config
+        size = config.sample_size // 2 ** (len(config.block_out_channels) - 1)
+        return torch.randn(batch_size, config.latent_channels, size, size, **options),
+    if component == 'audio_encoder':
+        n_mels = module.encoder.conv1.in_channels
+        return torch.randn(batch_size, n_mels, audio_frames, **options),
+    raise ValueError(f"unknown component {component}")
+
+
+def export(
+        component: str, module: nn.Module, inputs: Sequence[torch.Tensor], export_dir: Union[str, Path],
+        fmt: ArtifactFormat, dynamic_batch=True, opset=17,
+) -> dict:
+    """
+    导出单个组件，返回写入manifest的信息
+    dynamic_batch: 为False时只支持导出时的batch大小，运行时不足的batch补零
+    """
+    export_dir = Path(export_dir)
+    export_dir.mkdir(parents=True, exist_ok=True)
+    path = export_dir / f'{component}{FORMAT_SUFFIXES[fmt]}'
+    input_names, output_names, dynamic_dims = SIGNATURES[component]
+    if not dynamic_batch:
+        dynamic_dims = {name: [dim for dim in dims if dim != 0] for name, dims in dynamic_dims.items()}
+    module = module.eval()
+    with torch.no_grad():
+        if fmt == 'onnx':
+            torch.onnx.export(
+                module, tuple(inputs), str(path),
+                input_names=input_names,
+                output_names=output_names,
+                dynamic_axes={name: dims for name, dims in dynamic_dims.items() if dims},
+                opset_version=opset,
+                do_constant_folding=True,
+            )
+        elif fmt == 'torchscript':
+            traced = torch.jit.trace(module, tuple(inputs), check_trace=False)
+            torch.jit.save(torch.jit.freeze(traced), str(path))
+        else:
+            raise ValueError(f"unknown artifact format {fmt}")
+    return {
+        "file": path.name,
+        "batch_size": None if dynamic_batch else int(inputs[0].shape[0]),
+        "dtype": str(inputs[0].dtype).replace('torch.', ''),
+        "input_shapes": [list(x.shape) for x in inputs],
+    }
+
+
+def read_manifest(export_dir: Union[str, Path]) -> dict:
+    path = Path(export_dir) / MANIFEST
+    if not path.exists():
+        return {"components": {}}
+    return json.loads(path.read_text(encoding='utf-8'))
+
+
+def write_manifest(export_dir: Union[str, Path], manifest: dict):
+    manifest["updated_at"] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    manifest["torch"] = torch.__version__
+    (Path(export_dir) / MANIFEST).write_text(json.dumps(manifest, indent=2, ensure_ascii=False), encoding='utf-8')
+
+
+class ArtifactRunner:
+    """
+    执行导出的模型，输入输出均为torch.Tensor，与eager模块的调用方式一致。
+    输入转换为导出时的精度，输出转换回输入的设备和精度；固定batch的模型按batch_size切分，不足的部分补零
+    """
+
+    def __init__(
+            self, run: Callable[[List[torch.Tensor]], torch.Tensor], batch_size: Optional[int],
+            device: torch.device, dtype: torch.dtype,
+    ):
+        self.run = run
+        self.batch_size = batch_size
+        self.device = device
+        self.dtype = dtype
+
+    def __call__(self, *inputs: torch.Tensor) -> torch.Tensor:
+        out_device, out_dtype = inputs[0].device, inputs[0].dtype
+        inputs = [x.to(self.device, dtype=self.dtype) for x in inputs]
+        n = inputs[0].shape[0]
+        if self.batch_size is None or n == self.batch_size:
+            return self.run(inputs).to(out_device, dtype=out_dtype)
+        outputs = []
+        for start in range(0, n, self.batch_size):
+            chunk = [x[start: start + self.batch_size] for x in inputs]
+            count = chunk[0].shape[0]
+            if count < self.batch_size:
+                chunk = [torch.cat([x, x.new_zeros((self.batch_size - count, *x.shape[1:]))]) for x in chunk]
+            outputs.append(self.run(chunk)[:count])
+        return torch.cat(outputs).to(out_device, dtype=out_dtype)
+
+
+def _onnxruntime_runner(path: Path, entry: dict, device: torch.device, threads: int) -> ArtifactRunner:
+    try:
+        import onnxruntime as ort
+    except ImportError as e:
+        raise ImportError("the onnxruntime backend requires `pip install onnxruntime`") from e
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if threads:
+        options.intra_op_num_threads = threads
+    providers = ['CPUExecutionProvider']
+    if device.type == 'cuda' and 'CUDAExecutionProvider' in ort.get_available_providers():
+        providers.insert(0, 'CUDAExecutionProvider')
+    session = ort.InferenceSession(str(path), options, providers=providers)
+    input_names = [item.name for item in session.get_inputs()]
+
+    def run(inputs):
+        feeds = {name: x.numpy() for name, x in zip(input_names, inputs)}
+        return torch.from_numpy(session.run(None, feeds)[0])
+
+    # onnxruntime的输入输出在cpu上，由ArtifactRunner拷贝回调用方的设备
+    return ArtifactRunner(run, entry["batch_size"], torch.device('cpu'), getattr(torch, entry["dtype"]))
+
+
+def _torchscript_runner(path: Path, entry: dict, device: torch.device, threads: int) -> ArtifactRunner:
+    if threads:
+        torch.set_num_threads(threads)
+    module = torch.jit.load(str(path), map_location=device)
+
+    def run(inputs):
+        return module(*inputs)
+
+    return ArtifactRunner(run, entry["batch_size"], device, getattr(torch, entry["dtype"]))
+
+
+def _int8_runner(component: str, module: nn.Module, path: Path, device: torch.device, threads: int) -> ArtifactRunner:
+    from musetalk.models.quantization import load_int8
+
+    if device.type != 'cpu':
+        raise ValueError("the int8 backend only runs on cpu")
+    if threads:
+        torch.set_num_threads(threads)
+    quantized = load_int8(component, module, path)
+
+    def run(inputs):
+        return quantized(*inputs)
+
+    return ArtifactRunner(run, None, device, torch.float32)
+
+
+def load_backend(
+        component: str, module: nn.Module, backend: Backend = 'eager', export_dir: Union[str, Path, None] = None,
+        device: Union[str, torch.device] = 'cpu', threads=0,
+) -> Callable[..., torch.Tensor]:
+    """
+    component: unet、vae_decoder或audio_encoder
+    module: 该组件的eager模块(UNetModule、VaeDecoderModule、AudioEncoderModule)
+    backend: eager直接调用module；compiled使用torch.compile；torchscript和onnxruntime加载export_dir中导出的模型；
+             int8按export_dir中的校准结果原地量化module
+    threads: 后端使用的cpu线程数，0为默认
+    """
+    if backend == 'eager':
+        return module
+    if backend == 'compiled':
+        return torch.compile(module, dynamic=True)
+    if backend not in BACKEND_FORMATS:
+        raise ValueError(f"unknown inference backend {backend}")
+    fmt = BACKEND_FORMATS[backend]
+    entry = read_manifest(export_dir)["components"].get(component, {}).get(fmt)
+    if entry is None:
+        raise FileNotFoundError(
+            f"no {fmt} export of {component} in {export_dir}, "
+            f"run {'scripts/calibrate_int8.py' if fmt == 'int8' else 'scripts/export_backends.py'} first"
+        )
+    path = Path(export_dir) / entry["file"]
+    device = torch.device(device)
+    if fmt == 'onnx':
+        return _onnxruntime_runner(path, entry, device, threads)
+    if fmt == 'int8':
+        return _int8_runner(component, module, path, device, threads)
+    return _torchscript_runner(path, entry, device, threads)
+
+
+def parity(
+        reference: Callable[..., torch.Tensor], candidate: Callable[..., torch.Tensor],
+        inputs: Sequence[torch.Tensor], repeat=3,
+) -> Dict[str, float]:
+    """
+    比较candidate与eager模块的输出，同时返回两者的平均耗时
+    """
+    with torch.no_grad():
+        expected = reference(*inputs).float()
+        actual = candidate(*inputs).float()
+        timings = {}
+        for name, fn in (('reference', reference), ('candidate', candidate)):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                fn(*inputs)
+            timings[f'{name}_seconds'] = (time.perf_counter() - start) / repeat
+    diff = (actual - expected).abs()
+    return {
+        "max_abs_error": diff.max().item(),
+        "mean_abs_error": diff.mean().item(),
+        # 相对于输出幅度的最大误差
+        "max_rel_error": (diff.max() / expected.abs().max().clamp(min=1e-12)).item(),
+        **timings,
+    }
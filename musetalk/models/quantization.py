@@ -0,0 +1,184 @@
+import copy
+import warnings
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Optional, Sequence, Union
+
+import torch
+from torch import nn
+from torch.nn.utils import skip_init
+import torch.ao.nn.quantized.dynamic as nnqd
+from torch.ao.quantization import DeQuantStub, QuantStub, convert, default_dynamic_qconfig, get_default_qconfig, prepare
+
+# 各组件中参与量化的子模块(相对于backends中的UNetModule、VaeDecoderModule、AudioEncoderModule)
+QUANT_SCOPES = {
+    'unet': ('model.unet',),
+    # VaeDecoderModule包含整个vae，encoder只在预处理avatar时使用，保持float
+    'vae_decoder': ('vae.decoder', 'vae.post_quant_conv'),
+    'audio_encoder': ('encoder',),
+}
+# 默认保持float的卷积: 输入输出层对量化误差最敏感，计算量占比很小
+FLOAT_MODULES = {
+    'unet': ('model.unet.conv_in', 'model.unet.conv_out'),
+    'vae_decoder': ('vae.decoder.conv_in', 'vae.decoder.conv_out'),
+    'audio_encoder': ('encoder.conv1',),
+}
+
+
+def quantized_engine() -> str:
+    """
+    选择当前cpu支持的int8后端，x86和fbgemm使用AVX2/AVX512 VNNI，qnnpack用于arm
+    """
+    engines = torch.backends.quantized.supported_engines
+    for engine in ('x86', 'fbgemm', 'qnnpack'):
+        if engine in engines:
+            torch.backends.quantized.engine = engine
+            return engine
+    raise RuntimeError(f"no int8 engine available, supported engines: {engines}")
+
+
+def _float_copy(module: nn.Module) -> nn.Module:
+    """
+    diffusers的LoRACompatibleConv/Linear和whisper的Conv1d/Linear是nn.Conv*/nn.Linear的子类，
+    量化的模块映射只接受原始类型，转换为共享参数的原始类型
+    """
+    if isinstance(module, nn.Linear):
+        plain = skip_init(nn.Linear, module.in_features, module.out_features, bias=module.bias is not None)
+    elif isinstance(module, (nn.Conv1d, nn.Conv2d)):
+        plain = skip_init(
+            nn.Conv1d if isinstance(module, nn.Conv1d) else nn.Conv2d,
+            module.in_channels, module.out_channels, module.kernel_size,
+            stride=module.stride, padding=module.padding, dilation=module.dilation, groups=module.groups,
+            bias=module.bias is not None, padding_mode=module.padding_mode,
+        )
+    else:
+        raise TypeError(f"unsupported module {type(module).__name__}")
+    plain.weight = module.weight
+    plain.bias = module.bias
+    return plain
+
+
+class StaticInt8Conv(nn.Module):
+    """
+    静态量化的卷积: 输入量化为int8后以int8卷积，输出反量化为float，前后的norm和激活保持float。
+    调用方传入的额外参数(diffusers的lora scale)被忽略
+    """
+
+    def __init__(self, conv: nn.Module):
+        super().__init__()
+        self.quant = QuantStub()
+        self.conv = _float_copy(conv)
+        self.dequant = DeQuantStub()
+
+    def forward(self, x, *args, **kwargs):
+        return self.dequant(self.conv(self.quant(x)))
+
+
+class DynamicInt8Linear(nn.Module):
+    """
+    动态量化的线性层(包括注意力的q、k、v和输出投影): 权重为int8，激活在运行时按batch量化
+    """
+
+    def __init__(self, linear: nn.Module):
+        super().__init__()
+        linear = _float_copy(linear)
+        linear.qconfig = default_dynamic_qconfig
+        self.linear = nnqd.Linear.from_float(linear)
+
+    def forward(self, x, *args, **kwargs):
+        return self.linear(x)
+
+
+def _in_scope(name: str, prefixes: Iterable[str]) -> bool:
+    return any(name == prefix or name.startswith(prefix + '.') for prefix in prefixes)
+
+
+def _replace(module: nn.Module, name: str, new: nn.Module):
+    parent_name, _, child = name.rpartition('.')
+    parent = module.get_submodule(parent_name) if parent_name else module
+    setattr(parent, child, new)
+
+
+def _targets(component: str, module: nn.Module, types, float_modules: Sequence[str]):
+    return [
+        name for name, child in module.named_modules()
+        if isinstance(child, types) and _in_scope(name, QUANT_SCOPES[component]) and name not in float_modules
+    ]
+
+
+def prepare_static(
+        component: str, module: nn.Module, float_modules: Optional[Sequence[str]] = None,
+) -> nn.Module:
+    """
+    在原模块上把卷积替换为StaticInt8Conv并插入observer，之后以校准数据前向若干次，再调用convert_static
+    """
+    engine = quantized_engine()
+    float_modules = FLOAT_MODULES[component] if float_modules is None else float_modules
+    qconfig = get_default_qconfig(engine)
+    for name in _targets(component, module, (nn.Conv1d, nn.Conv2d), float_modules):
+        wrapper = StaticInt8Conv(module.get_submodule(name))
+        wrapper.qconfig = qconfig
+        _replace(module, name, wrapper)
+    return prepare(module.eval(), inplace=True)
+
+
+def convert_static(module: nn.Module) -> nn.Module:
+    return convert(module, inplace=True)
+
+
+def apply_dynamic(component: str, module: nn.Module, float_modules: Sequence[str] = ()) -> nn.Module:
+    for name in _targets(component, module, nn.Linear, float_modules):
+        _replace(module, name, DynamicInt8Linear(module.get_submodule(name)))
+    return module
+
+
+def static_state(module: nn.Module) -> Dict[str, dict]:
+    """
+    return: 各StaticInt8Conv的量化参数(int8权重、激活的scale和zero_point)，用于保存校准结果
+    """
+    return {name: child.state_dict() for name, child in module.named_modules() if isinstance(child, StaticInt8Conv)}
+
+
+def quantize(
+        component: str, module: nn.Module, calibrate: Optional[Callable[[nn.Module], None]] = None, dynamic=True,
+        float_modules: Optional[Sequence[str]] = None, inplace=False,
+) -> nn.Module:
+    """
+    calibrate: 以插入observer后的模块执行若干次前向(cpu上的float32输入)，为None时卷积不做静态量化
+    dynamic: 线性层使用动态量化
+    float_modules: 保持float的卷积，默认为FLOAT_MODULES
+    """
+    if not inplace:
+        module = copy.deepcopy(module)
+    module = module.float().cpu().eval()
+    float_modules = FLOAT_MODULES[component] if float_modules is None else tuple(float_modules)
+    if calibrate is not None:
+        prepare_static(component, module, float_modules)
+        with torch.no_grad():
+            calibrate(module)
+        convert_static(module)
+    if dynamic:
+        apply_dynamic(component, module, float_modules)
+    return module
+
+
+def save_int8(module: nn.Module, path: Union[str, Path], info: dict):
+    torch.save({"static": static_state(module), **info}, str(path))
+
+
+def load_int8(component: str, module: nn.Module, path: Union[str, Path]) -> nn.Module:
+    """
+    在原模块上按保存时的设置重新构建int8模块并载入校准得到的量化参数，module被原地替换
+    """
+    checkpoint = torch.load(str(path), map_location='cpu')
+    module = module.float().cpu().eval()
+    if checkpoint["static"]:
+        prepare_static(component, module, checkpoint["float_modules"])
+        with warnings.catch_warnings():
+            # observer未经过前向，convert得到的量化参数随即被保存的值覆盖
+            warnings.simplefilter('ignore')
+            convert_static(module)
+        for name, state in checkpoint["static"].items():
+            module.get_submodule(name).load_state_dict(state)
+    if checkpoint["dynamic"]:
+        apply_dynamic(component, module, checkpoint["float_modules"])
+    return module
@@ -31,6 +31,16 @@ class ImageProcessor:
         image = image * 255.0
         return image.permute(1, 2, 0).cpu().numpy().astype(np.uint8)
 
+    def de_process_bgr(self, images: torch.Tensor) -> np.ndarray:
+        """
+        批量反归一化，并在图像所在的设备上完成RGB到BGR的翻转和uint8转换，只向cpu拷贝一次
+        images: n * 3 * h * w
+        return: n * h * w * 3的BGR图像，C连续
+        """
+        images = images * self.std.to(images.device, images.dtype) + self.mean.to(images.device, images.dtype)
+        images = (images * 255.0).clamp(0, 255).to(torch.uint8)
+        return images.flip(1).permute(0, 2, 3, 1).contiguous().cpu().numpy()
+
 
 if __name__ == '__main__':
     import matplotlib.pyplot as plt
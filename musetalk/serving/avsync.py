@@ -0,0 +1,50 @@
+import json
+import struct
+from typing import List
+
+from musetalk.serving.playout import PlayoutFrame
+
+MESSAGE_VIDEO = 0
+MESSAGE_AUDIO = 1
+
+# 消息类型(uint8) + pts(int64，小端)，之后是jpeg或16位小端PCM
+HEADER = struct.Struct('<Bq')
+
+
+class MediaClock:
+    """
+    以音频采样数为时间基准的展示时间戳: 第n个播放节拍的pts为n * samples_per_frame。
+    同一节拍的视频帧和音频块使用相同的pts，客户端以音频播放位置为主时钟对齐视频
+    """
+
+    def __init__(self, sample_rate=16000, fps=25):
+        self.sample_rate = sample_rate
+        self.fps = fps
+        self.samples_per_frame = sample_rate // fps
+
+    def pts(self, frame: PlayoutFrame) -> int:
+        return frame.sequence * self.samples_per_frame
+
+    def hello(self) -> str:
+        """
+        连接建立后发送给客户端的流参数
+        """
+        return json.dumps({
+            "timebase": self.sample_rate,
+            "sample_rate": self.sample_rate,
+            "channels": 1,
+            "sample_format": "s16le",
+            "fps": self.fps,
+            "samples_per_frame": self.samples_per_frame,
+        })
+
+    def pack(self, frame: PlayoutFrame, image: bytes) -> List[bytes]:
+        """
+        image: 编码后的视频帧
+        return: 视频消息，说话帧另外附带一条相同pts的音频消息
+        """
+        pts = self.pts(frame)
+        messages = [HEADER.pack(MESSAGE_VIDEO, pts) + image]
+        if frame.audio is not None:
+            messages.append(HEADER.pack(MESSAGE_AUDIO, pts) + frame.audio.tobytes())
+        return messages
@@ -0,0 +1,128 @@
+import asyncio
+from typing import Awaitable, Callable, Optional, Set, List
+
+from musetalk.serving.avsync import MediaClock
+from musetalk.serving.playout import PlayoutFrame
+from musetalk.serving.encoders import EncodeProfile
+from musetalk.serving.h264 import FragmentedMp4Stream, Mp4Subscriber
+
+
+class ClientBuffer:
+    """
+    单个客户端的有界发送缓冲，客户端跟不上时丢弃最旧的帧，不会阻塞生产者和其它客户端
+
+    av: 为True时每帧是带pts的视频消息和音频消息组成的列表，否则是jpeg bytes
+    """
+
+    def __init__(self, profile: EncodeProfile, maxsize=5, av=False):
+        self.profile = profile
+        self.av = av
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.dropped = 0
+
+    def offer(self, data):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(data)
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class FrameBroadcaster:
+    """
+    每个avatar只有一个生产者: 从播放时钟取帧，每帧对每种输出规格只编码一次，再分发给所有客户端的缓冲。
+    没有客户端且不在说话时暂停取帧，待机画面不再空转；说话的帧即使没有客户端也会被取走，
+    因此生产者需要在服务启动时就调用start，不能等到第一个客户端连接
+    """
+
+    def __init__(
+            self, avatar, encode: Callable[[PlayoutFrame, EncodeProfile], Awaitable[bytes]], client_buffer=5,
+            streams: Optional[List[FragmentedMp4Stream]] = None, clock: Optional[MediaClock] = None,
+    ):
+        """
+        streams: 需要同时输出的视频流(如H.264 fragmented mp4)，有订阅者时每帧都会送入
+        clock: 为av客户端生成展示时间戳
+        """
+        self.avatar = avatar
+        self.encode = encode
+        self.clock = clock or MediaClock()
+        self.client_buffer = client_buffer
+        self.clients: Set[ClientBuffer] = set()
+        self.streams = list(streams or [])
+        self.has_clients = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def has_viewers(self) -> bool:
+        return bool(self.clients) or any(stream.subscribers for stream in self.streams)
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def ensure_running(self):
+        self.has_clients.set()
+        self.start()
+
+    def subscribe(self, profile: EncodeProfile, av=False) -> ClientBuffer:
+        client = ClientBuffer(profile, self.client_buffer, av)
+        self.clients.add(client)
+        self.ensure_running()
+        return client
+
+    def unsubscribe(self, client: ClientBuffer):
+        self.clients.discard(client)
+        if not self.has_viewers():
+            self.has_clients.clear()
+
+    def subscribe_stream(self, stream: FragmentedMp4Stream) -> Mp4Subscriber:
+        subscriber = stream.subscribe()
+        self.ensure_running()
+        return subscriber
+
+    def unsubscribe_stream(self, stream: FragmentedMp4Stream, subscriber: Mp4Subscriber):
+        stream.unsubscribe(subscriber)
+        if not self.has_viewers():
+            self.has_clients.clear()
+
+    async def wait_for_work(self):
+        # 推理线程开始说话时不会通知事件循环，因此定期检查
+        while not self.has_viewers() and not self.avatar.frame_buffer.active:
+            try:
+                await asyncio.wait_for(self.has_clients.wait(), timeout=0.1)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self):
+        frames = self.avatar.next_frame()
+        while True:
+            if not self.has_viewers() and not self.avatar.frame_buffer.active:
+                await self.wait_for_work()
+                self.avatar.playout.reset_clock()
+            frame = await frames.__anext__()
+            for stream in self.streams:
+                if stream.subscribers:
+                    stream.feed(frame.image)
+            # 没有客户端时仍然消费说话的帧，避免推理线程被缓冲阻塞
+            if not self.clients:
+                continue
+            clients = list(self.clients)
+            profiles = list({client.profile for client in clients})
+            encoded = await asyncio.gather(*[self.encode(frame, profile) for profile in profiles])
+            encoded = dict(zip(profiles, encoded))
+            packed = {}
+            for client in clients:
+                if client.av:
+                    if client.profile not in packed:
+                        packed[client.profile] = self.clock.pack(frame, encoded[client.profile])
+                    client.offer(packed[client.profile])
+                else:
+                    client.offer(encoded[client.profile])
+
+    def stats(self) -> dict:
+        return {
+            "clients": len(self.clients),
+            "stream_clients": sum(len(stream.subscribers) for stream in self.streams),
+            "dropped_frames": sum(client.dropped for client in self.clients),
+        }
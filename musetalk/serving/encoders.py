@@ -0,0 +1,122 @@
+import asyncio
+from typing import List, Optional
+from collections import OrderedDict
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+
+@dataclass(frozen=True)
+class EncodeProfile:
+    """
+    输出规格，图像按比例缩放到max_width * max_height以内(不放大)
+    """
+    max_width: int = 450
+    max_height: int = 450
+    quality: int = 95
+
+
+class JpegEncoder:
+    """
+    在线程池中编码jpeg，cv2.resize和cv2.imencode(libjpeg-turbo)执行期间会释放GIL，不阻塞事件循环
+    """
+
+    def __init__(self, workers=2):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='jpeg-encoder')
+
+    @staticmethod
+    def encode_sync(image: np.ndarray, profile: EncodeProfile) -> bytes:
+        """
+        image: BGR格式，C连续
+        """
+        assert image.flags['C_CONTIGUOUS'], "frames must be C-contiguous BGR"
+        h, w = image.shape[:2]
+        scale = min(profile.max_width / w, profile.max_height / h)
+        if scale < 1:
+            size = (max(1, round(w * scale)), max(1, round(h * scale)))
+            image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        ok, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, profile.quality])
+        if not ok:
+            raise RuntimeError("failed to encode frame")
+        return buffer.tobytes()
+
+    async def encode(self, image: np.ndarray, profile: EncodeProfile) -> bytes:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.encode_sync, image, profile)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+def frame_slots(frame_cycle: List[np.ndarray]) -> List[int]:
+    """
+    frame_cycle中每个位置对应的第一个相同ndarray的位置，正序和倒序拼接的两个位置共享一个slot
+    """
+    first_index = {}
+    return [first_index.setdefault(id(frame), idx) for idx, frame in enumerate(frame_cycle)]
+
+
+class IdleFrameCache:
+    """
+    待机画面按输出规格预先编码的缓存，待机时直接发送缓存的bytes。
+    frame_cycle由正序和倒序拼接而成，指向同一ndarray的两个位置共享一份编码。
+    帧在其它进程中时frame_cycle为None，需要传入slots，未命中时编码get传入的图像
+    """
+
+    def __init__(
+            self, encoder: JpegEncoder, frame_cycle: Optional[List[np.ndarray]], max_profiles=4,
+            slots: Optional[List[int]] = None,
+    ):
+        self.encoder = encoder
+        self.frame_cycle = frame_cycle
+        self.slots = slots if slots is not None else frame_slots(frame_cycle)
+        self.max_profiles = max_profiles
+        self.profiles = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _entries(self, profile: EncodeProfile) -> List[Optional[bytes]]:
+        if profile not in self.profiles:
+            self.profiles[profile] = [None] * len(self.slots)
+            while len(self.profiles) > self.max_profiles:
+                self.profiles.popitem(last=False)
+        self.profiles.move_to_end(profile)
+        return self.profiles[profile]
+
+    async def get(self, index: int, profile: EncodeProfile, image: Optional[np.ndarray] = None) -> bytes:
+        """
+        image: index对应的BGR图像，frame_cycle为None时用于未命中时的编码
+        """
+        entries = self._entries(profile)
+        slot = self.slots[index]
+        data = entries[slot]
+        if data is None:
+            self.misses += 1
+            if self.frame_cycle is not None:
+                image = self.frame_cycle[slot]
+            data = await self.encoder.encode(image, profile)
+            entries[slot] = data
+        else:
+            self.hits += 1
+        return data
+
+    async def warm(self, profile: EncodeProfile):
+        """
+        预先编码全部待机帧，可在加载avatar后作为后台任务运行
+        """
+        if self.frame_cycle is None:
+            return
+        entries = self._entries(profile)
+        for slot in sorted(set(self.slots)):
+            if entries[slot] is None:
+                entries[slot] = await self.encoder.encode(self.frame_cycle[slot], profile)
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "profiles": len(self.profiles),
+            "bytes": sum(len(data) for entries in self.profiles.values() for data in entries if data),
+        }
@@ -0,0 +1,220 @@
+import queue
+import struct
+import asyncio
+import threading
+import subprocess
+from dataclasses import dataclass
+from typing import List, Optional, Set
+
+import numpy as np
+
+
+@dataclass(frozen=True)
+class H264Profile:
+    max_width: int = 450
+    max_height: int = 450
+    fps: int = 25
+    # 关键帧间隔(帧数)，新连接的客户端最多等待一个gop才能开始解码
+    gop: int = 25
+    bitrate: str = '600k'
+    preset: str = 'ultrafast'
+
+
+def read_box(stream) -> Optional[bytes]:
+    """
+    从mp4字节流中读取一个完整的box(包含头部)，流结束时返回None
+    """
+    header = stream.read(8)
+    if len(header) < 8:
+        return None
+    size, = struct.unpack('>I', header[:4])
+    if size == 1:
+        large = stream.read(8)
+        header += large
+        size, = struct.unpack('>Q', large)
+    body = stream.read(size - len(header))
+    return header + body
+
+
+def contains_idr(mdat: bytes) -> bool:
+    """
+    mdat中的H.264数据为4字节长度前缀的NAL单元，类型5为IDR帧
+    """
+    offset = 8
+    while offset + 5 <= len(mdat):
+        length, = struct.unpack('>I', mdat[offset:offset + 4])
+        if mdat[offset + 4] & 0x1f == 5:
+            return True
+        offset += 4 + length
+    return False
+
+
+class Mp4Subscriber:
+    """
+    单个客户端的fragment队列，队列满时丢弃并等待下一个关键帧再继续，保证客户端始终能够解码
+    """
+
+    def __init__(self, maxsize=25):
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.waiting_keyframe = True
+        self.dropped = 0
+
+    def offer(self, fragment: bytes, keyframe: bool):
+        if self.waiting_keyframe and not keyframe:
+            self.dropped += 1
+            return
+        if self.queue.full():
+            self.waiting_keyframe = True
+            self.dropped += 1
+            return
+        self.waiting_keyframe = False
+        self.queue.put_nowait(fragment)
+
+    async def get(self) -> bytes:
+        return await self.queue.get()
+
+
+class FragmentedMp4Stream:
+    """
+    使用ffmpeg(libx264, zerolatency)将播放流编码为fragmented mp4，每帧一个fragment。
+    新客户端先收到init segment(ftyp + moov)，之后从下一个关键帧开始接收moof + mdat
+    """
+
+    def __init__(self, profile: H264Profile, client_buffer=25):
+        self.profile = profile
+        self.client_buffer = client_buffer
+        self.subscribers: Set[Mp4Subscriber] = set()
+        self.process: Optional[subprocess.Popen] = None
+        self.frames = queue.Queue(maxsize=profile.fps)
+        self.init_segment: Optional[bytes] = None
+        self._init_ready: Optional[asyncio.Event] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.dropped_frames = 0
+
+    @property
+    def init_ready(self) -> asyncio.Event:
+        # 在事件循环中第一次使用时创建，流对象在模块导入时构建，此时还没有运行中的事件循环
+        if self._init_ready is None:
+            self._init_ready = asyncio.Event()
+        return self._init_ready
+
+    def command(self, width, height) -> List[str]:
+        scale = f"scale='min({self.profile.max_width},iw)':'min({self.profile.max_height},ih)'" \
+                f":force_original_aspect_ratio=decrease:force_divisible_by=2"
+        return [
+            'ffmpeg', '-loglevel', 'error',
+            '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(self.profile.fps),
+            '-i', 'pipe:0',
+            '-vf', scale,
+            '-c:v', 'libx264', '-preset', self.profile.preset, '-tune', 'zerolatency',
+            '-profile:v', 'baseline', '-pix_fmt', 'yuv420p',
+            '-g', str(self.profile.gop), '-keyint_min', str(self.profile.gop), '-sc_threshold', '0',
+            '-b:v', self.profile.bitrate, '-maxrate', self.profile.bitrate, '-bufsize', self.profile.bitrate,
+            '-f', 'mp4', '-movflags', 'frag_keyframe+empty_moov+default_base_moof',
+            '-frag_duration', str(1_000_000 // self.profile.fps),
+            'pipe:1',
+        ]
+
+    def start(self, width, height):
+        self.loop = asyncio.get_running_loop()
+        self.init_segment = None
+        self.init_ready.clear()
+        self.frames = queue.Queue(maxsize=self.profile.fps)
+        self.process = subprocess.Popen(
+            self.command(width, height), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        )
+        threading.Thread(target=self._write, args=(self.process, self.frames), daemon=True).start()
+        threading.Thread(target=self._read, args=(self.process,), daemon=True).start()
+
+    def stop(self):
+        if self.process is not None:
+            # 在事件循环中调用，不能阻塞在已满的队列上: 丢弃未编码的帧后放入结束标记
+            while True:
+                try:
+                    self.frames.get_nowait()
+                except queue.Empty:
+                    break
+            try:
+                self.frames.put_nowait(None)
+            except queue.Full:
+                self.process.kill()
+            self.process = None
+
+    def subscribe(self) -> Mp4Subscriber:
+        subscriber = Mp4Subscriber(self.client_buffer)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Mp4Subscriber):
+        self.subscribers.discard(subscriber)
+        if not self.subscribers:
+            # 没有客户端时关闭编码器
+            self.stop()
+
+    def feed(self, image: np.ndarray):
+        """
+        image: C连续的BGR图像，同一个流中尺寸必须保持不变
+        """
+        assert image.flags['C_CONTIGUOUS'], "frames must be C-contiguous BGR"
+        if self.process is None:
+            height, width = image.shape[:2]
+            self.start(width, height)
+        try:
+            self.frames.put_nowait(image)
+        except queue.Full:
+            # 编码器跟不上时丢帧，不阻塞事件循环
+            self.dropped_frames += 1
+
+    @staticmethod
+    def _write(process: subprocess.Popen, frames: queue.Queue):
+        while True:
+            image = frames.get()
+            if image is None:
+                break
+            try:
+                process.stdin.write(image.data)
+            except (BrokenPipeError, ValueError):
+                break
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        process.wait()
+
+    def _read(self, process: subprocess.Popen):
+        init = b''
+        moof = None
+        while True:
+            box = read_box(process.stdout)
+            if box is None:
+                break
+            box_type = box[4:8]
+            if box_type in (b'ftyp', b'moov'):
+                init += box
+                if box_type == b'moov':
+                    self.loop.call_soon_threadsafe(self._set_init, process, init)
+            elif box_type == b'moof':
+                moof = box
+            elif box_type == b'mdat' and moof is not None:
+                self.loop.call_soon_threadsafe(self._dispatch, process, moof + box, contains_idr(box))
+                moof = None
+
+    def _set_init(self, process, init: bytes):
+        if process is self.process:
+            self.init_segment = init
+            self.init_ready.set()
+
+    def _dispatch(self, process, fragment: bytes, keyframe: bool):
+        if process is not self.process:
+            return
+        for subscriber in list(self.subscribers):
+            subscriber.offer(fragment, keyframe)
+
+    async def iter_segments(self, subscriber: Mp4Subscriber):
+        """
+        依次产出init segment以及之后的fragment
+        """
+        await self.init_ready.wait()
+        yield self.init_segment
+        while True:
+            yield await subscriber.get()
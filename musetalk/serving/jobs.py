@@ -0,0 +1,285 @@
+import time
+import heapq
+import uuid
+import itertools
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Literal, Optional
+
+
+class AdmissionRejected(Exception):
+    """
+    预计渲染时间超过服务能力，请求被拒绝
+    """
+
+
+@dataclass
+class Job:
+    text: str
+    # 数值越小越先执行，fifo模式下忽略
+    priority: int = 0
+    job_id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    # queued -> running -> done | cancelled | failed
+    status: str = 'queued'
+    # 预计渲染耗时(秒)，由AdmissionController估计
+    cost: float = 0.0
+    frames: int = 0
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    # 第一帧语音被播放的时间
+    first_frame_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    cancel_event: threading.Event = field(default_factory=threading.Event, repr=False)
+    admitted: bool = False
+
+    def mark_first_frame(self, played_at: float):
+        self.first_frame_at = played_at
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ('done', 'cancelled', 'failed')
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.job_id,
+            "text": self.text,
+            "priority": self.priority,
+            "status": self.status,
+            "frames": self.frames,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "first_frame_at": self.first_frame_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class AdmissionController:
+    """
+    所有avatar共享的准入控制: 按文本长度估计语音帧数，乘以实测的每帧渲染耗时得到预计渲染时间，
+    已接收但未完成的任务的预计渲染时间之和超过max_backlog_seconds时按policy处理
+
+    policy: reject 直接拒绝新请求
+            queue  接收请求，但任务在开始渲染前等待积压降到阈值以下
+    """
+
+    def __init__(
+            self,
+            max_backlog_seconds=30.0,
+            policy: Literal['reject', 'queue'] = 'reject',
+            seconds_per_char=0.25,
+            fps=25,
+    ):
+        self.max_backlog_seconds = max_backlog_seconds
+        self.policy = policy
+        self.seconds_per_char = seconds_per_char
+        self.fps = fps
+        # 每帧渲染耗时的滑动平均，初始按实时估计
+        self.frame_cost = 1 / fps
+        self.backlog = 0.0
+        self.rejected = 0
+        self.cond = threading.Condition()
+
+    def estimate(self, text: str) -> float:
+        frames = max(len(text.strip()), 1) * self.seconds_per_char * self.fps
+        return frames * self.frame_cost
+
+    def submit(self, job: Job):
+        """
+        在请求线程中调用，reject模式下超过阈值时抛出AdmissionRejected
+        """
+        job.cost = self.estimate(job.text)
+        if self.policy == 'queue':
+            return
+        with self.cond:
+            # 空闲时总是接收，避免单个长文本永远无法执行
+            if self.backlog > 0 and self.backlog + job.cost > self.max_backlog_seconds:
+                self.rejected += 1
+                raise AdmissionRejected(
+                    f"projected backlog {self.backlog + job.cost:.1f}s exceeds {self.max_backlog_seconds:.1f}s"
+                )
+            self.backlog += job.cost
+            job.admitted = True
+
+    def acquire(self, job: Job) -> bool:
+        """
+        在渲染线程中调用，queue模式下等待积压降到阈值以下。任务在等待期间被取消时返回False
+        """
+        with self.cond:
+            while not job.admitted:
+                if job.cancel_event.is_set():
+                    return False
+                if self.backlog == 0 or self.backlog + job.cost <= self.max_backlog_seconds:
+                    self.backlog += job.cost
+                    job.admitted = True
+                else:
+                    self.cond.wait(timeout=0.1)
+            return True
+
+    def release(self, job: Job, elapsed: Optional[float] = None):
+        with self.cond:
+            if job.admitted:
+                self.backlog = max(self.backlog - job.cost, 0.0)
+                job.admitted = False
+            if elapsed is not None and job.frames > 0:
+                self.frame_cost = 0.8 * self.frame_cost + 0.2 * elapsed / job.frames
+            self.cond.notify_all()
+
+    def stats(self) -> dict:
+        with self.cond:
+            return {
+                "backlog_seconds": self.backlog,
+                "frame_cost": self.frame_cost,
+                "rejected": self.rejected,
+            }
+
+
+class JobQueue:
+    """
+    单个avatar的任务队列，由一个渲染线程依次执行，同一时刻只有一个任务在使用avatar
+
+    policy: fifo 按提交顺序执行
+            priority 按priority从小到大执行，相同priority按提交顺序
+    """
+
+    def __init__(
+            self,
+            avatar,
+            admission: AdmissionController,
+            policy: Literal['fifo', 'priority'] = 'fifo',
+            batch_size=4,
+            history=256,
+    ):
+        self.avatar = avatar
+        self.admission = admission
+        self.policy = policy
+        self.batch_size = batch_size
+        self.history = history
+        self.heap = []
+        self.counter = itertools.count()
+        # 最近的任务，用于查询状态
+        self.jobs = OrderedDict()
+        self.current: Optional[Job] = None
+        self.cond = threading.Condition()
+        self.completed = 0
+        self.cancelled = 0
+        self.failed = 0
+        self.thread = threading.Thread(target=self._run, name=f'jobs-{avatar.avatar_id}', daemon=True)
+        self.thread.start()
+
+    def __len__(self):
+        return self.depth()
+
+    def depth(self) -> int:
+        with self.cond:
+            return sum(1 for _, _, job in self.heap if not job.finished)
+
+    def submit(self, text: str, priority=0, interrupt=False) -> Job:
+        """
+        interrupt: 打断当前正在说的话并取消所有排队的任务(barge-in)，新任务立即开始
+        """
+        job = Job(text, priority if self.policy == 'priority' else 0)
+        self.admission.submit(job)
+        with self.cond:
+            if interrupt:
+                for _, _, queued in self.heap:
+                    self._cancel(queued)
+                self.heap.clear()
+                if self.current is not None and not self.current.finished:
+                    self._cancel(self.current, flush=True)
+                else:
+                    # 上一个任务已渲染完但仍在播放
+                    self.avatar.frame_buffer.flush()
+            heapq.heappush(self.heap, (job.priority, next(self.counter), job))
+            self.jobs[job.job_id] = job
+            while len(self.jobs) > self.history:
+                self.jobs.popitem(last=False)
+            self.cond.notify_all()
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self.cond:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        取消排队或正在执行的任务，已结束或不存在时返回False
+        """
+        with self.cond:
+            job = self.jobs.get(job_id)
+            if job is None or job.finished:
+                return False
+            self._cancel(job)
+            self.cond.notify_all()
+            return True
+
+    def _cancel(self, job: Job, flush=False):
+        """
+        flush: 打断时为True，无论当前任务是否已开始出帧都清空播放缓冲(包括上一个任务仍在播放的帧)；
+               普通取消时只有当前任务已有帧进入缓冲才清空，任务仍在合成语音时让上一个任务播放完
+        """
+        if job.finished:
+            return
+        if job is self.current:
+            self.avatar.cancel_utterance(job.cancel_event, flush)
+        else:
+            job.cancel_event.set()
+            job.status = 'cancelled'
+            job.finished_at = time.time()
+            self.cancelled += 1
+            self.admission.release(job)
+
+    def _next_job(self) -> Job:
+        with self.cond:
+            while True:
+                while self.heap:
+                    _, _, job = heapq.heappop(self.heap)
+                    if not job.finished:
+                        self.current = job
+                        return job
+                self.cond.wait()
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            if not self.admission.acquire(job):
+                self._finish(job, 'cancelled')
+                continue
+            job.status = 'running'
+            job.started_at = time.time()
+            try:
+                job.frames = self.avatar.inference(
+                    None, job.text, self.batch_size, cancel=job.cancel_event, requested_at=job.created_at,
+                    on_first_frame=job.mark_first_frame,
+                ) or 0
+            except Exception as e:
+                job.error = repr(e)
+                self._finish(job, 'failed')
+            else:
+                self._finish(job, 'cancelled' if job.cancel_event.is_set() else 'done')
+
+    def _finish(self, job: Job, status: str):
+        elapsed = time.time() - job.started_at if job.started_at is not None and status == 'done' else None
+        self.admission.release(job, elapsed)
+        with self.cond:
+            job.status = status
+            job.finished_at = time.time()
+            if status == 'done':
+                self.completed += 1
+            elif status == 'cancelled':
+                self.cancelled += 1
+            else:
+                self.failed += 1
+            self.current = None
+
+    def stats(self) -> dict:
+        with self.cond:
+            return {
+                "depth": sum(1 for _, _, job in self.heap if not job.finished),
+                "running": self.current.job_id if self.current is not None else None,
+                "completed": self.completed,
+                "cancelled": self.cancelled,
+                "failed": self.failed,
+            }
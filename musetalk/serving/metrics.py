@@ -0,0 +1,193 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager, nullcontext
+from typing import Callable, ContextManager, Dict, Iterable, List, Optional, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric:
+    """
+    Prometheus风格的指标，按标签值分别计数，只在采集时整理成文本，记录本身只是一次加锁的加法
+    """
+    type = 'untyped'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def samples(self) -> List[list]:
+        with self.lock:
+            return [[self.name, dict(zip(self.labelnames, key)), value] for key, value in self.values.items()]
+
+    def collect(self) -> dict:
+        """
+        return: 可以跨进程传递的指标族，由render输出
+        """
+        return {"name": self.name, "type": self.type, "help": self.help, "samples": self.samples()}
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1.0, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self.lock:
+            if key not in self.values:
+                # 每个桶的计数(非累计)、总和、总数
+                self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry = self.values[key]
+            entry[0][bisect.bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self) -> List[list]:
+        samples = []
+        with self.lock:
+            for key, (counts, total, count) in self.values.items():
+                labels = dict(zip(self.labelnames, key))
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    samples.append([f'{self.name}_bucket', {**labels, "le": le}, cumulative])
+                samples.append([f'{self.name}_sum', labels, total])
+                samples.append([f'{self.name}_count', labels, count])
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+        self.lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, help, labelnames, **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, help, labelnames, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._get_or_create(Counter, name, help, labelnames)
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, help, labelnames)
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, help, labelnames, buckets=buckets)
+
+    def collect(self) -> List[dict]:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return [metric.collect() for metric in metrics]
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    'musetalk_stage_seconds', 'Latency of each serving stage', ['stage'],
+)
+TIME_TO_FIRST_FRAME = REGISTRY.histogram(
+    'musetalk_time_to_first_frame_seconds', 'Time from request to the first played speech frame', ['avatar'],
+    buckets=(0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 10.0, 30.0),
+)
+
+
+# 采集profile期间由profiler设置(torch.profiler.record_function)，为每个阶段加上标注，平时为None
+_annotate: Optional[Callable[[str], ContextManager]] = None
+
+
+def set_annotation(annotate: Optional[Callable[[str], ContextManager]]):
+    global _annotate
+    _annotate = annotate
+
+
+@contextmanager
+def stage(name: str, sync: Optional[Callable[[], None]] = None):
+    """
+    记录一个阶段的耗时到musetalk_stage_seconds
+    sync: 结束计时前调用，例如torch.cuda.synchronize，使异步执行的GPU阶段计入正确的耗时
+    """
+    start = time.perf_counter()
+    annotation = _annotate(name) if _annotate is not None else nullcontext()
+    try:
+        with annotation:
+            yield
+    finally:
+        if sync is not None:
+            sync()
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=name)
+
+
+def family(name: str, type: str, help: str, samples: Iterable[Tuple[dict, float]]) -> dict:
+    """
+    由采集时才读取的统计值(如各组件的stats())构造指标族
+    """
+    return {"name": name, "type": type, "help": help, "samples": [[name, labels, value] for labels, value in samples]}
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value) -> str:
+    if value is None:
+        return 'NaN'
+    value = float(value)
+    if value == float('inf'):
+        return '+Inf'
+    if value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def render(families: Iterable[dict]) -> str:
+    """
+    按Prometheus文本格式(0.0.4)输出，同名的指标族(例如来自不同进程)合并输出
+    """
+    merged: Dict[str, dict] = {}
+    for item in families:
+        if item["name"] in merged:
+            merged[item["name"]]["samples"].extend(item["samples"])
+        else:
+            merged[item["name"]] = {**item, "samples": list(item["samples"])}
+    lines = []
+    for item in merged.values():
+        lines.append(f'# HELP {item["name"]} {item["help"]}')
+        lines.append(f'# TYPE {item["name"]} {item["type"]}')
+        for name, labels, value in item["samples"]:
+            if labels:
+                label_text = ','.join(f'{key}="{_escape(str(val))}"' for key, val in labels.items())
+                lines.append(f'{name}{{{label_text}}} {_format_value(value)}')
+            else:
+                lines.append(f'{name} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
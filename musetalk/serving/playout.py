@@ -0,0 +1,228 @@
+import time
+import asyncio
+import threading
+from collections import deque
+from dataclasses import dataclass, replace
+from typing import Callable, Literal, Optional
+
+import numpy as np
+
+
+@dataclass
+class PlayoutFrame:
+    # BGR，C连续
+    image: np.ndarray
+    # 在avatar的frame_cycle中的序号
+    index: int
+    idle: bool
+    # 播放时钟的节拍序号，由PlayoutEngine赋值
+    sequence: int = -1
+    # 该帧时长内的16位PCM音频，待机帧为None
+    audio: Optional[np.ndarray] = None
+    # 只有每段语音的第一帧携带: 请求到达的时间(time.time())及该帧播放时的回调，用于统计首帧延迟。
+    # 上一段语音仍在播放时新语音的帧排在其后，因此不能在开始渲染时记录在avatar上
+    requested_at: Optional[float] = None
+    on_first_frame: Optional[Callable[[float], None]] = None
+
+    def __post_init__(self):
+        # 帧在各阶段之间不做拷贝和通道翻转，要求生产者直接给出C连续的BGR图像
+        assert self.image.flags['C_CONTIGUOUS'], "PlayoutFrame.image must be C-contiguous BGR"
+
+
+# get_nowait在语音的帧全部取完且生产者已调用end时返回，此时语音已结束
+UTTERANCE_END = object()
+
+
+class FrameRingBuffer:
+    """
+    推理线程(生产者)与播放协程(消费者)之间的有界帧缓冲
+
+    overrun: block 缓冲满时阻塞生产者，对推理形成背压
+             drop  缓冲满时丢弃最旧的帧
+    """
+
+    def __init__(self, capacity=50, overrun: Literal['block', 'drop'] = 'block'):
+        self.capacity = capacity
+        self.overrun = overrun
+        self.frames = deque()
+        self.cond = threading.Condition()
+        # active: 一段语音从start到被播放完之间为True; finished: 生产者已调用end
+        self.active = False
+        self.finished = False
+        # flush时递增，用于唤醒并作废阻塞中的put
+        self.generation = 0
+        self.overruns = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def start(self) -> bool:
+        """
+        return: 上一段语音是否仍未播放完，是则新语音的帧紧接在其后
+        """
+        with self.cond:
+            continuing = self.active
+            self.active = True
+            self.finished = False
+            return continuing
+
+    def end(self):
+        with self.cond:
+            self.finished = True
+
+    def put(self, frame: PlayoutFrame, generation: Optional[int] = None) -> bool:
+        """
+        generation: 语音开始时的generation，此后缓冲被flush过则不再接收该语音的帧
+        return: 帧是否被接收，缓冲已被flush时返回False
+        """
+        with self.cond:
+            if generation is None:
+                generation = self.generation
+            elif generation != self.generation:
+                return False
+            if len(self.frames) >= self.capacity:
+                self.overruns += 1
+                if self.overrun == 'drop':
+                    self.frames.popleft()
+                else:
+                    self.cond.wait_for(
+                        lambda: len(self.frames) < self.capacity or self.generation != generation
+                    )
+                    if self.generation != generation:
+                        return False
+            self.frames.append(frame)
+            return True
+
+    def get_nowait(self):
+        """
+        return: 下一帧；缓冲为空时返回None，语音的帧已全部取完时结束该语音并返回UTTERANCE_END。
+        判断与结束在同一次加锁中完成，不会结束生产者随后start的新语音
+        """
+        with self.cond:
+            if not self.frames:
+                if self.active and self.finished:
+                    self.active = False
+                    return UTTERANCE_END
+                return None
+            frame = self.frames.popleft()
+            self.cond.notify_all()
+            return frame
+
+    def flush(self):
+        """
+        丢弃所有未播放的帧并结束当前语音
+        """
+        with self.cond:
+            self.frames.clear()
+            self.active = False
+            self.finished = False
+            self.generation += 1
+            self.cond.notify_all()
+
+
+class PlayoutEngine:
+    """
+    按单调时钟以固定帧率输出帧，说话时从FrameRingBuffer取帧，否则输出待机帧
+
+    jitter_depth: 一段语音开始播放前需要缓冲的帧数，缓冲期间继续播放待机帧
+    underrun: 说话过程中缓冲为空时的处理，hold 重复上一帧，idle 插入待机帧
+    """
+
+    def __init__(
+            self,
+            buffer: FrameRingBuffer,
+            idle_frame: Callable[[], PlayoutFrame],
+            on_played: Optional[Callable[[PlayoutFrame], None]] = None,
+            fps=25,
+            jitter_depth=5,
+            underrun: Literal['hold', 'idle'] = 'hold',
+    ):
+        self.buffer = buffer
+        self.idle_frame = idle_frame
+        self.on_played = on_played
+        self.fps = fps
+        self.interval = 1 / fps
+        self.jitter_depth = min(jitter_depth, buffer.capacity)
+        self.underrun = underrun
+        self.speaking = False
+        self.last_frame: Optional[PlayoutFrame] = None
+        self.frames_played = 0
+        self.speech_frames = 0
+        self.underruns = 0
+        self.deadline_misses = 0
+        self.clock_start = None
+        self.tick = 0
+        # 最近一秒内各帧的输出时间，用于计算实际帧率
+        self.played_at = deque(maxlen=fps + 1)
+
+    def reset_clock(self):
+        """
+        重新以当前时间作为时钟起点，在消费者暂停后恢复时调用，避免把暂停时间计为deadline miss
+        """
+        self.clock_start = None
+
+    def next_frame(self) -> PlayoutFrame:
+        frame = None
+        if self.buffer.active:
+            if not self.speaking and (len(self.buffer) >= self.jitter_depth or self.buffer.finished):
+                self.speaking = True
+            if self.speaking:
+                frame = self.buffer.get_nowait()
+                if frame is UTTERANCE_END:
+                    # 语音播放完毕
+                    self.speaking = False
+                    frame = None
+                elif frame is None:
+                    self.underruns += 1
+                    if self.underrun == 'hold' and self.last_frame is not None:
+                        # 重复画面但不重复声音，也不重复首帧的统计
+                        frame = replace(self.last_frame, audio=None, requested_at=None, on_first_frame=None)
+                else:
+                    self.speech_frames += 1
+                    self.last_frame = frame
+        elif self.speaking:
+            # 缓冲被flush
+            self.speaking = False
+        if frame is None:
+            frame = self.idle_frame()
+        frame.sequence = self.tick
+        if self.on_played is not None:
+            self.on_played(frame)
+        self.frames_played += 1
+        self.played_at.append(time.monotonic())
+        return frame
+
+    async def frames(self):
+        while True:
+            now = time.monotonic()
+            if self.clock_start is None:
+                self.clock_start = now - self.tick * self.interval
+            lag = now - (self.clock_start + self.tick * self.interval)
+            if lag >= self.interval:
+                # 落后一帧以上时跳过错过的节拍，不连续补发
+                missed = int(lag // self.interval)
+                self.deadline_misses += missed
+                self.tick += missed
+            yield self.next_frame()
+            self.tick += 1
+            # 消费者在yield期间可能调用了reset_clock
+            if self.clock_start is not None:
+                delay = self.clock_start + self.tick * self.interval - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+    def fps_achieved(self) -> float:
+        if len(self.played_at) < 2:
+            return 0.0
+        return (len(self.played_at) - 1) / max(self.played_at[-1] - self.played_at[0], 1e-6)
+
+    def stats(self) -> dict:
+        return {
+            "fps": self.fps_achieved(),
+            "frames_played": self.frames_played,
+            "speech_frames": self.speech_frames,
+            "underruns": self.underruns,
+            "overruns": self.buffer.overruns,
+            "deadline_misses": self.deadline_misses,
+            "buffered_frames": len(self.buffer),
+        }
@@ -0,0 +1,210 @@
+import os
+import sys
+import time
+import threading
+from pathlib import Path
+from collections import Counter
+from contextlib import contextmanager
+from typing import Optional
+
+from musetalk.serving.metrics import set_annotation
+
+
+class ProfileCapture:
+    """
+    一次profile采集: 按秒数或按推理batch数结束
+
+    torch_trace: 在推理线程中记录torch.profiler，输出chrome trace(可在chrome://tracing或perfetto中打开)
+    python: 在后台线程中对所有线程的python调用栈采样，输出folded stacks(flamegraph.pl或speedscope可直接读取)
+    """
+
+    def __init__(self, output_dir: Path, seconds=None, batches=None, torch_trace=True, python=True, interval=0.005):
+        self.output_dir = output_dir
+        self.seconds = seconds
+        self.batches = batches
+        self.torch_trace = torch_trace
+        self.python = python
+        self.interval = interval
+        self.started_at = time.monotonic()
+        self.prefix = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        self.batches_done = 0
+        self.torch_profile = None
+        # 启动torch.profiler的推理线程，stop必须在同一线程中调用
+        self.torch_thread: Optional[int] = None
+        self.torch_finished = not torch_trace
+        self.stacks = Counter()
+        self.samples = 0
+        self.artifacts = []
+
+    def due(self) -> bool:
+        if self.batches is not None:
+            return self.batches_done >= self.batches
+        return time.monotonic() - self.started_at >= self.seconds
+
+    @property
+    def torch_path(self) -> Path:
+        return self.output_dir / f'{self.prefix}-torch.json'
+
+    def owns_torch(self) -> bool:
+        return self.torch_profile is not None and self.torch_thread == threading.get_ident()
+
+    def start_torch(self):
+        if self.torch_profile is not None or self.torch_finished:
+            return
+        import torch
+        from torch.profiler import profile, record_function, ProfilerActivity
+
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        self.torch_profile = profile(activities=activities)
+        self.torch_profile.start()
+        self.torch_thread = threading.get_ident()
+        # 采集期间各阶段(unet、vae、composite、encode)以record_function标注
+        set_annotation(record_function)
+
+    def finish_torch(self):
+        """
+        只能在启动torch.profiler的推理线程中调用，或在torch.profiler未启动时调用
+        """
+        assert self.torch_profile is None or self.owns_torch(), "torch.profiler must be stopped on its own thread"
+        set_annotation(None)
+        if self.torch_profile is not None:
+            self.torch_profile.stop()
+            self.torch_profile.export_chrome_trace(str(self.torch_path))
+            self.artifacts.append(str(self.torch_path))
+            self.torch_profile = None
+        self.torch_finished = True
+
+    def sample_python(self):
+        """
+        按interval对其它线程的调用栈采样，直到采集结束
+        """
+        current = threading.get_ident()
+        while not self.due():
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == current:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def write_python(self):
+        path = self.output_dir / f'{self.prefix}-python.folded'
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        self.artifacts.append(str(path))
+
+
+class Profiler:
+    """
+    按需采集profile，进程内只有一个实例(PROFILER)。未采集时推理路径上只有一次属性判断
+    """
+
+    def __init__(self, stop_timeout=5.0):
+        """
+        stop_timeout: 采集结束后等待推理线程停止torch.profiler的时间
+        """
+        self.capture: Optional[ProfileCapture] = None
+        # 已结束但torch.profiler仍等待推理线程停止的采集
+        self.stopping: Optional[ProfileCapture] = None
+        self.stop_timeout = stop_timeout
+        self.lock = threading.Lock()
+
+    def _stop_torch(self, capture: ProfileCapture):
+        if capture.due() and capture.owns_torch():
+            capture.finish_torch()
+            if self.stopping is capture:
+                self.stopping = None
+
+    @contextmanager
+    def batch(self):
+        """
+        包裹推理线程中的每个batch，torch.profiler由同一个推理线程在batch之间启动和停止:
+        采集期间第一个进入batch的线程启动，达到batches后或按秒采集到期后的下一个batch开始前停止
+        """
+        capture = self.capture or self.stopping
+        if capture is None:
+            yield
+            return
+        with self.lock:
+            self._stop_torch(capture)
+            if capture is self.capture and not capture.due():
+                capture.start_torch()
+        try:
+            yield
+        finally:
+            with self.lock:
+                if capture is self.capture:
+                    capture.batches_done += 1
+                self._stop_torch(capture)
+
+    def run(
+            self, output_dir='profiles', seconds: Optional[float] = None, batches: Optional[int] = None,
+            torch_trace=True, python=True, timeout=120.0,
+    ) -> dict:
+        """
+        阻塞直到采集结束，返回生成的文件。按batch采集时超过timeout仍未完成则提前结束
+        """
+        if seconds is None and batches is None:
+            seconds = 10.0
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        capture = ProfileCapture(output_dir, seconds, batches, torch_trace, python)
+        with self.lock:
+            if self.capture is not None:
+                raise RuntimeError("a profile capture is already running")
+            if self.stopping is not None:
+                raise RuntimeError("the previous torch trace is still waiting for the inference thread to stop it")
+            self.capture = capture
+        sampler = None
+        if python:
+            sampler = threading.Thread(target=capture.sample_python, name='profiler-sampler', daemon=True)
+            sampler.start()
+        deadline = time.monotonic() + timeout
+        while not capture.due() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        timed_out = not capture.due()
+        if timed_out:
+            capture.batches = capture.batches_done
+        # torch.profiler只能由启动它的推理线程停止，等待它在下一个batch前后停止。
+        # 推理已空闲时不在这里停止，交给推理线程的下一个batch，文件名在pending中返回
+        deadline = time.monotonic() + self.stop_timeout
+        while time.monotonic() < deadline:
+            with self.lock:
+                if capture.torch_finished or capture.torch_profile is None:
+                    break
+            time.sleep(0.05)
+        pending = []
+        with self.lock:
+            if capture.torch_profile is None:
+                if not capture.torch_finished:
+                    capture.finish_torch()
+            else:
+                self.stopping = capture
+                pending.append(str(capture.torch_path))
+            self.capture = None
+        if sampler is not None:
+            # sampler在due()后自行退出，超时时以batches_done为准强制结束
+            capture.batches = capture.batches_done
+            sampler.join()
+            capture.write_python()
+        return {
+            "artifacts": capture.artifacts,
+            "pending": pending,
+            "seconds": time.monotonic() - capture.started_at,
+            "batches": capture.batches_done,
+            "python_samples": capture.samples,
+            "timed_out": timed_out,
+        }
+
+
+PROFILER = Profiler()
@@ -0,0 +1,186 @@
+import time
+from typing import Optional
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from musetalk.serving.playout import PlayoutFrame
+
+HEADER_DTYPE = np.dtype([
+    ('write_seq', '<u8'),
+    ('heartbeat', '<f8'),
+    # 渲染线程的心跳及其是否正在渲染，读者最近一次取帧的时间
+    ('render_heartbeat', '<f8'),
+    ('read_heartbeat', '<f8'),
+    ('rendering', '<u1'),
+    ('slots', '<u4'),
+    ('height', '<u4'),
+    ('width', '<u4'),
+    ('audio_samples', '<u4'),
+    ('active', '<u1'),
+], align=True)
+
+SLOT_DTYPE = np.dtype([
+    ('version', '<u8'),
+    ('seq', '<u8'),
+    ('index', '<i8'),
+    ('tick', '<i8'),
+    ('audio_len', '<u4'),
+    ('idle', '<u1'),
+], align=True)
+
+
+def _align(offset, alignment=64):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+class SharedFrameRing:
+    """
+    共享内存中的BGR帧(及其音频)环形缓冲，一个写者(推理进程)、多个读者(前端进程)。
+
+    每个槽位使用seqlock: 写入期间version为奇数，读者拷贝帧后再比较version，帧在拷贝期间被覆盖时放弃该帧。
+    读出的帧会被编码线程池和H.264队列持有任意长的时间，因此必须拷贝，不能把共享内存的视图交给下游:
+    seqlock只能在读完之后发现撕裂，返回视图时写者绕回该槽位会在下游编码途中改写画面，且无法再检测到。
+    避免拷贝需要槽位租约(读者引用计数，写者跳过被占用的槽位)，写者就要等待最慢的读者。
+    一帧1080p约6MB，按内存带宽估计拷贝约1ms，相对40ms的帧间隔可以接受，实际耗时用scripts/benchmark_shm.py测量
+    """
+
+    def __init__(self, name: str, slots=16, height=0, width=0, create=False, audio_samples=640):
+        """
+        audio_samples: 每帧音频的最大采样数
+        """
+        if create:
+            header_size = _align(HEADER_DTYPE.itemsize)
+            meta_size = _align(SLOT_DTYPE.itemsize * slots)
+            audio_size = _align(slots * audio_samples * 2)
+            size = header_size + meta_size + audio_size + slots * height * width * 3
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = name
+        self.header = np.ndarray((), dtype=HEADER_DTYPE, buffer=self.shm.buf)
+        if create:
+            self.header['write_seq'] = 0
+            self.header['heartbeat'] = time.monotonic()
+            self.header['render_heartbeat'] = time.monotonic()
+            self.header['read_heartbeat'] = 0.0
+            self.header['rendering'] = 0
+            self.header['slots'] = slots
+            self.header['height'] = height
+            self.header['width'] = width
+            self.header['audio_samples'] = audio_samples
+            self.header['active'] = 0
+        self.slots = int(self.header['slots'])
+        self.height = int(self.header['height'])
+        self.width = int(self.header['width'])
+        self.audio_samples = int(self.header['audio_samples'])
+        offset = _align(HEADER_DTYPE.itemsize)
+        meta = np.ndarray((self.slots,), dtype=SLOT_DTYPE, buffer=self.shm.buf, offset=offset)
+        if create:
+            meta[:] = 0
+        self.versions = meta['version']
+        self.seqs = meta['seq']
+        self.indexes = meta['index']
+        self.ticks = meta['tick']
+        self.audio_lens = meta['audio_len']
+        self.idles = meta['idle']
+        offset += _align(SLOT_DTYPE.itemsize * self.slots)
+        self.audio = np.ndarray((self.slots, self.audio_samples), dtype=np.int16, buffer=self.shm.buf, offset=offset)
+        offset += _align(self.slots * self.audio_samples * 2)
+        self.images = np.ndarray(
+            (self.slots, self.height, self.width, 3), dtype=np.uint8, buffer=self.shm.buf, offset=offset
+        )
+
+    @property
+    def write_seq(self) -> int:
+        """
+        下一帧的序号，即已写入的帧数
+        """
+        return int(self.header['write_seq'])
+
+    @property
+    def heartbeat(self) -> float:
+        return float(self.header['heartbeat'])
+
+    @property
+    def active(self) -> bool:
+        return bool(self.header['active'])
+
+    def write(self, frame: PlayoutFrame, active: bool):
+        """
+        active: 写者是否正在说话，前端据此决定没有客户端时是否继续取帧
+        """
+        assert frame.image.shape == (self.height, self.width, 3), \
+            f"frame shape {frame.image.shape} does not match ring {(self.height, self.width, 3)}"
+        seq = self.write_seq
+        slot = seq % self.slots
+        self.versions[slot] += 1
+        np.copyto(self.images[slot], frame.image)
+        audio_len = 0
+        if frame.audio is not None:
+            audio_len = min(len(frame.audio), self.audio_samples)
+            self.audio[slot, :audio_len] = frame.audio[:audio_len]
+        self.seqs[slot] = seq
+        self.indexes[slot] = frame.index
+        self.ticks[slot] = frame.sequence
+        self.audio_lens[slot] = audio_len
+        self.idles[slot] = frame.idle
+        self.versions[slot] += 1
+        self.header['active'] = active
+        self.header['heartbeat'] = time.monotonic()
+        self.header['write_seq'] = seq + 1
+
+    def touch(self):
+        self.header['heartbeat'] = time.monotonic()
+
+    def render_progress(self, rendering: bool):
+        """
+        由写者的渲染线程在每个batch前调用，rendering为True且心跳超时说明渲染卡住
+        """
+        self.header['render_heartbeat'] = time.monotonic()
+        self.header['rendering'] = rendering
+
+    def render_stalled(self, timeout: float) -> bool:
+        return bool(self.header['rendering']) and time.monotonic() - float(self.header['render_heartbeat']) > timeout
+
+    def mark_read(self):
+        self.header['read_heartbeat'] = time.monotonic()
+
+    def has_reader(self, timeout=1.0) -> bool:
+        """
+        最近timeout秒内是否有读者在取帧，没有读者且不在说话时写者不再生成待机帧
+        """
+        return time.monotonic() - float(self.header['read_heartbeat']) < timeout
+
+    def read(self, seq: int) -> Optional[PlayoutFrame]:
+        """
+        返回序号为seq的帧的拷贝，sequence为写者播放时钟的节拍序号。
+        帧尚未写入、已被覆盖或正在写入时返回None
+        """
+        slot = seq % self.slots
+        version = int(self.versions[slot])
+        if version % 2 or int(self.seqs[slot]) != seq:
+            return None
+        audio_len = int(self.audio_lens[slot])
+        frame = PlayoutFrame(
+            self.images[slot].copy(),
+            int(self.indexes[slot]),
+            bool(self.idles[slot]),
+            sequence=int(self.ticks[slot]),
+            audio=self.audio[slot, :audio_len].copy() if audio_len else None,
+        )
+        # 拷贝完成后再检查version，拷贝期间写者覆盖了该槽位时丢弃撕裂的帧
+        if int(self.versions[slot]) != version:
+            return None
+        return frame
+
+    def close(self):
+        self.header = self.versions = self.seqs = self.indexes = self.ticks = self.audio_lens = self.idles = None
+        self.audio = self.images = None
+        self.shm.close()
+
+    def unlink(self):
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,405 @@
+import time
+import uuid
+import queue
+import asyncio
+import itertools
+import threading
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from common.setting import settings
+from common.tts import get_tts_cache
+from musetalk.serving.jobs import AdmissionController, AdmissionRejected, JobQueue
+from musetalk.serving.metrics import REGISTRY
+from musetalk.serving.profiling import PROFILER
+from musetalk.serving.shm import SharedFrameRing
+
+
+class WorkerCrashed(RuntimeError):
+    """
+    推理进程退出或失去响应，未完成的请求失败
+    """
+
+
+@dataclass(frozen=True)
+class WorkerSpec:
+    avatar_id: str
+    video_path: str
+    bbox_shift: int = 5
+
+
+def create_admission() -> AdmissionController:
+    return AdmissionController(
+        max_backlog_seconds=settings.serving.max_backlog_seconds,
+        policy=settings.serving.admission_policy,
+        seconds_per_char=settings.serving.tts_seconds_per_char,
+        fps=settings.common.fps,
+    )
+
+
+class InProcessService:
+    """
+    在当前进程中推理的avatar服务，与AvatarWorker提供相同的接口
+    """
+
+    def __init__(self, avatar, admission: AdmissionController):
+        self.avatar = avatar
+        self.admission = admission
+        self.jobs = JobQueue(
+            avatar, admission, policy=settings.serving.queue_policy, batch_size=settings.serving.batch_size
+        )
+        self.slots = None
+
+    @property
+    def frame_source(self):
+        return self.avatar
+
+    async def start(self):
+        pass
+
+    async def submit(self, text: str, priority=0, interrupt=False) -> dict:
+        return self.jobs.submit(text, priority=priority, interrupt=interrupt).to_dict()
+
+    async def get_job(self, job_id: str) -> Optional[dict]:
+        job = self.jobs.get(job_id)
+        return job.to_dict() if job is not None else None
+
+    async def cancel(self, job_id: str) -> bool:
+        return self.jobs.cancel(job_id)
+
+    @property
+    def avatar_id(self) -> str:
+        return self.avatar.avatar_id
+
+    @property
+    def sample_rate(self) -> int:
+        return self.avatar.afe.sample_rate
+
+    async def stats(self) -> dict:
+        return avatar_stats(self.avatar, self.jobs, self.admission)
+
+    async def metrics(self) -> list:
+        # 与前端在同一进程，指标已在REGISTRY中
+        return []
+
+    async def profile(self, **kwargs) -> dict:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, lambda: PROFILER.run(**kwargs))
+
+
+def avatar_stats(avatar, jobs: JobQueue, admission: AdmissionController) -> dict:
+    return {
+        "queue": jobs.stats(),
+        "admission": admission.stats(),
+        "playout": avatar.playout.stats(),
+        "caches": {"audio_features": avatar.feature_cache.stats(), "tts": get_tts_cache().stats()},
+    }
+
+
+def _profile(request_id, kwargs, events):
+    try:
+        events.put((request_id, None, PROFILER.run(**kwargs)))
+    except Exception as e:
+        events.put((request_id, repr(e), None))
+
+
+def _serve_commands(jobs: JobQueue, admission: AdmissionController, avatar, commands, events):
+    while True:
+        command = commands.get()
+        if command is None:
+            break
+        op, request_id, kwargs = command
+        if op == 'profile':
+            # 采集耗时较长，在单独的线程中进行，不阻塞其它命令
+            threading.Thread(target=_profile, args=(request_id, kwargs, events), daemon=True).start()
+            continue
+        try:
+            if op == 'submit':
+                try:
+                    result = jobs.submit(**kwargs).to_dict()
+                except AdmissionRejected as e:
+                    result = {"rejected": str(e)}
+            elif op == 'get':
+                job = jobs.get(kwargs['job_id'])
+                result = job.to_dict() if job is not None else None
+            elif op == 'cancel':
+                result = jobs.cancel(kwargs['job_id'])
+            elif op == 'stats':
+                result = avatar_stats(avatar, jobs, admission)
+            elif op == 'metrics':
+                result = REGISTRY.collect()
+            else:
+                raise ValueError(f"unknown command {op}")
+            events.put((request_id, None, result))
+        except Exception as e:
+            events.put((request_id, repr(e), None))
+
+
+async def _playout(avatar, ring: SharedFrameRing):
+    # 播放时钟在推理进程中运行，前端只读取已播放的帧。
+    # 前端没有在取帧(没有观众)且不在说话时不生成待机帧，只更新心跳
+    frames = avatar.next_frame()
+    interval = 1 / settings.common.fps
+    while True:
+        if not avatar.frame_buffer.active and not ring.has_reader():
+            ring.touch()
+            avatar.playout.reset_clock()
+            await asyncio.sleep(interval)
+            continue
+        frame = await frames.__anext__()
+        ring.write(frame, avatar.frame_buffer.active)
+
+
+def worker_main(spec: WorkerSpec, ring_name: str, ring_slots: int, commands, events):
+    """
+    推理进程入口: 加载avatar，把播放帧写入共享内存，在线程中处理前端的命令
+    """
+    import torch
+    from musetalk.avatar import Avatar
+    from musetalk.serving.encoders import frame_slots
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    avatar = Avatar(
+        spec.avatar_id,
+        spec.video_path,
+        spec.bbox_shift,
+        device=device,
+        dtype=torch.float16 if device.type == "cuda" else torch.float32,
+    )
+    height, width = avatar.frame_cycle[0].shape[:2]
+    ring = SharedFrameRing(
+        ring_name, ring_slots, height, width, create=True,
+        audio_samples=avatar.afe.sample_rate // settings.common.fps,
+    )
+    avatar.on_render_progress = ring.render_progress
+    admission = create_admission()
+    jobs = JobQueue(avatar, admission, policy=settings.serving.queue_policy, batch_size=settings.serving.batch_size)
+    threading.Thread(
+        target=_serve_commands, args=(jobs, admission, avatar, commands, events), name='commands', daemon=True
+    ).start()
+    events.put(('ready', None, {"slots": frame_slots(avatar.frame_cycle), "sample_rate": avatar.afe.sample_rate}))
+    asyncio.run(_playout(avatar, ring))
+
+
+class _RingBuffer:
+    # FrameBroadcaster通过frame_buffer.active判断是否正在说话
+    def __init__(self, worker: "AvatarWorker"):
+        self.worker = worker
+
+    @property
+    def active(self) -> bool:
+        return self.worker.ring is not None and self.worker.ring.active
+
+
+class _RemotePlayout:
+    # 播放时钟在推理进程中，前端暂停后恢复时直接跳到最新的帧，不需要重置时钟
+    def reset_clock(self):
+        pass
+
+
+class AvatarWorker:
+    """
+    前端进程中代表一个推理进程: 启动和监控进程，转发任务命令，从共享内存读取播放帧。
+    进程退出或心跳超时(例如卡在CUDA调用中)时重启，重启期间未完成的请求以WorkerCrashed失败
+    """
+
+    def __init__(self, spec: WorkerSpec, ring_slots=16, heartbeat_timeout=5.0, request_timeout=10.0):
+        self.spec = spec
+        self.avatar_id = spec.avatar_id
+        self.ring_slots = ring_slots
+        self.heartbeat_timeout = heartbeat_timeout
+        self.request_timeout = request_timeout
+        self.fps = settings.common.fps
+        self.ctx = mp.get_context('spawn')
+        self.process: Optional[mp.Process] = None
+        self.commands = None
+        self.ring: Optional[SharedFrameRing] = None
+        self.ring_name: Optional[str] = None
+        self.slots = None
+        # 推理进程的音频采样率，在ready事件中给出
+        self.sample_rate: Optional[int] = None
+        self.ready = asyncio.Event()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.pending: Dict[int, asyncio.Future] = {}
+        self.request_ids = itertools.count()
+        self.generation = 0
+        self.restarts = 0
+        self.dropped_frames = 0
+        self.frame_buffer = _RingBuffer(self)
+        self.playout = _RemotePlayout()
+        self.monitor_task: Optional[asyncio.Task] = None
+
+    @property
+    def frame_source(self):
+        return self
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self._spawn()
+        self.monitor_task = asyncio.create_task(self.monitor())
+        await self.ready.wait()
+
+    def _spawn(self):
+        self.generation += 1
+        self.ready.clear()
+        self.ring_name = f"musetalk-{self.avatar_id}-{uuid.uuid4().hex[:8]}"
+        self.commands = self.ctx.Queue()
+        events = self.ctx.Queue()
+        self.process = self.ctx.Process(
+            target=worker_main,
+            args=(self.spec, self.ring_name, self.ring_slots, self.commands, events),
+            name=f"avatar-{self.avatar_id}",
+            daemon=True,
+        )
+        self.process.start()
+        threading.Thread(
+            target=self._read_events, args=(events, self.generation), name=f'events-{self.avatar_id}', daemon=True
+        ).start()
+
+    def _read_events(self, events, generation):
+        while generation == self.generation:
+            try:
+                request_id, error, result = events.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            self.loop.call_soon_threadsafe(self._on_event, generation, request_id, error, result)
+
+    def _on_event(self, generation, request_id, error, result):
+        if generation != self.generation:
+            return
+        if request_id == 'ready':
+            self.ring = SharedFrameRing(self.ring_name)
+            self.slots = result["slots"]
+            self.sample_rate = result["sample_rate"]
+            self.ready.set()
+            return
+        future = self.pending.pop(request_id, None)
+        if future is None or future.done():
+            return
+        if error is not None:
+            future.set_exception(RuntimeError(error))
+        else:
+            future.set_result(result)
+
+    async def request(self, op: str, timeout: Optional[float] = None, **kwargs):
+        await self.ready.wait()
+        request_id = next(self.request_ids)
+        future = self.loop.create_future()
+        self.pending[request_id] = future
+        self.commands.put((op, request_id, kwargs))
+        try:
+            return await asyncio.wait_for(future, timeout or self.request_timeout)
+        finally:
+            self.pending.pop(request_id, None)
+
+    async def submit(self, text: str, priority=0, interrupt=False) -> dict:
+        result = await self.request('submit', text=text, priority=priority, interrupt=interrupt)
+        if "rejected" in result:
+            raise AdmissionRejected(result["rejected"])
+        return result
+
+    async def get_job(self, job_id: str) -> Optional[dict]:
+        return await self.request('get', job_id=job_id)
+
+    async def cancel(self, job_id: str) -> bool:
+        return await self.request('cancel', job_id=job_id)
+
+    async def metrics(self) -> list:
+        """
+        推理进程中记录的指标(各阶段耗时、首帧延迟)
+        """
+        return await self.request('metrics')
+
+    async def profile(self, **kwargs) -> dict:
+        """
+        在推理进程中采集profile，文件写在推理进程的工作目录下
+        """
+        timeout = (kwargs.get('seconds') or kwargs.get('timeout') or 120.0) + self.request_timeout
+        return await self.request('profile', timeout=timeout, **kwargs)
+
+    async def stats(self) -> dict:
+        stats = await self.request('stats')
+        stats["worker"] = {"pid": self.process.pid, "restarts": self.restarts, "dropped_frames": self.dropped_frames}
+        return stats
+
+    def alive(self) -> bool:
+        if not self.process.is_alive():
+            return False
+        # 模型加载期间还没有共享内存，由进程是否存活判断
+        if self.ring is not None and time.monotonic() - self.ring.heartbeat > self.heartbeat_timeout:
+            return False
+        # 播放时钟在单独的线程中，渲染线程卡住时播放心跳仍会更新，需要单独检查渲染心跳
+        if self.ring is not None and self.ring.render_stalled(self.heartbeat_timeout):
+            return False
+        return True
+
+    async def monitor(self, interval=1.0):
+        while True:
+            await asyncio.sleep(interval)
+            if not self.alive():
+                print(f"avatar worker {self.avatar_id} (pid {self.process.pid}) died, restarting")
+                await self.restart()
+
+    async def restart(self):
+        await self.stop()
+        self.restarts += 1
+        self._spawn()
+
+    def _kill(self):
+        if self.process is not None:
+            if self.process.is_alive():
+                self.process.kill()
+            self.process.join(timeout=5)
+
+    async def stop(self):
+        # join最长阻塞5秒，不能在事件循环中等待
+        await asyncio.get_running_loop().run_in_executor(None, self._kill)
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(WorkerCrashed(f"avatar worker {self.avatar_id} exited"))
+        self.pending.clear()
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+        if self.ring_name is not None:
+            # 进程被kill时不会清理自己创建的共享内存
+            try:
+                shm = shared_memory.SharedMemory(name=self.ring_name)
+                shm.close()
+                shm.unlink()
+            except FileNotFoundError:
+                pass
+            self.ring_name = None
+
+    async def shutdown(self):
+        if self.monitor_task is not None:
+            self.monitor_task.cancel()
+        self.generation += 1
+        await self.stop()
+
+    async def next_frame(self):
+        """
+        从共享内存读取推理进程播放的帧，落后超过一圈时跳到最新的帧
+        """
+        ring = None
+        seq = 0
+        while True:
+            if self.ring is None:
+                await self.ready.wait()
+            if self.ring is not ring:
+                ring = self.ring
+                seq = max(ring.write_seq - 1, 0)
+            ring.mark_read()
+            latest = ring.write_seq
+            if seq >= latest:
+                await asyncio.sleep(1 / self.fps / 4)
+                continue
+            if latest - seq > ring.slots // 2:
+                self.dropped_frames += latest - 1 - seq
+                seq = latest - 1
+            frame = ring.read(seq)
+            seq += 1
+            if frame is not None:
+                yield frame
@@ -2,11 +2,22 @@ import json
 import shutil
 import subprocess
 from pathlib import Path
+from typing import TYPE_CHECKING
 
 import torch
 import numpy as np
 from torch import nn
-from accelerate import Accelerator
+
+if TYPE_CHECKING:
+    # accelerate只有训练脚本需要，推理进程不导入
+    from accelerate import Accelerator
+
+
+def stack_batch(batch):
+    # tensor直接在所在设备上stack，避免经过numpy拷贝到cpu
+    if isinstance(batch[0], torch.Tensor):
+        return torch.stack(batch)
+    return torch.Tensor(np.array(batch))
 
 
 def datagen(
@@ -23,10 +34,10 @@ def datagen(
         latent_batch.append(latent)
 
         if len(latent_batch) >= batch_size:
-            yield torch.Tensor(np.array(whisper_batch)), torch.Tensor(np.array(latent_batch))
+            yield stack_batch(whisper_batch), stack_batch(latent_batch)
             whisper_batch, latent_batch = [], []
     if len(latent_batch) > 0:
-        yield torch.Tensor(np.array(whisper_batch)), torch.Tensor(np.array(latent_batch))
+        yield stack_batch(whisper_batch), stack_batch(latent_batch)
 
 
 def images2video(images_dir, output, fps=25):
@@ -58,7 +69,7 @@ def merge_audio_video(video_path, audio_path, output_path):
 
 
 def save_model(
-        checkpoint_infos: dict, accelerator: Accelerator, model: nn.Module,
+        checkpoint_infos: dict, accelerator: "Accelerator", model: nn.Module,
         output_dir: str, train_infos: dict, total_limit=10
 ):
     """
@@ -0,0 +1,88 @@
+"""
+启动耗时压测: 在新的python进程中分别导入各入口模块、运行脚本的--help，统计墙钟时间，
+并用python -X importtime找出累计耗时最长的导入，用于发现重新出现在import阶段的模型加载或重量级依赖:
+
+    python scripts/benchmark_imports.py --repeat 5 --output imports.json
+"""
+import re
+import sys
+import json
+import time
+import statistics
+import subprocess
+from pathlib import Path
+from argparse import ArgumentParser
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+# (名称, python参数)
+TARGETS = [
+    ("import common.setting", ["-c", "import common.setting"]),
+    ("import common.tts", ["-c", "import common.tts"]),
+    ("import musetalk.serving.workers", ["-c", "import musetalk.serving.workers"]),
+    ("import musetalk.datasets", ["-c", "import musetalk.datasets"]),
+    ("import musetalk.avatar", ["-c", "import musetalk.avatar"]),
+    ("import server", ["-c", "import server"]),
+    ("prepare_dataset.py --help", ["scripts/prepare_dataset.py", "--help"]),
+    ("preprocess.py --help", ["scripts/preprocess.py", "--help"]),
+]
+
+IMPORTTIME = re.compile(r'import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+
+def run_once(args) -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable, *args], cwd=REPO_DIR, check=True, capture_output=True)
+    return time.perf_counter() - start
+
+
+def slowest_imports(args, top: int) -> list:
+    """
+    return: 累计耗时最长的顶层导入(只统计被入口直接或间接导入的第一层包)
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', *args], cwd=REPO_DIR, capture_output=True, text=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME.match(line)
+        if match and len(match.group(3)) <= 1:
+            imports.append({"module": match.group(4), "cumulative_ms": int(match.group(2)) / 1000})
+    imports.sort(key=lambda item: item["cumulative_ms"], reverse=True)
+    return imports[:top]
+
+
+def main():
+    parser = ArgumentParser(description="Measure cold-start time of the repo's entry points")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per target, the median is reported")
+    parser.add_argument('--top', type=int, default=10, help="slowest top-level imports to list per target")
+    parser.add_argument('--output', type=str, default=None, help="write the results as json")
+    args = parser.parse_args()
+
+    baseline = statistics.median(run_once(["-c", "pass"]) for _ in range(args.repeat))
+    print(f"{'python -c pass':<36}{baseline * 1000:>10.1f} ms")
+    results = []
+    for name, target in TARGETS:
+        try:
+            seconds = [run_once(target) for _ in range(args.repeat)]
+        except subprocess.CalledProcessError as e:
+            error = e.stderr.decode(errors='replace').strip().splitlines()
+            print(f"{name:<36}{'failed':>10}  {error[-1] if error else ''}")
+            results.append({"target": name, "error": error[-1] if error else str(e)})
+            continue
+        median = statistics.median(seconds)
+        print(f"{name:<36}{median * 1000:>10.1f} ms")
+        results.append({
+            "target": name,
+            "median_seconds": median,
+            "seconds": seconds,
+            "slowest_imports": slowest_imports(target, args.top),
+        })
+    if args.output:
+        Path(args.output).write_text(json.dumps({
+            "python": sys.version,
+            "interpreter_seconds": baseline,
+            "results": results,
+        }, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,466 @@
+"""
+服务压测: 使用随机初始化的小模型和合成的avatar数据在CPU上启动server.py，模拟多个websocket观众和/talk请求，
+输出首帧延迟、帧间抖动、丢帧、吞吐以及各进程的CPU和内存占用。
+
+完全离线运行(tts使用ToneTTSProvider)，结果以json保存，便于在不同提交之间比较。
+观众客户端和uvicorn的/ws都依赖websockets包(requirements.txt):
+
+    python scripts/benchmark_server.py --viewers 8 --rate 0.5 --duration 60 --output bench.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import signal
+import asyncio
+import tempfile
+import subprocess
+import urllib.error
+import urllib.parse
+import urllib.request
+from pathlib import Path
+from argparse import ArgumentParser
+
+import numpy as np
+
+sys.path.append('.')
+
+SENTENCES = [
+    "你好，欢迎来到我们的直播间。",
+    "今天给大家介绍一款新产品，它的续航时间非常长。",
+    "有任何问题都可以在评论区留言。",
+    "感谢大家的支持，我们下次再见。",
+    "这个价格只在今天有效，喜欢的朋友不要错过。",
+]
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+
+def build_models(model_dir: Path):
+    """
+    生成与正式模型输入输出形状一致、但层数和通道数很小的随机模型
+    """
+    import torch
+    from diffusers import AutoencoderKL, UNet2DConditionModel
+    from musetalk.audio.audio_feature_extract import AudioEncoder
+
+    torch.manual_seed(0)
+    dims = {"n_mels": 80, "n_audio_ctx": 1500, "n_audio_state": 384, "n_audio_head": 6, "n_audio_layer": 1}
+    encoder = AudioEncoder(
+        dims["n_mels"], dims["n_audio_ctx"], dims["n_audio_state"], dims["n_audio_head"], dims["n_audio_layer"]
+    )
+    whisper_path = model_dir / 'whisper-tiny-random.pt'
+    torch.save(
+        {"dims": dims, "model_state_dict": {f'encoder.{k}': v for k, v in encoder.state_dict().items()}},
+        whisper_path,
+    )
+
+    unet = UNet2DConditionModel(
+        sample_size=32,
+        in_channels=8,
+        out_channels=4,
+        layers_per_block=1,
+        block_out_channels=(32, 64),
+        down_block_types=("CrossAttnDownBlock2D", "DownBlock2D"),
+        up_block_types=("UpBlock2D", "CrossAttnUpBlock2D"),
+        cross_attention_dim=384,
+        attention_head_dim=8,
+    )
+    unet_path = model_dir / 'unet'
+    unet.save_pretrained(unet_path, safe_serialization=False)
+
+    vae = AutoencoderKL(
+        in_channels=3,
+        out_channels=3,
+        down_block_types=("DownEncoderBlock2D",) * 4,
+        up_block_types=("UpDecoderBlock2D",) * 4,
+        block_out_channels=(32, 32, 32, 32),
+        layers_per_block=1,
+        latent_channels=4,
+        sample_size=256,
+    )
+    vae_path = model_dir / 'vae'
+    vae.save_pretrained(vae_path, safe_serialization=False)
+    return whisper_path, unet_path, vae_path
+
+
+def build_avatar(avatar_dir: Path, frames=50, size=512):
+    """
+    合成一个已完成预处理的avatar: 渐变背景的帧、下半脸mask、人脸位置和随机的latents，不需要dwpose和视频
+    """
+    import cv2
+
+    rng = np.random.default_rng(0)
+    full_images = avatar_dir / 'full_images'
+    full_masks = avatar_dir / 'full_masks'
+    full_images.mkdir(parents=True)
+    full_masks.mkdir()
+    face = size // 4, size // 4, size * 3 // 4, size * 3 // 4
+    x1, y1, x2, y2 = face
+    gradient = np.linspace(0, 255, size, dtype=np.float32)
+    for idx in range(frames):
+        frame = np.empty((size, size, 3), dtype=np.uint8)
+        frame[..., 0] = gradient[None, :]
+        frame[..., 1] = gradient[:, None]
+        frame[..., 2] = (idx * 255 // frames)
+        frame = cv2.add(frame, rng.integers(0, 16, frame.shape, dtype=np.uint8))
+        cv2.imwrite(str(full_images / f'{idx:08d}.png'), frame)
+        mask = np.zeros((size, size), dtype=np.uint8)
+        cv2.ellipse(mask, ((x1 + x2) // 2, (y1 * 2 + y2 * 3) // 5), ((x2 - x1) // 3, (y2 - y1) // 4), 0, 0, 360, 255, -1)
+        cv2.imwrite(str(full_masks / f'{idx:08d}.png'), cv2.GaussianBlur(mask, (21, 21), 0))
+    # 与Avatar.prepare_avatar一致，保存正序和倒序拼接后的数据
+    np.save(avatar_dir / 'coords.npy', np.array([face] * frames * 2))
+    np.save(avatar_dir / 'latents.npy', rng.standard_normal((frames * 2, 8, 32, 32), dtype=np.float32))
+
+
+def build_settings(workdir: Path, args) -> Path:
+    from omegaconf import OmegaConf
+
+    whisper_path, unet_path, vae_path = build_models(workdir / 'models')
+    avatar_id = 'benchmark'
+    build_avatar(workdir / 'avatars' / avatar_id, args.frames, args.frame_size)
+    config = OmegaConf.load(REPO_DIR / 'common' / 'settings.yaml')
+    config.models.whisper_path = str(whisper_path)
+    config.models.unet_path = str(unet_path)
+    config.models.vae_path = str(vae_path)
+    config.avatar.avatar_dir = str(workdir / 'avatars')
+    config.cache.audio_feature_dir = str(workdir / 'caches' / 'audio_features')
+    config.cache.tts_dir = str(workdir / 'caches' / 'tts')
+    config.cache.tts_provider = 'tone'
+    config.serving.avatar_id = avatar_id
+    config.serving.video_path = ''
+    config.serving.mode = args.mode
+    config.serving.batch_size = args.batch_size
+    config.serving.profile_dir = str(workdir / 'profiles')
+    settings_path = workdir / 'settings.yaml'
+    OmegaConf.save(config, settings_path)
+    return settings_path
+
+
+def start_server(settings_path: Path, port: int, log_path: Path) -> subprocess.Popen:
+    env = dict(os.environ, MUSETALK_SETTINGS=str(settings_path), CUDA_VISIBLE_DEVICES='')
+    log = open(log_path, 'w')
+    return subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'server:app', '--host', '127.0.0.1', '--port', str(port)],
+        cwd=REPO_DIR, env=env, stdout=log, stderr=subprocess.STDOUT,
+    )
+
+
+def http_json(url: str, method='GET', timeout=30):
+    request = urllib.request.Request(url, method=method)
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, None
+
+
+def wait_ready(base_url: str, process: subprocess.Popen, timeout=600):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server exited with code {process.returncode}")
+        try:
+            status, _ = http_json(f'{base_url}/queue', timeout=5)
+            if status == 200:
+                return
+        except (urllib.error.URLError, ConnectionError, TimeoutError):
+            pass
+        time.sleep(1)
+    raise TimeoutError("server did not become ready")
+
+
+class ProcessSampler:
+    """
+    通过/proc定期读取服务进程及其子进程(multiprocess模式下的推理进程)的CPU时间和RSS
+    """
+
+    def __init__(self, root_pid: int):
+        self.root_pid = root_pid
+        self.ticks = os.sysconf('SC_CLK_TCK')
+        self.first = {}
+        self.last = {}
+        self.max_rss = {}
+        self.names = {}
+
+    def pids(self):
+        pids = [self.root_pid]
+        children = {}
+        for entry in Path('/proc').iterdir():
+            if not entry.name.isdigit():
+                continue
+            try:
+                stat = (entry / 'stat').read_text()
+            except OSError:
+                continue
+            ppid = int(stat.rsplit(')', 1)[1].split()[1])
+            children.setdefault(ppid, []).append(int(entry.name))
+        idx = 0
+        while idx < len(pids):
+            pids.extend(children.get(pids[idx], []))
+            idx += 1
+        return pids
+
+    def sample(self):
+        now = time.monotonic()
+        for pid in self.pids():
+            try:
+                fields = Path(f'/proc/{pid}/stat').read_text().rsplit(')', 1)[1].split()
+                status = Path(f'/proc/{pid}/status').read_text()
+                cmdline = Path(f'/proc/{pid}/cmdline').read_bytes().replace(b'\0', b' ').decode().strip()
+            except OSError:
+                continue
+            cpu = (int(fields[11]) + int(fields[12])) / self.ticks
+            rss = next((int(line.split()[1]) * 1024 for line in status.splitlines() if line.startswith('VmRSS')), 0)
+            self.first.setdefault(pid, (now, cpu))
+            self.last[pid] = (now, cpu)
+            self.max_rss[pid] = max(self.max_rss.get(pid, 0), rss)
+            self.names[pid] = cmdline[:120]
+
+    async def run(self, interval=1.0):
+        while True:
+            self.sample()
+            await asyncio.sleep(interval)
+
+    def report(self) -> list:
+        report = []
+        for pid, (start, cpu_start) in self.first.items():
+            end, cpu_end = self.last[pid]
+            elapsed = end - start
+            report.append({
+                "pid": pid,
+                "cmdline": self.names[pid],
+                "cpu_percent": 100 * (cpu_end - cpu_start) / elapsed if elapsed > 0 else None,
+                "max_rss_bytes": self.max_rss[pid],
+            })
+        return report
+
+
+class Viewer:
+    """
+    使用av协议的websocket观众，记录视频消息的到达时间和pts
+    """
+
+    def __init__(self):
+        self.arrivals = []
+        self.pts = []
+        self.audio_messages = 0
+        self.samples_per_frame = 640
+        self.fps = 25
+        self.error = None
+
+    async def run(self, url: str, stop: asyncio.Event):
+        import websockets
+
+        try:
+            async with websockets.connect(url, max_size=None) as websocket:
+                hello = json.loads(await websocket.recv())
+                self.samples_per_frame = hello["samples_per_frame"]
+                self.fps = hello["fps"]
+                while not stop.is_set():
+                    try:
+                        message = await asyncio.wait_for(websocket.recv(), timeout=1.0)
+                    except asyncio.TimeoutError:
+                        continue
+                    kind, pts = message[0], int.from_bytes(message[1:9], 'little', signed=True)
+                    if kind == 0:
+                        self.arrivals.append(time.monotonic())
+                        self.pts.append(pts)
+                    else:
+                        self.audio_messages += 1
+        except Exception as e:
+            self.error = repr(e)
+
+    def report(self) -> dict:
+        intervals = np.diff(self.arrivals) if len(self.arrivals) > 1 else np.array([])
+        deviation = np.abs(intervals - 1 / self.fps) * 1000
+        # pts按节拍递增，间隔大于一帧说明服务端跳过了节拍或客户端缓冲丢弃了帧
+        gaps = np.diff(self.pts) // self.samples_per_frame if len(self.pts) > 1 else np.array([])
+        duration = self.arrivals[-1] - self.arrivals[0] if len(self.arrivals) > 1 else 0
+        return {
+            "frames": len(self.arrivals),
+            "speech_frames": self.audio_messages,
+            "fps": (len(self.arrivals) - 1) / duration if duration > 0 else 0.0,
+            "dropped_frames": int(np.clip(gaps - 1, 0, None).sum()) if len(gaps) else 0,
+            "jitter_ms": percentiles(deviation),
+            "jitter_std_ms": float(np.std(intervals) * 1000) if len(intervals) else None,
+            "error": self.error,
+        }
+
+
+def percentiles(values) -> dict:
+    values = np.asarray(values, dtype=np.float64)
+    if values.size == 0:
+        return {"p50": None, "p95": None, "p99": None, "mean": None, "count": 0}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": float(p50), "p95": float(p95), "p99": float(p99), "mean": float(values.mean()),
+            "count": int(values.size)}
+
+
+async def generate_requests(base_url: str, args, stop: asyncio.Event, results: dict):
+    """
+    按泊松过程(或固定间隔)发送/talk请求
+    """
+    rng = random.Random(args.seed)
+    while not stop.is_set():
+        interval = rng.expovariate(args.rate) if args.arrival == 'poisson' else 1 / args.rate
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=interval)
+            break
+        except asyncio.TimeoutError:
+            pass
+        text = rng.choice(SENTENCES)
+        url = f'{base_url}/talk?' + urllib.parse.urlencode({"text": text})
+        sent_at = time.time()
+        status, body = await asyncio.to_thread(http_json, url)
+        results["latency"].append(time.time() - sent_at)
+        if status == 200:
+            results["jobs"].append(body["job_id"])
+        elif status == 429:
+            results["rejected"] += 1
+        else:
+            results["errors"] += 1
+
+
+async def collect_jobs(base_url: str, job_ids, timeout: float) -> list:
+    """
+    等待已接收的任务结束，返回任务状态
+    """
+    deadline = time.time() + timeout
+    jobs = {}
+    while time.time() < deadline:
+        for job_id in job_ids:
+            if job_id in jobs and jobs[job_id]["status"] in ('done', 'cancelled', 'failed'):
+                continue
+            status, job = await asyncio.to_thread(http_json, f'{base_url}/jobs/{job_id}')
+            if status == 200:
+                jobs[job_id] = job
+        if all(job_id in jobs and jobs[job_id]["status"] in ('done', 'cancelled', 'failed') for job_id in job_ids):
+            break
+        await asyncio.sleep(1)
+    return list(jobs.values())
+
+
+async def run_load(base_url: str, ws_url: str, server_pid: int, args) -> dict:
+    stop = asyncio.Event()
+    viewers = [Viewer() for _ in range(args.viewers)]
+    sampler = ProcessSampler(server_pid)
+    requests = {"jobs": [], "latency": [], "rejected": 0, "errors": 0}
+    viewer_tasks = [asyncio.create_task(viewer.run(ws_url, stop)) for viewer in viewers]
+    sampler_task = asyncio.create_task(sampler.run())
+    await asyncio.sleep(args.warmup)
+    started = time.monotonic()
+    load_task = asyncio.create_task(generate_requests(base_url, args, stop, requests))
+    await asyncio.sleep(args.duration)
+    stop.set()
+    await load_task
+    jobs = await collect_jobs(base_url, requests["jobs"], args.drain_timeout)
+    elapsed = time.monotonic() - started
+    await asyncio.gather(*viewer_tasks)
+    sampler_task.cancel()
+    sampler.sample()
+
+    ttff = [job["first_frame_at"] - job["created_at"] for job in jobs if job.get("first_frame_at")]
+    done = [job for job in jobs if job["status"] == 'done']
+    rendered = sum(job["frames"] for job in done)
+    render_time = sum(job["finished_at"] - job["started_at"] for job in done if job["started_at"])
+    viewer_reports = [viewer.report() for viewer in viewers]
+    status, _ = http_json(f'{base_url}/queue')
+    return {
+        "elapsed_seconds": elapsed,
+        "requests": {
+            "sent": len(requests["latency"]),
+            "accepted": len(requests["jobs"]),
+            "rejected": requests["rejected"],
+            "errors": requests["errors"],
+            "http_latency_s": percentiles(requests["latency"]),
+        },
+        "jobs": {status: sum(1 for job in jobs if job["status"] == status)
+                 for status in ('done', 'cancelled', 'failed', 'queued', 'running')},
+        "time_to_first_frame_s": percentiles(ttff),
+        "throughput": {
+            "jobs_per_second": len(done) / elapsed,
+            "rendered_frames_per_second": rendered / elapsed,
+            # 渲染速度与实时的比值，大于1说明渲染快于播放
+            "render_realtime_factor": rendered / 25 / render_time if render_time > 0 else None,
+        },
+        "viewers": {
+            "count": len(viewers),
+            "jitter_ms_p95_max": max((r["jitter_ms"]["p95"] or 0) for r in viewer_reports) if viewer_reports else None,
+            "dropped_frames_total": sum(r["dropped_frames"] for r in viewer_reports),
+            "per_viewer": viewer_reports,
+        },
+        "processes": sampler.report(),
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main():
+    parser = ArgumentParser(description="Load-test server.py with tiny random models on CPU")
+    parser.add_argument('--viewers', type=int, default=4, help="number of websocket viewers")
+    parser.add_argument('--rate', type=float, default=0.2, help="/talk requests per second")
+    parser.add_argument('--arrival', choices=['poisson', 'fixed'], default='poisson')
+    parser.add_argument('--duration', type=float, default=60, help="seconds of load")
+    parser.add_argument('--warmup', type=float, default=5, help="seconds of idle streaming before load")
+    parser.add_argument('--drain-timeout', type=float, default=120, help="seconds to wait for accepted jobs")
+    parser.add_argument('--mode', choices=['inprocess', 'multiprocess'], default='inprocess')
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--frames', type=int, default=50, help="frames of the synthetic avatar")
+    parser.add_argument('--frame-size', type=int, default=512, help="width and height of avatar frames")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', type=str, default=None,
+                        help="keep models and logs in a new run directory under this path instead of a temp dir")
+    parser.add_argument('--output', type=str, default='benchmark.json')
+    args = parser.parse_args()
+
+    if args.workdir:
+        # 每次运行在用户给出的目录下新建子目录，不删除也不覆盖其中已有的内容
+        Path(args.workdir).mkdir(parents=True, exist_ok=True)
+        workdir = Path(tempfile.mkdtemp(prefix=f"run-{time.strftime('%Y%m%d-%H%M%S')}-", dir=args.workdir))
+    else:
+        workdir = Path(tempfile.mkdtemp(prefix='musetalk-bench-'))
+    print(f"building tiny models and avatar in {workdir}")
+    settings_path = build_settings(workdir, args)
+    base_url = f'http://127.0.0.1:{args.port}'
+    ws_url = f'ws://127.0.0.1:{args.port}/ws?av=true'
+    server = start_server(settings_path, args.port, workdir / 'server.log')
+    try:
+        wait_ready(base_url, server)
+        print("server ready, running load")
+        results = asyncio.run(run_load(base_url, ws_url, server.pid, args))
+    finally:
+        server.send_signal(signal.SIGINT)
+        try:
+            server.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "config": vars(args),
+        "results": results,
+    }
+    Path(args.output).write_text(json.dumps(report, indent=2, ensure_ascii=False))
+    print(json.dumps({
+        "time_to_first_frame_s": results["time_to_first_frame_s"],
+        "throughput": results["throughput"],
+        "dropped_frames": results["viewers"]["dropped_frames_total"],
+    }, indent=2))
+    print(f"results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,309 @@
+"""
+int8量化校准: 以已准备好的avatar的latents和一组语音作为校准集，对unet、vae decoder和whisper audio encoder的卷积做静态量化，
+线性层(含注意力的投影)做动态量化，结果保存到settings.models.export_dir。
+之后在留出的语音上与fp32比较画质(PSNR)、各组件的误差、口型同步(SyncNet距离)和速度:
+
+    python scripts/calibrate_int8.py --avatars tjl --syncnet outputs/checkpoints/syncnet.pt --report int8.json
+
+校准后在settings.yaml中设置serving.backend为int8即可使用
+"""
+import sys
+import json
+import time
+import asyncio
+from pathlib import Path
+from argparse import ArgumentParser
+
+import numpy as np
+
+sys.path.append('.')
+
+from common.setting import settings
+
+COMPONENTS = ('unet', 'vae_decoder', 'audio_encoder')
+SENTENCES = [
+    "大家好，欢迎来到今天的直播间。",
+    "这款产品采用了全新的设计，使用起来非常方便。",
+    "如果您有任何问题，可以随时在评论区留言。",
+    "今天下单还可以享受额外的优惠。",
+    "我们的客服会在第一时间为您解答。",
+    "感谢您的耐心观看，记得点赞关注。",
+    "接下来为大家演示一下具体的使用方法。",
+    "好的，今天的介绍就到这里，我们下次再见。",
+]
+
+
+def load_avatars(avatar_ids):
+    """
+    return: {avatar_id: latents}，latents为n * 8 * 32 * 32(不含倒序拼接的部分)
+    """
+    import torch
+
+    avatar_dir = Path(settings.avatar.avatar_dir)
+    if not avatar_ids:
+        avatar_ids = sorted(path.name for path in avatar_dir.iterdir() if (path / 'latents.npy').exists())
+    if not avatar_ids:
+        raise SystemExit(f"no prepared avatars in {avatar_dir}")
+    avatars = {}
+    for avatar_id in avatar_ids:
+        latents = torch.from_numpy(np.load(avatar_dir / avatar_id / 'latents.npy')).float()
+        avatars[avatar_id] = latents[: latents.shape[0] // 2]
+    return avatars
+
+
+def load_clips(audio_files, sentences):
+    """
+    return: 16kHz单声道float32波形列表，未指定音频文件时用tts合成sentences
+    """
+    from common.tts import get_tts_cache
+    from musetalk.audio.audio_feature_extract import load_audio
+
+    if audio_files:
+        return [load_audio(path).numpy() for path in audio_files]
+    cache = get_tts_cache()
+    return [load_audio(asyncio.run(cache.synthesize_bytes(text))).numpy() for text in sentences]
+
+
+def frame_batches(features, latents, batch_size, limit):
+    """
+    按推理时的方式把第i帧的音频特征与avatar的第i帧latents配对，最多limit帧
+    """
+    count = min(features.shape[0], limit)
+    for start in range(0, count, batch_size):
+        end = min(start + batch_size, count)
+        index = np.arange(start, end) % latents.shape[0]
+        yield features[start:end], latents[index]
+
+
+def psnr(reference: np.ndarray, image: np.ndarray) -> float:
+    mse = np.mean((reference.astype(np.float64) - image.astype(np.float64)) ** 2)
+    return float('inf') if mse == 0 else float(10 * np.log10(255.0 ** 2 / mse))
+
+
+def relative_error(reference, candidate) -> float:
+    return ((candidate - reference).abs().max() / reference.abs().max().clamp(min=1e-12)).item()
+
+
+class Timer:
+    def __init__(self):
+        self.seconds = {}
+
+    def run(self, name, fn, *inputs):
+        start = time.perf_counter()
+        output = fn(*inputs)
+        self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - start
+        return output
+
+
+def sync_distances(syncnet, images, features, sync_t):
+    """
+    images: n * 3 * 256 * 256(-1~1的RGB)，features: n * 50 * 384
+    return: 每sync_t个连续帧的图像embedding与音频embedding的距离，越小口型越同步
+    """
+    import torch
+    import torch.nn.functional as F
+
+    distances = []
+    for start in range(0, images.shape[0] - sync_t + 1, sync_t):
+        image_window = images[start: start + sync_t].reshape(1, -1, *images.shape[2:])
+        audio_window = features[start: start + sync_t][None]
+        with torch.no_grad():
+            image_embedding, audio_embedding = syncnet((image_window, audio_window))
+        distances.append(F.pairwise_distance(image_embedding, audio_embedding).item())
+    return distances
+
+
+def main():
+    parser = ArgumentParser(description="Calibrate int8 UNet / VAE decoder / audio encoder and report quality")
+    parser.add_argument('--components', nargs='+', choices=COMPONENTS, default=list(COMPONENTS))
+    parser.add_argument('--avatars', nargs='+', default=None, help="prepared avatars used for calibration, default all")
+    parser.add_argument('--audio', nargs='+', default=None, help="calibration audio files, default synthesized speech")
+    parser.add_argument('--sentences', nargs='+', default=SENTENCES, help="texts synthesized when --audio is not set")
+    parser.add_argument('--eval-clips', type=int, default=2, help="clips held out for the quality report")
+    parser.add_argument('--calibration-frames', type=int, default=200, help="frames per clip and avatar to calibrate")
+    parser.add_argument('--eval-frames', type=int, default=50, help="frames per clip and avatar to evaluate")
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--no-static', action='store_true', help="skip static quantization of convolutions")
+    parser.add_argument('--no-dynamic', action='store_true', help="skip dynamic quantization of linear layers")
+    parser.add_argument('--quantize-io', action='store_true', help="also quantize the input and output convolutions")
+    parser.add_argument('--syncnet', type=str, default=None, help="SyncNet checkpoint for the lip-sync score")
+    parser.add_argument('--threads', type=int, default=0, help="cpu threads, 0 for the torch default")
+    parser.add_argument('--output', type=str, default=None, help="export directory, defaults to models.export_dir")
+    parser.add_argument('--report', type=str, default='int8_report.json')
+    args = parser.parse_args()
+
+    import torch
+    from musetalk.processors import ImageProcessor
+    from musetalk.models.musetalk import PositionalEncoding
+    from musetalk.models.backends import AudioEncoderModule, load_modules, read_manifest, write_manifest
+    from musetalk.models.quantization import FLOAT_MODULES, quantize, quantized_engine, save_int8
+    from musetalk.audio.audio_feature_extract import AudioFeatureExtractor
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    engine = quantized_engine()
+    export_dir = Path(args.output or settings.models.export_dir)
+    export_dir.mkdir(parents=True, exist_ok=True)
+    avatars = load_avatars(args.avatars)
+    clips = load_clips(args.audio, args.sentences)
+    if len(clips) <= args.eval_clips:
+        raise SystemExit("need more clips than --eval-clips")
+    calibration_clips, eval_clips = clips[:-args.eval_clips], clips[-args.eval_clips:]
+
+    modules = load_modules(
+        ['unet', 'vae_decoder'], settings.models.unet_path, settings.models.vae_path, settings.models.whisper_path
+    )
+    afe = AudioFeatureExtractor(settings.models.whisper_path, 'cpu', torch.float32)
+    modules['audio_encoder'] = AudioEncoderModule(afe.encoder).eval()
+    pe = PositionalEncoding()
+    scaling_factor = modules['vae_decoder'].vae.config.scaling_factor
+    image_processor = ImageProcessor()
+
+    def float_modules(component):
+        return () if args.quantize_io else FLOAT_MODULES[component]
+
+    # 校准集: fp32的音频特征及unet的输出(vae decoder的输入)
+    with torch.no_grad():
+        calibration_features = [afe.extract_features(pcm) for pcm in calibration_clips]
+    unet_inputs = [
+        (latent_batch, pe(feature_batch))
+        for features in calibration_features for latents in avatars.values()
+        for feature_batch, latent_batch in frame_batches(features, latents, args.batch_size, args.calibration_frames)
+    ]
+    vae_inputs = []
+
+    def calibrate_unet(module):
+        for latent_batch, audio_batch in unet_inputs:
+            # 插入observer后的模块输出与fp32一致，同时作为vae decoder的校准输入
+            vae_inputs.append(module(latent_batch, audio_batch) / scaling_factor)
+
+    def calibrate_vae(module):
+        if not vae_inputs:
+            calibrate_unet(modules['unet'])
+        for latents in vae_inputs:
+            module(latents)
+
+    def calibrate_audio(module):
+        afe.set_encoder(module, 'calibration')
+        for pcm in calibration_clips:
+            afe.extract_features(pcm)
+        afe.set_encoder(None, 'eager')
+
+    calibrators = {'unet': calibrate_unet, 'vae_decoder': calibrate_vae, 'audio_encoder': calibrate_audio}
+    quantized = {}
+    manifest = read_manifest(export_dir)
+    for component in COMPONENTS:
+        if component not in args.components:
+            continue
+        print(f"quantizing {component}")
+        start = time.perf_counter()
+        quantized[component] = quantize(
+            component, modules[component], None if args.no_static else calibrators[component],
+            dynamic=not args.no_dynamic, float_modules=float_modules(component),
+        )
+        info = {
+            "dynamic": not args.no_dynamic,
+            "float_modules": list(float_modules(component)),
+            "engine": engine,
+            "avatars": list(avatars),
+            "calibration_clips": len(calibration_clips),
+            "calibration_batches": len(unet_inputs),
+        }
+        path = export_dir / f'{component}.int8.pt'
+        save_int8(quantized[component], path, info)
+        manifest["components"].setdefault(component, {})["int8"] = {
+            "file": path.name, "batch_size": None, "dtype": "float32", "static": not args.no_static, **info,
+            "calibration_seconds": time.perf_counter() - start,
+        }
+    write_manifest(export_dir, manifest)
+
+    # 质量与速度: 各组件单独替换为int8，以及全部替换后的端到端结果
+    syncnet = None
+    if args.syncnet:
+        from musetalk.models.sync_net import SyncNet, sync_t
+
+        syncnet = SyncNet()
+        syncnet.load_state_dict(torch.load(args.syncnet, map_location='cpu'))
+        syncnet.eval()
+    unet_int8 = quantized.get('unet', modules['unet'])
+    vae_int8 = quantized.get('vae_decoder', modules['vae_decoder'])
+    timer = Timer()
+    errors = {"audio_encoder": [], "unet": [], "vae_decoder_psnr": [], "psnr": []}
+    distances = {"fp32": [], "int8": []}
+    frames = 0
+    with torch.no_grad():
+        for pcm in eval_clips:
+            features = timer.run('audio_encoder_fp32', afe.extract_features, pcm)
+            if 'audio_encoder' in quantized:
+                afe.set_encoder(quantized['audio_encoder'], 'int8')
+                features_int8 = timer.run('audio_encoder_int8', afe.extract_features, pcm)
+                afe.set_encoder(None, 'eager')
+                errors["audio_encoder"].append(relative_error(features, features_int8))
+            else:
+                features_int8 = features
+            for latents in avatars.values():
+                images_fp32, images_int8 = [], []
+                batches = zip(
+                    frame_batches(features, latents, args.batch_size, args.eval_frames),
+                    frame_batches(features_int8, latents, args.batch_size, args.eval_frames),
+                )
+                for (feature_batch, latent_batch), (feature_batch_int8, _) in batches:
+                    pred = timer.run('unet_fp32', modules['unet'], latent_batch, pe(feature_batch)) / scaling_factor
+                    image = timer.run('vae_decoder_fp32', modules['vae_decoder'], pred)
+                    pred_unet_int8 = timer.run('unet_int8', unet_int8, latent_batch, pe(feature_batch)) / scaling_factor
+                    image_vae_int8 = timer.run('vae_decoder_int8', vae_int8, pred)
+                    errors["unet"].append(relative_error(pred, pred_unet_int8))
+                    errors["vae_decoder_psnr"].append(psnr(
+                        image_processor.de_process_bgr(image), image_processor.de_process_bgr(image_vae_int8)
+                    ))
+                    # 端到端: int8的音频特征、unet和vae decoder
+                    pred_int8 = unet_int8(latent_batch, pe(feature_batch_int8)) / scaling_factor
+                    image_int8 = vae_int8(pred_int8)
+                    errors["psnr"].append(psnr(
+                        image_processor.de_process_bgr(image), image_processor.de_process_bgr(image_int8)
+                    ))
+                    images_fp32.append(image)
+                    images_int8.append(image_int8)
+                    frames += image.shape[0]
+                if syncnet is not None and images_fp32:
+                    count = min(features.shape[0], args.eval_frames)
+                    distances["fp32"] += sync_distances(syncnet, torch.cat(images_fp32), features[:count], sync_t)
+                    distances["int8"] += sync_distances(syncnet, torch.cat(images_int8), features[:count], sync_t)
+
+    def mean(values):
+        return float(np.mean(values)) if values else None
+
+    def fps(*names):
+        seconds = sum(timer.seconds.get(name, 0.0) for name in names)
+        return frames / seconds if seconds else None
+
+    report = {
+        "settings": {"engine": engine, "threads": torch.get_num_threads(), "batch_size": args.batch_size},
+        "avatars": list(avatars),
+        "eval_frames": frames,
+        "quality": {
+            "psnr_db": mean(errors["psnr"]),
+            "psnr_db_min": min(errors["psnr"]) if errors["psnr"] else None,
+            "vae_decoder_psnr_db": mean(errors["vae_decoder_psnr"]),
+            "unet_max_rel_error": mean(errors["unet"]),
+            "audio_encoder_max_rel_error": mean(errors["audio_encoder"]),
+            "sync_distance_fp32": mean(distances["fp32"]),
+            "sync_distance_int8": mean(distances["int8"]),
+        },
+        "speed": {
+            "seconds": timer.seconds,
+            "render_fps_fp32": fps('unet_fp32', 'vae_decoder_fp32'),
+            "render_fps_int8": fps('unet_int8', 'vae_decoder_int8'),
+        },
+        "manifest": {component: manifest["components"][component]["int8"] for component in quantized},
+    }
+    Path(args.report).write_text(json.dumps(report, indent=2, ensure_ascii=False))
+    print(json.dumps({"quality": report["quality"], "speed": {
+        key: value for key, value in report["speed"].items() if key != 'seconds'
+    }}, indent=2))
+    print(f"report written to {args.report}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+将unet、vae decoder和whisper audio encoder导出为onnx和torchscript，写入settings.models.export_dir，
+并与eager模型比较输出(随机输入，含不足一个batch的情况)，误差超过--rtol时返回非0:
+
+    python scripts/export_backends.py --formats onnx torchscript --batch-size 4
+    python scripts/export_backends.py --check-only --backends onnxruntime compiled
+
+导出之后在settings.yaml中设置serving.backend为onnxruntime或torchscript即可使用
+"""
+import sys
+import json
+from argparse import ArgumentParser
+
+sys.path.append('.')
+
+from common.setting import settings
+
+
+def check_inputs(component, module, batch_size, audio_frames):
+    """
+    一致性检查使用的输入: 完整batch、不足一个batch，以及audio encoder的变长输入
+    """
+    from musetalk.models.backends import sample_inputs
+
+    cases = [sample_inputs(component, module, batch_size, audio_frames)]
+    if batch_size > 1:
+        cases.append(sample_inputs(component, module, batch_size - 1, audio_frames))
+    if component == 'audio_encoder' and audio_frames > 100:
+        cases.append(sample_inputs(component, module, 1, 100))
+    return cases
+
+
+# 与musetalk.models.backends.COMPONENTS一致，--help时不导入torch
+COMPONENTS = ('unet', 'vae_decoder', 'audio_encoder')
+
+
+def main():
+    parser = ArgumentParser(description="Export inference backends and check parity against eager PyTorch")
+    parser.add_argument('--components', nargs='+', choices=COMPONENTS, default=list(COMPONENTS))
+    parser.add_argument('--formats', nargs='+', choices=['onnx', 'torchscript'], default=['onnx', 'torchscript'])
+    parser.add_argument('--batch-size', type=int, default=4, help="batch size used for tracing and checks")
+    parser.add_argument('--fixed-batch', action='store_true',
+                        help="export with a fixed batch size, smaller batches are zero-padded at runtime")
+    parser.add_argument('--audio-frames', type=int, default=3000, help="mel frames of the audio encoder sample input")
+    parser.add_argument('--opset', type=int, default=17)
+    parser.add_argument('--output', type=str, default=None, help="export directory, defaults to models.export_dir")
+    parser.add_argument('--check-only', action='store_true', help="skip exporting, only check existing artifacts")
+    parser.add_argument('--backends', nargs='+', choices=['compiled', 'torchscript', 'onnxruntime'], default=None,
+                        help="backends to check, defaults to the exported formats")
+    parser.add_argument('--rtol', type=float, default=1e-3, help="max error relative to the output magnitude")
+    parser.add_argument('--report', type=str, default=None, help="write the parity report as json")
+    args = parser.parse_args()
+
+    import torch
+    from musetalk.models.backends import (
+        export, load_backend, load_modules, parity, read_manifest, sample_inputs, write_manifest
+    )
+
+    export_dir = args.output or settings.models.export_dir
+    modules = load_modules(
+        args.components, settings.models.unet_path, settings.models.vae_path, settings.models.whisper_path
+    )
+    if not args.check_only:
+        manifest = read_manifest(export_dir)
+        for component, module in modules.items():
+            inputs = sample_inputs(component, module, args.batch_size, args.audio_frames)
+            for fmt in args.formats:
+                print(f"exporting {component} to {fmt}")
+                entry = export(component, module, inputs, export_dir, fmt, not args.fixed_batch, args.opset)
+                manifest["components"].setdefault(component, {})[fmt] = entry
+        write_manifest(export_dir, manifest)
+
+    backends = args.backends or [{'onnx': 'onnxruntime', 'torchscript': 'torchscript'}[fmt] for fmt in args.formats]
+    report = []
+    failed = False
+    for component, module in modules.items():
+        for backend in backends:
+            runner = load_backend(component, module, backend, export_dir)
+            for inputs in check_inputs(component, module, args.batch_size, args.audio_frames):
+                result = parity(module, runner, inputs)
+                result.update({
+                    "component": component,
+                    "backend": backend,
+                    "input_shapes": [list(x.shape) for x in inputs],
+                    "passed": result["max_rel_error"] <= args.rtol,
+                })
+                failed |= not result["passed"]
+                report.append(result)
+                print(
+                    f"{component:<14}{backend:<13}{str(result['input_shapes']):<36}"
+                    f"max_rel={result['max_rel_error']:.2e} eager={result['reference_seconds'] * 1000:.1f}ms "
+                    f"{backend}={result['candidate_seconds'] * 1000:.1f}ms {'ok' if result['passed'] else 'FAILED'}"
+                )
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump({"torch": torch.__version__, "rtol": args.rtol, "results": report}, f, indent=2)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
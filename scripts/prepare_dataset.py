@@ -5,28 +5,59 @@ import shutil
 import argparse
 from uuid import uuid4
 from pathlib import Path
-from typing import Optional
+from typing import Optional, TYPE_CHECKING
 
 import cv2
-import torch
 import numpy as np
-from diffusers import AutoencoderKL
 from tqdm import tqdm
 
 sys.path.append('.')
 
 from common.setting import settings
 from common.utils import read_images, video2images, video2audio, recreate_multiple_dirs
-from musetalk.processors import ImageProcessor
-from musetalk.faces.face_analysis import FaceAnalyst
-from musetalk.audio.audio_feature_extract import AudioFeatureExtractor
 
-device = "cuda" if torch.cuda.is_available() else "cpu"
-afe: AudioFeatureExtractor
-fa = FaceAnalyst(settings.models.dwpose_config_path, settings.models.dwpose_model_path)
-ip = ImageProcessor()
-IMAGE_SIZE = settings.common.image_size
-vae: Optional[AutoencoderKL] = None
+if TYPE_CHECKING:
+    from diffusers import AutoencoderKL
+    from musetalk.processors import ImageProcessor
+    from musetalk.faces.face_analysis import FaceAnalyst
+    from musetalk.audio.feature_cache import AudioFeatureCache
+    from musetalk.audio.audio_feature_extract import AudioFeatureExtractor
+
+# torch、diffusers和mmpose在main中导入，模型在第一次使用时加载，--help不需要等待
+device = "cpu"
+afe: "AudioFeatureExtractor"
+feature_cache: "AudioFeatureCache"
+_face_analyst: Optional["FaceAnalyst"] = None
+_image_processor: Optional["ImageProcessor"] = None
+_vae: Optional["AutoencoderKL"] = None
+
+
+def get_face_analyst() -> "FaceAnalyst":
+    global _face_analyst
+    if _face_analyst is None:
+        from musetalk.faces.face_analysis import FaceAnalyst
+
+        _face_analyst = FaceAnalyst(settings.models.dwpose_config_path, settings.models.dwpose_model_path)
+    return _face_analyst
+
+
+def get_image_processor() -> "ImageProcessor":
+    global _image_processor
+    if _image_processor is None:
+        from musetalk.processors import ImageProcessor
+
+        _image_processor = ImageProcessor()
+    return _image_processor
+
+
+def get_vae() -> "AutoencoderKL":
+    global _vae
+    if _vae is None:
+        import torch
+        from diffusers import AutoencoderKL
+
+        _vae = AutoencoderKL.from_pretrained(settings.models.vae_path, subfolder="vae").to(device, dtype=torch.float16)
+    return _vae
 
 
 def process_video(video_path, face_shift=None, include_latents=False):
@@ -39,7 +70,6 @@ def process_video(video_path, face_shift=None, include_latents=False):
         "audio_files": ['path/to/audio01', 'path/to/audio02'],
     }
     """
-    global vae, ip
     video_data = {
         "image_files": [],
         "audio_files": [],
@@ -59,6 +89,8 @@ def process_video(video_path, face_shift=None, include_latents=False):
         video_frame_dir.mkdir(parents=True, exist_ok=True)
         video2images(video_path, tmp_frame_dir)
         frame_list = read_images([str(img) for img in tmp_frame_dir.glob('*')], to_rgb=False)
+        fa = get_face_analyst()
+        image_size = settings.common.image_size
         for fidx, frame in tqdm(
                 enumerate(frame_list),
                 total=len(frame_list),
@@ -68,7 +100,7 @@ def process_video(video_path, face_shift=None, include_latents=False):
             bbox = fa.face_location(pts, shift=face_shift)
             x1, y1, x2, y2 = bbox
             resized_crop_frame = cv2.resize(
-                frame[y1:y2, x1:x2], (IMAGE_SIZE, IMAGE_SIZE),
+                frame[y1:y2, x1:x2], (image_size, image_size),
                 interpolation=cv2.INTER_LANCZOS4
             )
             dst = str(video_frame_dir / f"{fidx:08d}.png")
@@ -87,7 +119,7 @@ def process_video(video_path, face_shift=None, include_latents=False):
     if not audio_feature_dir.exists() or not any(audio_feature_dir.iterdir()):
         audio_feature_dir.mkdir(parents=True, exist_ok=True)
         audio_path = video2audio(video_path, tmp_audio_dir)
-        feature_chunks = afe.extract_features(audio_path, 0)
+        feature_chunks = feature_cache.get_or_compute(afe, audio_path, 0)
         for fidx, chunk in tqdm(
                 enumerate(feature_chunks),
                 total=len(feature_chunks),
@@ -100,10 +132,10 @@ def process_video(video_path, face_shift=None, include_latents=False):
         video_data['audio_files'] = [str(i) for i in audio_feature_dir.glob('*')]
         print(f"Video {video_name}'s audio has already been processed.")
     if include_latents:
-        if vae is None:
-            vae = AutoencoderKL.from_pretrained(
-                settings.models.vae_path, subfolder="vae"
-            ).to(device, dtype=torch.float16)
+        import torch
+
+        vae = get_vae()
+        ip = get_image_processor()
         latent_dir = Path(settings.dataset.latents_dir) / video_name
         if not latent_dir.exists() or not any(latent_dir.iterdir()):
             latent_dir.mkdir(parents=True, exist_ok=True)
@@ -170,11 +202,24 @@ def parse_args():
 
 
 def main():
-    global afe
+    global afe, feature_cache, device
     args = parse_args()
+    import torch
+    from musetalk.audio.feature_cache import AudioFeatureCache
+    from musetalk.audio.audio_feature_extract import AudioFeatureExtractor
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
     afe = AudioFeatureExtractor(settings.models.whisper_path, device=device, dtype=torch.float32)
+    feature_cache = AudioFeatureCache(
+        settings.cache.audio_feature_dir,
+        memory_items=settings.cache.audio_feature_memory_items,
+        max_disk_bytes=settings.cache.audio_feature_disk_bytes,
+        # 训练特征与extractor的输出保持一致，不经过fp16
+        dtype=torch.float32,
+    )
     process_videos(video_dir=args.videos_dir, face_shift=args.face_shift, test_split=args.test_split,
                    include_latents=args.include_latents)
+    print(f"Audio feature cache: {feature_cache.stats()}")
 
 
 if __name__ == '__main__':
@@ -1,25 +1,37 @@
 import sys
 import argparse
 from pathlib import Path
-from typing import Optional
+from typing import Optional, TYPE_CHECKING
 
 import cv2
-import torch
 import numpy as np
 from tqdm import tqdm
-from diffusers import AutoencoderKL
 
 sys.path.append('.')
 
 from common.setting import settings
-from musetalk.processors import ImageProcessor
 
-device = "cuda" if torch.cuda.is_available() else "cpu"
+if TYPE_CHECKING:
+    from diffusers import AutoencoderKL
+    from musetalk.processors import ImageProcessor
 
-IMAGE_SIZE = settings.common.image_size
-ip = ImageProcessor()
-vae = AutoencoderKL.from_pretrained(settings.models.vae_path, subfolder="vae").to(device, dtype=torch.float16)
-vae.requires_grad_(False)
+# vae在第一次处理视频时加载，import和--help时不导入torch和diffusers
+_image_processor: Optional["ImageProcessor"] = None
+_vae: Optional["AutoencoderKL"] = None
+
+
+def get_models():
+    global _image_processor, _vae
+    if _vae is None:
+        import torch
+        from diffusers import AutoencoderKL
+        from musetalk.processors import ImageProcessor
+
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        _image_processor = ImageProcessor()
+        _vae = AutoencoderKL.from_pretrained(settings.models.vae_path, subfolder="vae").to(device, dtype=torch.float16)
+        _vae.requires_grad_(False)
+    return _image_processor, _vae
 
 
 def process_video(video_path):
@@ -31,6 +43,7 @@ def process_video(video_path):
     # 目录不存在或目录为空才创建
     if not video_latent_dir.exists() or not any(video_latent_dir.iterdir()):
         video_latent_dir.mkdir(parents=True, exist_ok=True)
+        ip, vae = get_models()
         frame_list = [str(img) for img in video_frame_dir.glob('*')]
         audio_feature_list = [np.load(str(audio)) for audio in audio_feature_dir.glob("*")]
         for fidx, (frame, audio_feature) in tqdm(
@@ -1,22 +1,20 @@
-import queue
-from functools import partial
-from io import BytesIO
+import hmac
+import asyncio
+from typing import Optional, Union
 
-import torch
-from fastapi import FastAPI, WebSocket, BackgroundTasks
-from PIL import Image
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Header
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 
-from musetalk.avatar import Avatar
-from musetalk.utils.utils import load_all_model
+from common.setting import settings
+from musetalk.serving.avsync import MediaClock
+from musetalk.serving.broadcast import FrameBroadcaster
+from musetalk.serving.encoders import EncodeProfile, JpegEncoder, IdleFrameCache
+from musetalk.serving.h264 import H264Profile, FragmentedMp4Stream
+from musetalk.serving.jobs import AdmissionRejected
+from musetalk.serving.metrics import REGISTRY, family, render, stage
+from musetalk.serving.workers import AvatarWorker, InProcessService, WorkerCrashed, WorkerSpec, create_admission
 
-AVATAR_DIR = "./results/avatars"
-loaded_avatar = None
-whisper, vae, unet, pe = load_all_model()
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-pe = pe.half()
-vae.vae = vae.vae.half()
-unet.model = unet.model.half()
 app = FastAPI()
 app.add_middleware(
     CORSMiddleware,
@@ -26,35 +24,283 @@ app.add_middleware(
     allow_headers=["*"],  # 允许所有HTTP头
 )
 
-avatar = Avatar(
-    unet,
-    vae,
-    pe,
-    whisper,
-    avatar_id="tjl",
+jpeg_encoder = JpegEncoder(workers=settings.serving.encoder_workers)
+default_profile = EncodeProfile(
+    max_width=settings.serving.max_width,
+    max_height=settings.serving.max_height,
+    quality=settings.serving.jpeg_quality,
 )
-inference_result_queue = queue.Queue()
 
+idle_frame_cache: Optional[IdleFrameCache] = None
 
-async def get_compressed_image_data(image, max_width=450, max_height=450):
-    img = Image.fromarray(image[:, :, ::-1])
-    img.thumbnail((max_width, max_height))
-    buffer = BytesIO()
-    img.save(buffer, format="JPEG", quality=95)  # 调整质量以进一步压缩
-    return buffer.getvalue()
+
+async def encode_frame(frame, profile: EncodeProfile):
+    # 待机帧直接使用缓存，说话帧在线程池中编码，不阻塞事件循环
+    if frame.idle:
+        return await idle_frame_cache.get(frame.index, profile, frame.image)
+    with stage('encode'):
+        return await jpeg_encoder.encode(frame.image, profile)
+
+
+# 所有客户端共享同一个生产者，每帧只渲染和编码一次
+h264_stream = FragmentedMp4Stream(H264Profile(
+    max_width=settings.serving.max_width,
+    max_height=settings.serving.max_height,
+    fps=settings.common.fps,
+    gop=settings.serving.h264_gop,
+    bitrate=settings.serving.h264_bitrate,
+    preset=settings.serving.h264_preset,
+))
+
+# 模型在startup中加载，import server(例如测试或uvicorn --help)时不加载模型
+service: Optional[Union[AvatarWorker, InProcessService]] = None
+broadcaster: Optional[FrameBroadcaster] = None
+# 采样率取自服务实际使用的音频特征提取器，与推理端切分的每帧音频一致
+media_clock: Optional[MediaClock] = None
+
+
+def create_service() -> Union[AvatarWorker, InProcessService]:
+    if settings.serving.mode == 'multiprocess':
+        # 推理、合成与播放时钟在独立进程中，本进程只负责编码和网络，帧通过共享内存传递
+        return AvatarWorker(
+            WorkerSpec(settings.serving.avatar_id, settings.serving.video_path, settings.serving.bbox_shift),
+            ring_slots=settings.serving.ring_slots,
+            heartbeat_timeout=settings.serving.worker_heartbeat_timeout,
+        )
+    import torch
+    from musetalk.avatar import Avatar
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    avatar = Avatar(
+        settings.serving.avatar_id,
+        settings.serving.video_path,
+        settings.serving.bbox_shift,
+        device=device,
+        dtype=torch.float16 if device.type == "cuda" else torch.float32,
+    )
+    # 每个avatar一个任务队列，同一时刻只渲染一个任务
+    return InProcessService(avatar, create_admission())
+
+
+@app.on_event("startup")
+async def startup():
+    global service, broadcaster, idle_frame_cache, media_clock
+    service = create_service()
+    await service.start()
+    media_clock = MediaClock(sample_rate=service.sample_rate, fps=settings.common.fps)
+    broadcaster = FrameBroadcaster(
+        service.frame_source, encode_frame, client_buffer=settings.serving.client_buffer_size,
+        streams=[h264_stream], clock=media_clock,
+    )
+    # 没有观众时也要消费说话的帧，否则/talk会把播放缓冲填满并阻塞渲染线程；待机时生产者自行暂停
+    broadcaster.start()
+    if isinstance(service, InProcessService):
+        idle_frame_cache = IdleFrameCache(jpeg_encoder, service.avatar.frame_cycle)
+    else:
+        # 帧在推理进程中，待机帧在第一次出现时编码并缓存
+        idle_frame_cache = IdleFrameCache(jpeg_encoder, None, slots=service.slots)
+    asyncio.create_task(idle_frame_cache.warm(default_profile))
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    if isinstance(service, AvatarWorker):
+        await service.shutdown()
 
 
 @app.get("/talk")
-async def talk(text: str, background_tasks: BackgroundTasks):
-    inference = partial(avatar.inference, {"audio_path": "", "text": text})
-    background_tasks.add_task(inference)
-    return {"data": text}
+async def talk(text: str, priority: int = 0, interrupt: bool = False):
+    """
+    priority: 队列为priority模式时生效，数值越小越先执行
+    interrupt: 打断正在说的话并清空排队的任务
+    """
+    # 按句流式合成与渲染，第一句合成完成即开始出帧
+    try:
+        job = await service.submit(text, priority=priority, interrupt=interrupt)
+        stats = await service.stats()
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    except (WorkerCrashed, asyncio.TimeoutError) as e:
+        raise HTTPException(status_code=503, detail=str(e) or "avatar worker unavailable")
+    return {"data": text, "job_id": job["job_id"], "queue_depth": stats["queue"]["depth"]}
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await service.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="job not found")
+    return job
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    if not await service.cancel(job_id):
+        raise HTTPException(status_code=404, detail="job not found or already finished")
+    return {"job_id": job_id, "cancelled": True}
+
+
+@app.get("/queue")
+async def queue_stats():
+    return await service.stats()
 
 
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    global avatar
+async def websocket_endpoint(
+        websocket: WebSocket,
+        width: Optional[int] = None,
+        height: Optional[int] = None,
+        quality: Optional[int] = None,
+        av: bool = False,
+):
+    """
+    av: 为False时每条消息是一帧jpeg；为True时先发送一条json文本描述流参数，之后每条二进制消息为
+        1字节类型(0视频/1音频) + 8字节小端pts(以音频采样数计) + jpeg或16位PCM，同一帧的视频和音频pts相同
+    """
+    await websocket.accept()
+    # 相同规格的客户端共享同一份编码结果
+    profile = EncodeProfile(
+        max_width=width or default_profile.max_width,
+        max_height=height or default_profile.max_height,
+        quality=min(max(quality or default_profile.quality, 1), 100),
+    )
+    client = broadcaster.subscribe(profile, av=av)
+    try:
+        if av:
+            await websocket.send_text(media_clock.hello())
+        while True:
+            data = await client.get()
+            with stage('send'):
+                if av:
+                    for message in data:
+                        await websocket.send_bytes(message)
+                else:
+                    await websocket.send_bytes(data)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        broadcaster.unsubscribe(client)
+
+
+@app.websocket("/ws/h264")
+async def h264_websocket_endpoint(websocket: WebSocket):
+    """
+    H.264 fragmented mp4流，第一条消息为init segment，之后每条消息为一个moof + mdat，可直接送入MSE
+    """
     await websocket.accept()
-    async for frame in avatar.next_frame():
-        image_data = await get_compressed_image_data(frame)
-        await websocket.send_bytes(image_data)
+    subscriber = broadcaster.subscribe_stream(h264_stream)
+    try:
+        async for segment in h264_stream.iter_segments(subscriber):
+            with stage('send'):
+                await websocket.send_bytes(segment)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        broadcaster.unsubscribe_stream(h264_stream, subscriber)
+
+
+@app.get("/stream.mp4")
+async def h264_http_stream():
+    """
+    以chunked http输出同一个fragmented mp4流
+    """
+    subscriber = broadcaster.subscribe_stream(h264_stream)
+
+    async def segments():
+        try:
+            async for segment in h264_stream.iter_segments(subscriber):
+                yield segment
+        finally:
+            broadcaster.unsubscribe_stream(h264_stream, subscriber)
+
+    return StreamingResponse(segments(), media_type='video/mp4')
+
+
+@app.post("/admin/profile")
+async def profile(
+        seconds: Optional[float] = None,
+        batches: Optional[int] = None,
+        torch_trace: bool = True,
+        python: bool = True,
+        timeout: float = 120.0,
+        x_profile_token: Optional[str] = Header(None),
+):
+    """
+    采集seconds秒或batches个推理batch的profile，完成后返回生成的chrome trace和folded stacks文件。
+    seconds与batches都为空时采集10秒。folded stacks不是svg，需要自行用flamegraph.pl渲染或在speedscope中打开。
+
+    需要在X-Profile-Token头中给出settings.serving.profile_token，未配置token时该接口关闭
+    """
+    token = settings.serving.profile_token
+    if not token:
+        raise HTTPException(status_code=404, detail="profiling is disabled")
+    if x_profile_token is None or not hmac.compare_digest(x_profile_token.encode(), token.encode()):
+        raise HTTPException(status_code=403, detail="invalid profile token")
+    if seconds is not None and batches is not None:
+        raise HTTPException(status_code=400, detail="specify either seconds or batches")
+    try:
+        return await service.profile(
+            output_dir=settings.serving.profile_dir, seconds=seconds, batches=batches,
+            torch_trace=torch_trace, python=python, timeout=timeout,
+        )
+    except WorkerCrashed as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+
+def stats_families(avatar_id: str, stats: dict) -> list:
+    """
+    把各组件的stats()转换为指标族，采集时才读取，不增加推理和播放路径的开销
+    """
+    avatar = {"avatar": avatar_id}
+    playout = stats["playout"]
+    queue = stats["queue"]
+    feature_cache = stats["caches"]["audio_features"]
+    tts_cache = stats["caches"]["tts"]
+    idle_cache = idle_frame_cache.stats() if idle_frame_cache is not None else {"hits": 0, "misses": 0}
+    sessions = broadcaster.stats()
+    return [
+        family('musetalk_fps', 'gauge', 'Achieved playout frames per second', [(avatar, playout["fps"])]),
+        family('musetalk_frames_played_total', 'counter', 'Frames emitted by the playout clock',
+               [(avatar, playout["frames_played"])]),
+        family('musetalk_speech_frames_total', 'counter', 'Rendered speech frames played',
+               [(avatar, playout["speech_frames"])]),
+        family('musetalk_deadline_misses_total', 'counter', 'Playout ticks skipped because a frame was late',
+               [(avatar, playout["deadline_misses"])]),
+        family('musetalk_underruns_total', 'counter', 'Ticks with an empty buffer while speaking',
+               [(avatar, playout["underruns"])]),
+        family('musetalk_overruns_total', 'counter', 'Frames put into a full playout buffer',
+               [(avatar, playout["overruns"])]),
+        family('musetalk_buffered_frames', 'gauge', 'Rendered frames waiting to be played',
+               [(avatar, playout["buffered_frames"])]),
+        family('musetalk_queue_depth', 'gauge', 'Jobs waiting in the avatar queue', [(avatar, queue["depth"])]),
+        family('musetalk_jobs_total', 'counter', 'Finished jobs by status', [
+            ({**avatar, "status": status}, queue[status]) for status in ('completed', 'cancelled', 'failed')
+        ]),
+        family('musetalk_admission_backlog_seconds', 'gauge', 'Projected render time of admitted jobs',
+               [(avatar, stats["admission"]["backlog_seconds"])]),
+        family('musetalk_admission_rejected_total', 'counter', 'Requests rejected by admission control',
+               [(avatar, stats["admission"]["rejected"])]),
+        family('musetalk_sessions', 'gauge', 'Connected viewers by transport', [
+            ({"transport": "jpeg"}, sessions["clients"]), ({"transport": "h264"}, sessions["stream_clients"]),
+        ]),
+        family('musetalk_cache_hits_total', 'counter', 'Cache hits', [
+            ({"cache": "audio_features", "tier": "memory"}, feature_cache["memory_hits"]),
+            ({"cache": "audio_features", "tier": "disk"}, feature_cache["disk_hits"]),
+            ({"cache": "tts", "tier": "disk"}, tts_cache["hits"]),
+            ({"cache": "idle_frames", "tier": "memory"}, idle_cache["hits"]),
+        ]),
+        family('musetalk_cache_misses_total', 'counter', 'Cache misses', [
+            ({"cache": "audio_features"}, feature_cache["misses"]),
+            ({"cache": "tts"}, tts_cache["misses"]),
+            ({"cache": "idle_frames"}, idle_cache["misses"]),
+        ]),
+    ]
+
+
+@app.get("/metrics")
+async def metrics():
+    families = REGISTRY.collect() + await service.metrics()
+    families += stats_families(service.avatar_id, await service.stats())
+    return PlainTextResponse(render(families), media_type='text/plain; version=0.0.4')
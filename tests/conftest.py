@@ -0,0 +1,25 @@
+import pytest
+
+
+@pytest.fixture
+def tiny_whisper(tmp_path):
+    """
+    随机初始化的小型whisper audio encoder checkpoint(格式与openai-whisper一致，只包含encoder)
+    """
+    torch = pytest.importorskip("torch")
+    pytest.importorskip("whisper")
+    from musetalk.audio.audio_feature_extract import AudioEncoder
+
+    torch.manual_seed(0)
+    dims = {'n_mels': 80, 'n_audio_ctx': 1500, 'n_audio_state': 16, 'n_audio_head': 2, 'n_audio_layer': 2}
+    encoder = AudioEncoder(
+        n_mels=dims['n_mels'],
+        n_ctx=dims['n_audio_ctx'],
+        n_state=dims['n_audio_state'],
+        n_head=dims['n_audio_head'],
+        n_layer=dims['n_audio_layer'],
+    )
+    state_dict = {f'encoder.{key}': value for key, value in encoder.state_dict().items()}
+    path = tmp_path / 'tiny_whisper.pt'
+    torch.save({'dims': dims, 'model_state_dict': state_dict}, path)
+    return path
@@ -0,0 +1,42 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+
+
+def late_peak_signal(seconds=5.0, peak_at=4.0, sample_rate=16000):
+    # 前面是很轻的噪声和音调，最响的部分出现在末尾，流式处理时运行中的最大值会在最后被刷新
+    rng = np.random.default_rng(0)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    pcm = 0.01 * rng.standard_normal(t.shape[0]) + 0.02 * np.sin(2 * np.pi * 220 * t)
+    burst = (t >= peak_at) & (t < peak_at + 0.5)
+    pcm[burst] += 0.9 * np.sin(2 * np.pi * 440 * t[burst])
+    return pcm.astype(np.float32)
+
+
+@pytest.fixture
+def extractor(tiny_whisper):
+    from musetalk.audio.audio_feature_extract import AudioFeatureExtractor
+
+    return AudioFeatureExtractor(str(tiny_whisper), 'cpu', torch.float32)
+
+
+def stream_features(extractor, pcm, lookahead, chunk=3200):
+    chunks = [pcm[start: start + chunk] for start in range(0, pcm.shape[0], chunk)]
+    return torch.stack(list(extractor.extract_features_stream(chunks, audio_window=2, lookahead=lookahead)))
+
+
+def test_stream_without_lookahead_matches_offline_with_late_peak(extractor):
+    pcm = late_peak_signal()
+    offline = extractor.extract_features(pcm, audio_window=2)
+    streamed = stream_features(extractor, pcm, lookahead=None)
+    assert streamed.shape == offline.shape
+    torch.testing.assert_close(streamed, offline, rtol=1e-4, atol=1e-4)
+
+
+def test_stream_with_lookahead_emits_every_frame(extractor):
+    pcm = late_peak_signal()
+    offline = extractor.extract_features(pcm, audio_window=2)
+    streamed = stream_features(extractor, pcm, lookahead=5)
+    # 低延迟模式的数值与离线不同(运行中的最大值、补零的上下文)，但帧数和形状一致
+    assert streamed.shape == offline.shape
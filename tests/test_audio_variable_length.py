@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+
+# 变长编码与补零编码的容差，serving.variable_length_audio只有在真实权重上满足时才能打开
+RTOL = 0.05
+MIN_COSINE = 0.99
+
+
+def speech_like(seconds, sample_rate=16000):
+    rng = np.random.default_rng(0)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    envelope = 0.5 + 0.5 * np.sin(2 * np.pi * 3 * t)
+    pcm = envelope * (0.3 * np.sin(2 * np.pi * 180 * t) + 0.05 * rng.standard_normal(t.shape[0]))
+    return pcm.astype(np.float32)
+
+
+def extractor(model_path):
+    from musetalk.audio.audio_feature_extract import AudioFeatureExtractor
+
+    return AudioFeatureExtractor(str(model_path), 'cpu', torch.float32)
+
+
+@pytest.mark.parametrize('seconds', [0.3, 2.0, 7.5])
+def test_variable_length_keeps_frame_count(tiny_whisper, seconds):
+    afe = extractor(tiny_whisper)
+    pcm = speech_like(seconds)
+    padded = afe.extract_features(pcm, audio_window=2, variable_length=False)
+    trimmed = afe.extract_features(pcm, audio_window=2, variable_length=True)
+    assert trimmed.shape == padded.shape
+    assert torch.isfinite(trimmed).all()
+
+
+def test_variable_length_only_changes_the_last_segment(tiny_whisper):
+    # 完整的30秒片段仍然按原来的方式编码，只有最后不足30秒的片段被裁剪
+    afe = extractor(tiny_whisper)
+    pcm = speech_like(33.0)
+    padded = afe.extract_features(pcm, audio_window=2, variable_length=False)
+    trimmed = afe.extract_features(pcm, audio_window=2, variable_length=True)
+    # 30秒为750帧，最后的audio_window帧的窗口跨入最后一个片段
+    torch.testing.assert_close(trimmed[:748], padded[:748], rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.skipif(
+    not os.environ.get('MUSETALK_WHISPER'),
+    reason="set MUSETALK_WHISPER to a whisper checkpoint to check parity on real weights",
+)
+@pytest.mark.parametrize('seconds', [1.0, 4.0, 12.0])
+def test_variable_length_parity_on_real_weights(seconds):
+    # 随机权重的注意力分布与真实模型不同，一致性只能在真实权重上判断
+    afe = extractor(os.environ['MUSETALK_WHISPER'])
+    result = afe.variable_length_parity(speech_like(seconds), audio_window=2)
+    assert result["max_rel_error"] <= RTOL, result
+    assert result["min_cosine"] >= MIN_COSINE, result
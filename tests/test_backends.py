@@ -0,0 +1,157 @@
+import copy
+from types import SimpleNamespace
+
+import pytest
+
+torch = pytest.importorskip("torch")
+nn = torch.nn
+
+from musetalk.models.backends import (  # noqa: E402
+    AudioEncoderModule, UNetModule, VaeDecoderModule, export, load_backend, parity, read_manifest, write_manifest,
+)
+
+# 与scripts/export_backends.py的--rtol一致，int8按量化误差放宽
+RTOL = {'compiled': 1e-4, 'torchscript': 1e-3, 'onnxruntime': 1e-3, 'int8': 0.1}
+
+
+class TinyUNet(nn.Module):
+    """
+    代替diffusers的UNet2DConditionModel: 卷积加上音频特征投影，子模块名与量化的FLOAT_MODULES一致
+    """
+
+    def __init__(self, latent_channels=8, channels=16, audio_dim=384):
+        super().__init__()
+        self.conv_in = nn.Conv2d(latent_channels, channels, 3, padding=1)
+        self.audio_proj = nn.Linear(audio_dim, channels)
+        self.mid = nn.Conv2d(channels, channels, 3, padding=1)
+        self.conv_out = nn.Conv2d(channels, latent_channels // 2, 3, padding=1)
+
+    def forward(self, latents, audio):
+        h = self.conv_in(latents) + self.audio_proj(audio).mean(1)[:, :, None, None]
+        return self.conv_out(torch.nn.functional.silu(self.mid(h)))
+
+
+class TinyMuseTalk(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.unet = TinyUNet()
+
+    def forward(self, inputs):
+        latents, audio = inputs
+        return self.unet(latents, audio)
+
+
+class TinyDecoder(nn.Module):
+    def __init__(self, latent_channels=4, channels=16):
+        super().__init__()
+        self.conv_in = nn.Conv2d(latent_channels, channels, 3, padding=1)
+        self.mid = nn.Conv2d(channels, channels, 3, padding=1)
+        self.conv_out = nn.Conv2d(channels, 3, 3, padding=1)
+
+    def forward(self, z):
+        h = torch.nn.functional.silu(self.mid(self.conv_in(z)))
+        h = torch.nn.functional.interpolate(h, scale_factor=2, mode='nearest')
+        return torch.tanh(self.conv_out(h))
+
+
+class TinyVae(nn.Module):
+    """
+    代替AutoencoderKL，decode的返回值与diffusers一样带有sample属性
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.post_quant_conv = nn.Conv2d(4, 4, 1)
+        self.decoder = TinyDecoder()
+
+    def decode(self, z):
+        return SimpleNamespace(sample=self.decoder(self.post_quant_conv(z)))
+
+
+def tiny_audio_encoder():
+    pytest.importorskip("whisper")
+    from musetalk.audio.audio_feature_extract import AudioEncoder
+
+    return AudioEncoder(n_mels=80, n_ctx=1500, n_state=16, n_head=2, n_layer=2)
+
+
+def make_component(component, batch_size=4):
+    torch.manual_seed(0)
+    if component == 'unet':
+        module = UNetModule(TinyMuseTalk())
+        inputs = (torch.randn(batch_size, 8, 32, 32), torch.randn(batch_size, 50, 384))
+    elif component == 'vae_decoder':
+        module = VaeDecoderModule(TinyVae())
+        inputs = (torch.randn(batch_size, 4, 16, 16),)
+    else:
+        module = AudioEncoderModule(tiny_audio_encoder())
+        inputs = (torch.randn(batch_size, 80, 3000),)
+    return module.eval(), inputs
+
+
+def prepare_backend(component, module, inputs, backend, export_dir, dynamic_batch=True):
+    """
+    导出backend需要的文件并写入manifest，返回load_backend得到的runner
+    """
+    if backend in ('torchscript', 'onnxruntime'):
+        fmt = 'onnx' if backend == 'onnxruntime' else 'torchscript'
+        manifest = read_manifest(export_dir)
+        manifest["components"].setdefault(component, {})[fmt] = export(
+            component, module, inputs, export_dir, fmt, dynamic_batch
+        )
+        write_manifest(export_dir, manifest)
+    elif backend == 'int8':
+        from musetalk.models.quantization import FLOAT_MODULES, quantize, save_int8
+
+        def calibrate(observed):
+            observed(*inputs)
+
+        info = {"float_modules": list(FLOAT_MODULES[component]), "dynamic": True}
+        path = export_dir / f'{component}.int8.pt'
+        save_int8(quantize(component, module, calibrate), path, info)
+        manifest = read_manifest(export_dir)
+        manifest["components"].setdefault(component, {})["int8"] = {
+            "file": path.name, "batch_size": None, "dtype": "float32", "static": True, **info,
+        }
+        write_manifest(export_dir, manifest)
+        # int8后端原地量化传入的模块，保留eager模块作为参照
+        module = copy.deepcopy(module)
+    return load_backend(component, module, backend, export_dir)
+
+
+def require(backend):
+    if backend == 'onnxruntime':
+        pytest.importorskip("onnx")
+        pytest.importorskip("onnxruntime")
+    elif backend == 'int8':
+        from musetalk.models.quantization import quantized_engine
+
+        try:
+            quantized_engine()
+        except RuntimeError as e:
+            pytest.skip(str(e))
+
+
+@pytest.mark.parametrize('backend', ['compiled', 'torchscript', 'onnxruntime', 'int8'])
+@pytest.mark.parametrize('component', ['unet', 'vae_decoder', 'audio_encoder'])
+def test_backend_matches_eager(component, backend, tmp_path):
+    require(backend)
+    module, inputs = make_component(component)
+    runner = prepare_backend(component, module, inputs, backend, tmp_path)
+    # 动态batch导出的模型也要覆盖与导出时不同的batch
+    for case in (inputs, tuple(x[:3] for x in inputs)):
+        result = parity(module, runner, case, repeat=1)
+        assert result["max_rel_error"] <= RTOL[backend], result
+
+
+@pytest.mark.parametrize('backend', ['torchscript', 'onnxruntime'])
+def test_fixed_batch_export_pads_partial_batches(backend, tmp_path):
+    require(backend)
+    module, inputs = make_component('vae_decoder')
+    runner = prepare_backend('vae_decoder', module, inputs, backend, tmp_path, dynamic_batch=False)
+    partial = tuple(x[:3] for x in inputs)
+    with torch.no_grad():
+        expected = module(*partial)
+        actual = runner(*partial)
+    assert actual.shape == expected.shape
+    torch.testing.assert_close(actual, expected, rtol=1e-3, atol=1e-4)
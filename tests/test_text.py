@@ -0,0 +1,27 @@
+from common.text import speakable_sentences, split_sentence
+
+
+def test_split_sentence_keeps_punctuation():
+    assert split_sentence("你好。再见！", min_length=1) == ["你好。", "再见！"]
+
+
+def test_trailing_newline_is_dropped():
+    assert speakable_sentences("大家好。\n") == ["大家好。"]
+
+
+def test_pieces_are_stripped():
+    assert speakable_sentences("  大家好。\n  欢迎来到直播间！ ") == ["大家好。", "欢迎来到直播间！"]
+
+
+def test_punctuation_only_pieces_are_dropped():
+    assert speakable_sentences("。！？") == []
+    assert speakable_sentences("……。好的。") == ["好的。"]
+
+
+def test_whitespace_only_text():
+    assert speakable_sentences(" \n\t") == []
+    assert speakable_sentences("") == []
+
+
+def test_digits_and_latin_are_speakable():
+    assert speakable_sentences("2024。OK！") == ["2024。", "OK！"]
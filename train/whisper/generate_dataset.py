@@ -14,7 +14,7 @@ audio,text
 path/to/audio_file.mp3,对应的文本内容
 """
 import os
-import re
+import sys
 import glob
 import hashlib
 import asyncio
@@ -27,20 +27,8 @@ import aiofiles
 import pandas as pd
 from tqdm import tqdm
 
-pattern = re.compile('([﹒﹔﹖﹗．；。！？]["’”」』]{0,2}|：(?=["‘“「『]{1,2}|$))')
-
-
-def split_sentence(text, min_length=5):
-    if not text.strip():
-        return []
-    slist = []
-    for sentence in pattern.split(text):
-        if pattern.match(sentence) and slist:
-            slist[-1] += sentence
-        elif sentence:
-            if len(sentence) >= min_length:
-                slist.append(sentence)
-    return slist
+sys.path.append('.')
+from common.text import split_sentence
 
 
 async def tts(text, voice, output_dir):
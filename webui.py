@@ -66,7 +66,7 @@ def inference(text):
 def load_avatar(avatar_id):
     global avatar, svc
     if avatar is None:
-        avatar = Avatar(str(avatar_id), 'video_path', 5, device)
+        avatar = Avatar(str(avatar_id), 'video_path', 5, device, streaming=False)
     if svc is None:
         speaker_path = Path('speakers') / avatar_id
         config_path = str(list(speaker_path.glob('*.json'))[0])